@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from cli import STAGE_MODULES, STAGE_EXCLUDED_MODULES
+from benchmarks.run_benchmarks import BASELINE_PATH, compare_to_baseline
+from typing import Dict, List, Tuple
+
+# Imports the CLI and the modules of one stage in a fresh interpreter, and reports the
+# time it took and which of the excluded libraries got imported along the way
+PROBE = """
+import sys, json, time, importlib
+start = time.perf_counter()
+import cli
+for module in {modules!r}:
+    importlib.import_module(module)
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "imported": [name for name in {excluded!r} if name in sys.modules]}}))
+"""
+
+def probe_stage(stage: str) -> Tuple[float, List[str]]:
+    """
+    Measures the import time of a stage (or of the bare CLI for "cli") in a new process.
+    """
+    code = PROBE.format(modules=STAGE_MODULES.get(stage, []), excluded=STAGE_EXCLUDED_MODULES.get(stage, []))
+    output = subprocess.run([sys.executable, "-c", code], cwd=REPO_ROOT, check=True, capture_output=True, text=True).stdout
+    report = json.loads(output.strip().splitlines()[-1])
+    return report["seconds"], report["imported"]
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measures the startup time of the CLI stages, guarding against heavy imports.")
+    parser.add_argument("--stages", nargs="+", default=["cli"] + list(STAGE_MODULES))
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Allowed slowdown relative to the baseline")
+    args = parser.parse_args()
+
+    timings: Dict[str, float] = {}
+    violations = []
+    for stage in args.stages:
+        samples = []
+        for _ in range(args.repeats):
+            seconds, imported = probe_stage(stage)
+            samples.append(seconds)
+        timings[stage] = statistics.median(samples)
+        print(f"  {stage:<12} {timings[stage]:8.3f}s")
+        if imported:
+            violations.append(f"{stage} imports {', '.join(imported)}")
+    results = {"startup": timings}
+
+    for violation in violations:
+        print(f"HEAVY IMPORT {violation}")
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=4)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        violations.extend(regressions)
+    else:
+        print("No baseline found, run with --save-baseline to create one.")
+    if violations:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import os
+import numpy as np
+import nibabel as nib
+from typing import Dict, Tuple
+
+# Voxel spacing (mm) of the thin high res series and slice thickness of the segmentation series
+HIGH_RES_SPACING = (0.45, 0.45, 0.6)
+SEGMENTATION_SLICE_THICKNESS = 3.0
+
+def phantom_affine(shape: Tuple[int, int, int], spacing: Tuple[float, float, float]) -> np.ndarray:
+    """
+    Builds a scanner-like affine with the volume centred on the origin.
+    """
+    affine = np.diag(list(spacing) + [1.0])
+    affine[:3, 3] = -np.array(shape) * np.array(spacing) / 2.0
+    return affine
+
+def phantom_labels(shape: Tuple[int, int, int], spacing: Tuple[float, float, float]) -> Dict[str, np.ndarray]:
+    """
+    Creates head-and-neck label masks (body, skull, vertebrae_C3, vertebrae_C7) on a grid,
+    with the anatomy defined in millimetres so every grid sees the same phantom.
+    Slices are generated one at a time to keep memory at one byte per voxel and label.
+    """
+    extent = np.array(shape) * np.array(spacing)
+    x = (np.arange(shape[0]) + 0.5) * spacing[0] - extent[0] / 2
+    y = (np.arange(shape[1]) + 0.5) * spacing[1] - extent[1] / 2
+    radius = (x[:, None] / (0.35 * extent[0])) ** 2 + (y[None, :] / (0.4 * extent[1])) ** 2
+    vertebra = (x[:, None] / (0.08 * extent[0])) ** 2 + ((y[None, :] + 0.2 * extent[1]) / (0.06 * extent[1])) ** 2 <= 1.0
+
+    labels = {label: np.zeros(shape, dtype=bool) for label in ("body", "skull", "vertebrae_C3", "vertebrae_C7")}
+    for k in range(shape[2]):
+        z = (k + 0.5) * spacing[2] / extent[2]
+        # The neck narrows the body below the head
+        labels["body"][:, :, k] = radius <= (1.0 if z >= 0.45 else 0.36)
+        head = radius + ((z - 0.72) / 0.25) ** 2
+        labels["skull"][:, :, k] = (head <= 1.0) & (head >= 0.8)
+        if 0.4 <= z < 0.45:
+            labels["vertebrae_C3"][:, :, k] = vertebra
+        if 0.15 <= z < 0.2:
+            labels["vertebrae_C7"][:, :, k] = vertebra
+    return labels
+
+def phantom_ct(labels: Dict[str, np.ndarray], seed: int = 0) -> np.ndarray:
+    """
+    Creates HU intensities for the label masks: air, noisy soft tissue and bone.
+    """
+    rng = np.random.default_rng(seed)
+    ct = np.full(labels["body"].shape, -1000, dtype=np.int16)
+    for k in range(ct.shape[2]):
+        body = labels["body"][:, :, k]
+        ct[:, :, k][body] = 40 + rng.normal(0, 15, size=int(body.sum())).astype(np.int16)
+        bone = labels["skull"][:, :, k] | labels["vertebrae_C3"][:, :, k] | labels["vertebrae_C7"][:, :, k]
+        ct[:, :, k][bone] = 700
+    return ct
+
+def write_phantom_case(case_path: str, shape: Tuple[int, int, int], seed: int = 0) -> Dict[str, str]:
+    """
+    Writes a synthetic case folder with the layout of an unzipped case: the thin CT scan,
+    the thick segmentation series and its label masks in segmentation/.
+    Returns the paths of the written CT scans.
+    """
+    os.makedirs(os.path.join(case_path, "segmentation"), exist_ok=True)
+
+    high_res_labels = phantom_labels(shape, HIGH_RES_SPACING)
+    high_res_affine = phantom_affine(shape, HIGH_RES_SPACING)
+    ct_scan_path = os.path.join(case_path, "CT_scan.nii.gz")
+    nib.save(nib.Nifti1Image(phantom_ct(high_res_labels, seed), high_res_affine), ct_scan_path)
+    del high_res_labels
+
+    segmentation_spacing = (HIGH_RES_SPACING[0] * 2, HIGH_RES_SPACING[1] * 2, SEGMENTATION_SLICE_THICKNESS)
+    segmentation_shape = tuple(
+        max(1, int(round(size * spacing / segmentation_spacing_axis)))
+        for size, spacing, segmentation_spacing_axis in zip(shape, HIGH_RES_SPACING, segmentation_spacing)
+    )
+    segmentation_labels = phantom_labels(segmentation_shape, segmentation_spacing)
+    segmentation_affine = phantom_affine(segmentation_shape, segmentation_spacing)
+    segmentation_ct_path = os.path.join(case_path, "CT_scan_segmentation.nii.gz")
+    nib.save(nib.Nifti1Image(phantom_ct(segmentation_labels, seed), segmentation_affine), segmentation_ct_path)
+    for label, mask in segmentation_labels.items():
+        nib.save(nib.Nifti1Image(mask.astype(np.uint8), segmentation_affine), os.path.join(case_path, "segmentation", f"{label}.nii.gz"))
+
+    return {"ct_scan": ct_scan_path, "segmentation_ct": segmentation_ct_path}
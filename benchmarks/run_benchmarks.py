@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import numpy as np
+import nibabel as nib
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.phantoms import write_phantom_case
+from preprocessing import downsampling, normalization, removing_excess, ROI_cropping
+from utils import file_utils
+from utils.common import find_bounding_box
+from typing import Callable, Dict, List, Tuple
+
+DEFAULT_SIZES = ["256x256x256"]
+LARGE_SIZES = ["512x512x800", "512x512x1500"]
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+ROI_BOUNDS = {
+    "left": {"label": "skull", "task": "total", "type": "min", "padding": 15},
+    "right": {"label": "skull", "task": "total", "type": "max", "padding": 15},
+    "up": {"label": "vertebrae_C3", "task": "total", "type": "max", "padding": 5},
+    "down": {"label": "vertebrae_C7", "task": "total", "type": "min", "padding": 5},
+    "front": {"label": "body", "task": "body", "type": "max", "padding": 7},
+    "back": {"label": "vertebrae_C7", "task": "total", "type": "min", "padding": 7},
+    "outside": {"label": "body", "task": "body", "padding": 5},
+}
+
+def parse_size(size: str) -> Tuple[int, int, int]:
+    return tuple(int(axis) for axis in size.lower().split("x"))
+
+def time_call(function: Callable, setup: Callable = None, repeats: int = 3) -> float:
+    """
+    Returns the median wall time of a function over several runs. The setup function,
+    if given, runs before every call and its result is passed to the function.
+    """
+    timings = []
+    for _ in range(repeats):
+        argument = setup() if setup is not None else None
+        start = time.perf_counter()
+        function(argument) if setup is not None else function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+def benchmark_size(size: str, work_folder: str, repeats: int) -> Dict[str, float]:
+    """
+    Times the preprocessing functions and the full preprocessing path on one phantom size.
+    """
+    shape = parse_size(size)
+    case_path = os.path.join(work_folder, f"phantom-{size}")
+    paths = write_phantom_case(case_path, shape)
+
+    ct_scan = nib.load(paths["ct_scan"], mmap=True)
+    ct_data = np.asarray(ct_scan.dataobj, dtype=np.float32)
+    body_data = np.asarray(ct_data > -500, dtype=np.float32)
+    skull_mask = torch.from_numpy(np.asarray(nib.load(os.path.join(case_path, "segmentation", "skull.nii.gz")).dataobj, dtype=np.float32))
+    target_shape = (128, 128, 128)
+    crop = tuple(axis for size_axis in shape for axis in (size_axis // 8, size_axis - size_axis // 8))
+
+    results = {}
+    results["find_bounding_box"] = time_call(lambda: find_bounding_box(skull_mask), repeats=repeats)
+    results["expand_mask"] = time_call(lambda: removing_excess.expand_mask(torch.from_numpy(body_data), 5), repeats=repeats)
+    body_with_padding = removing_excess.expand_mask(torch.from_numpy(body_data), 5)
+    results["set_values_outside_body"] = time_call(
+        lambda ct_tensor: removing_excess.set_values_outside_body(ct_tensor, body_with_padding),
+        setup=lambda: torch.from_numpy(ct_data.copy()),
+        repeats=repeats
+    )
+    results["crop_ct_scan"] = time_call(lambda: ROI_cropping.crop_ct_scan(torch.from_numpy(ct_data), *crop).contiguous(), repeats=repeats)
+    cropped = ROI_cropping.crop_ct_scan(torch.from_numpy(ct_data), *crop).contiguous()
+    results["downsample_ct"] = time_call(lambda: downsampling.downsample_ct(cropped, target_shape, verbose=False), repeats=repeats)
+    downsampled = downsampling.downsample_ct(cropped, target_shape, verbose=False)
+    pyramid_shapes = [target_shape, tuple(size // 2 for size in target_shape)]
+    results["downsample_pyramid"] = time_call(lambda: downsampling.downsample_pyramid(cropped, pyramid_shapes, mode="antialiased", verbose=False), repeats=repeats)
+    results["normalize_hu"] = time_call(lambda: normalization.normalize_hu(downsampled, -1000, 1000), repeats=repeats)
+    output_file = os.path.join(work_folder, "save_nifti.nii.gz")
+    results["save_nifti"] = time_call(lambda: file_utils.save_nifti(downsampled.numpy(), np.eye(4), output_file), repeats=repeats)
+    del ct_data, body_data, skull_mask, body_with_padding, cropped
+
+    # The full path imports main lazily, since it pulls in every stage of the pipeline
+    from main import preprocess_ct_scan
+    output_folder = os.path.join(work_folder, "output")
+    config = {
+        "target_shape": target_shape,
+        "min_hu": -1000,
+        "max_hu": 1000,
+        "output_folder": output_folder,
+        "roi_bounds": ROI_BOUNDS,
+        "crop_first": True,
+        "segmentation_backend": "threshold",
+        "manifest_path": None,
+    }
+
+    def run_full_path(_) -> None:
+        preprocess_ct_scan(case_path, paths["ct_scan"], paths["segmentation_ct"], config)
+
+    def clear_output() -> None:
+        # The output folder also holds the case_summaries folder
+        shutil.rmtree(output_folder, ignore_errors=True)
+        os.makedirs(output_folder)
+
+    results["preprocess_ct_scan"] = time_call(run_full_path, setup=clear_output, repeats=repeats)
+    return results
+
+def compare_to_baseline(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float) -> List[str]:
+    """
+    Returns a message for every benchmark that is slower than its baseline by more than the tolerance.
+    """
+    regressions = []
+    for size, timings in results.items():
+        for name, seconds in timings.items():
+            reference = baseline.get(size, {}).get(name)
+            if reference and seconds > reference * (1 + tolerance):
+                regressions.append(f"{size} {name}: {seconds:.3f}s vs baseline {reference:.3f}s ({seconds / reference:.2f}x)")
+    return regressions
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks the preprocessing functions on synthetic CT phantoms.")
+    parser.add_argument("--sizes", nargs="+", default=DEFAULT_SIZES, help="Phantom sizes as XxYxZ")
+    parser.add_argument("--large", action="store_true", help=f"Also run the large sizes {', '.join(LARGE_SIZES)}")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown relative to the baseline")
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    sizes = args.sizes + (LARGE_SIZES if args.large else [])
+    results = {}
+    with tempfile.TemporaryDirectory() as work_folder:
+        for size in sizes:
+            print(f"Benchmarking phantom {size}...")
+            results[size] = benchmark_size(size, work_folder, args.repeats)
+            for name, seconds in results[size].items():
+                print(f"  {name:<26} {seconds:8.3f}s")
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=4)
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print("No baseline found, run with --save-baseline to create one.")
+        return
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    regressions = compare_to_baseline(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+    print("No regressions against the baseline.")
+
+if __name__ == "__main__":
+    main()
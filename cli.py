@@ -0,0 +1,205 @@
+import os
+import sys
+import argparse
+from config import load_config
+from typing import List
+
+# Modules imported by each stage when it runs. Building the parser and loading the config
+# import none of them, so a stage only pays for the libraries it uses; benchmarks.import_time
+# checks that stages stay clear of the libraries listed in STAGE_EXCLUDED_MODULES
+STAGE_MODULES = {
+    "ingest": ["preprocessing.process_zipped_data"],
+    "segment": ["preprocessing.segmentation", "preprocessing.segmentation_backends", "preprocessing.process_zipped_data", "utils.segmentation_cache"],
+    "preprocess": ["main"],
+    "anomalies": ["synthetic_abnormality.generate_abnormalities"],
+    "catalog": ["utils.dicom_catalog"],
+    "qc": ["utils.qc_montage"],
+}
+STAGE_EXCLUDED_MODULES = {
+    "ingest": ["torch", "pandas", "totalsegmentator"],
+    "segment": ["torch", "pandas", "totalsegmentator"],
+    "anomalies": ["torch", "pandas", "totalsegmentator", "dicom2nifti"],
+    "catalog": ["torch", "pandas", "totalsegmentator", "dicom2nifti"],
+    "qc": ["torch", "pandas", "totalsegmentator", "dicom2nifti", "matplotlib.pyplot"],
+}
+
+def select_cases(config: dict, args: argparse.Namespace) -> List[str]:
+    """
+    Returns the cases a stage runs on: the cases given with --case, the case at
+    --case-index in the sorted list of archives (e.g. the index of an array job),
+    or all archives of the zipped data folder.
+    """
+    if args.case:
+        return args.case
+    cases = sorted(os.path.splitext(f)[0] for f in os.listdir(config["data_zipped_folder"]) if f.endswith(".zip"))
+    if args.case_index is not None:
+        if not 0 <= args.case_index < len(cases):
+            raise SystemExit(f"Case index {args.case_index} out of range, there are {len(cases)} cases")
+        return [cases[args.case_index]]
+    return cases
+
+def resolve_scan_choice(config: dict, verbose: bool = False) -> dict:
+    """
+    Returns the scan choice, completed from the DICOM catalog if automatic scan choice is on.
+    """
+    if not config.get("auto_scan_choice", False):
+        return config["scan_choice"]
+    from utils.dicom_catalog import DicomCatalog, build_scan_choice, scan_choice_overrides
+    with DicomCatalog(config["dicom_catalog_path"]) as catalog:
+        catalog.update(config["data_zipped_folder"], num_workers=config.get("ingest_workers", 1), verbose=verbose)
+        return build_scan_choice(catalog, config.get("scan_selection_rules"), overrides=scan_choice_overrides(config))
+
+def run_ingest(config: dict, args: argparse.Namespace) -> int:
+    """
+    Unzips the cases and converts their chosen DICOM series to NIfTI.
+    """
+    from preprocessing import process_zipped_data
+    process_zipped_data.process_zipped_data(
+        config["data_zipped_folder"],
+        config["data_folder"],
+        resolve_scan_choice(config, verbose=args.verbose),
+        num_workers=config.get("ingest_workers", 1),
+        in_memory=config["ingest_in_memory"],
+        manifest_path=config.get("manifest_path"),
+        extension=config.get("intermediate_nifti_extension", ".nii.gz"),
+        zip_filenames=[f"{case}.zip" for case in select_cases(config, args)],
+        verbose=args.verbose
+    )
+    return 0
+
+def run_segment(config: dict, args: argparse.Namespace) -> int:
+    """
+    Segments the ingested cases. Cases whose segmentation is complete are left as they are.
+    """
+    from preprocessing.process_zipped_data import intermediate_nifti_paths
+    from preprocessing.segmentation import run_segmentation
+    from preprocessing.segmentation_backends import create_backend
+    from utils.segmentation_cache import create_segmentation_cache
+    backend = create_backend(config.get("segmentation_backend", "totalsegmentator"), verbose=args.verbose)
+    cache = create_segmentation_cache(config, verbose=args.verbose)
+    failed = []
+    for case in select_cases(config, args):
+        case_path = os.path.join(config["data_folder"], case)
+        segmentation_ct_path, _ = intermediate_nifti_paths(case_path, config.get("intermediate_nifti_extension", ".nii.gz"))
+        if not os.path.exists(segmentation_ct_path):
+            print(f"{case}: {segmentation_ct_path} not found, run the ingest stage first")
+            failed.append(case)
+            continue
+        if not run_segmentation(segmentation_ct_path, os.path.join(case_path, "segmentation"), config["roi_bounds"], verbose=args.verbose, backend=backend, cache=cache):
+            print(f"{case}: segmentation failed or missing files")
+            failed.append(case)
+    return 1 if failed else 0
+
+def run_preprocess(config: dict, args: argparse.Namespace) -> int:
+    """
+    Preprocesses the ingested cases into the output folder, appending errors to the error log.
+    """
+    import main
+    error_log_path = config.get("error_log", "error_log.csv")
+    if not os.path.exists(error_log_path):
+        with open(error_log_path, "w") as f:
+            f.write(",".join(main.ERROR_LOG_COLUMNS) + "\n")
+    results, _ = main.process_cases(
+        select_cases(config, args), config, verbose=args.verbose,
+        on_case_done=lambda result, errors: main.append_error_log(errors, error_log_path)
+    )
+    if config.get("profile_report"):
+        main.write_profile_report([record for result in results for record in result["Profile"]], config["profile_report"])
+    if config.get("hu_statistics", True):
+        main.write_dataset_statistics(main.case_summary_folder(config), main.dataset_statistics_path(config))
+    return 0 if all(result["Status"] in ("done", "skipped") for result in results) else 1
+
+def run_anomalies(config: dict, args: argparse.Namespace) -> int:
+    """
+    Injects synthetic anomalies into preprocessed scans.
+    """
+    from synthetic_abnormality.generate_abnormalities import generate_abnormalities
+    input_folder = args.input_folder or config["output_folder"]
+    generate_abnormalities(
+        input_folder, args.output_folder or os.path.join(input_folder, "synthetic_abnormalities"), args.num_scans, args.sizes,
+        shapes=args.shapes, intensity=args.intensity, seed=args.seed, num_workers=args.workers, save_masks=args.save_masks
+    )
+    return 0
+
+def run_catalog(config: dict, args: argparse.Namespace) -> int:
+    """
+    Catalogs the DICOM series of the zipped cases, optionally writing the selected scans.
+    """
+    import json
+    from utils.dicom_catalog import DicomCatalog, build_scan_choice, scan_choice_overrides
+    with DicomCatalog(config["dicom_catalog_path"]) as catalog:
+        scanned = catalog.update(config["data_zipped_folder"], num_workers=args.workers or config.get("ingest_workers", 1), verbose=args.verbose)
+        print(f"Cataloged {len(scanned)} archives in {config['dicom_catalog_path']}")
+        if args.scan_choice_output:
+            with open(args.scan_choice_output, "w") as f:
+                json.dump(build_scan_choice(catalog, config.get("scan_selection_rules"), overrides=scan_choice_overrides(config)), f, indent=4)
+            print(f"Scan choice saved to {args.scan_choice_output}")
+    return 0
+
+def run_qc(config: dict, args: argparse.Namespace) -> int:
+    """
+    Renders QC montages of the preprocessed outputs and flags the outliers.
+    """
+    from utils.case_summary import case_summary_folder
+    from utils.qc_montage import generate_qc
+    source = config["packed_store_folder"] if config.get("output_backend", "nifti") == "packed" else config["output_folder"]
+    generate_qc(
+        source, args.qc_folder, case_summary_folder(config), cases_per_page=args.cases_per_page, columns=args.columns,
+        num_workers=args.workers, threshold=args.threshold, verbose=args.verbose
+    )
+    return 0
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Runs one stage of the CT preprocessing pipeline.")
+    parser.add_argument("--config", default=None, help="JSON or Python file overriding the defaults of config.py")
+    parser.add_argument("--quiet", dest="verbose", action="store_false")
+    subparsers = parser.add_subparsers(dest="stage", required=True)
+
+    def add_case_arguments(subparser: argparse.ArgumentParser) -> None:
+        subparser.add_argument("--case", action="append", default=None, help="Case to run on, repeatable (default: all cases)")
+        subparser.add_argument("--case-index", type=int, default=None, help="Run on the case at this index of the sorted archives, e.g. the task id of an array job")
+
+    ingest = subparsers.add_parser("ingest", help="Unzip the cases and convert their DICOM series to NIfTI")
+    add_case_arguments(ingest)
+    ingest.set_defaults(run=run_ingest)
+
+    segment = subparsers.add_parser("segment", help="Segment the ingested cases")
+    add_case_arguments(segment)
+    segment.set_defaults(run=run_segment)
+
+    preprocess = subparsers.add_parser("preprocess", help="Preprocess the ingested cases")
+    add_case_arguments(preprocess)
+    preprocess.set_defaults(run=run_preprocess)
+
+    anomalies = subparsers.add_parser("anomalies", help="Inject synthetic anomalies into preprocessed scans")
+    anomalies.add_argument("--input-folder", default=None, help="Preprocessed scans (default: the output folder)")
+    anomalies.add_argument("--output-folder", default=None)
+    anomalies.add_argument("--num-scans", type=int, default=2)
+    anomalies.add_argument("--sizes", type=int, nargs="+", default=[5, 10, 15])
+    anomalies.add_argument("--shapes", nargs="+", default=["cube"])
+    anomalies.add_argument("--intensity", type=float, default=1)
+    anomalies.add_argument("--seed", type=int, default=None)
+    anomalies.add_argument("--workers", type=int, default=1)
+    anomalies.add_argument("--save-masks", action="store_true")
+    anomalies.set_defaults(run=run_anomalies)
+
+    catalog = subparsers.add_parser("catalog", help="Catalog the DICOM series of the zipped cases")
+    catalog.add_argument("--workers", type=int, default=None)
+    catalog.add_argument("--scan-choice-output", default=None, help="Write the selected scans as a scan_choice.json")
+    catalog.set_defaults(run=run_catalog)
+
+    qc = subparsers.add_parser("qc", help="Render QC montages of the preprocessed outputs and flag outliers")
+    qc.add_argument("--qc-folder", default="qc")
+    qc.add_argument("--cases-per-page", type=int, default=24)
+    qc.add_argument("--columns", type=int, default=4)
+    qc.add_argument("--workers", type=int, default=1)
+    qc.add_argument("--threshold", type=float, default=3.5, help="Modified z-score above which a statistic is an outlier")
+    qc.set_defaults(run=run_qc)
+    return parser
+
+def main(argv: List[str] = None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.run(load_config(args.config), args)
+
+if __name__ == "__main__":
+    sys.exit(main())
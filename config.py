@@ -1,10 +1,24 @@
+import os
+import copy
 import json
+import runpy
+from typing import Optional
 
 config = {
     
+    # Scan choices of the cases (see the README), read when the config is loaded
+    "scan_choice_path": "/workspace/project-data/CT_preprocessing_2025/scan_choice.json",
+    
     # Target shape for downsampling the CT scan
     "target_shape": (128, 128, 128),
     
+    # Shapes of a multi-resolution output pyramid produced in one pass, each written to
+    # its own {case}_NORMAL_{shape}.nii.gz (None writes target_shape only)
+    "pyramid_shapes": None,
+    
+    # Downsampling mode: "trilinear", "antialiased" (Gaussian prefilter) or "area" (averaging)
+    "downsample_mode": "trilinear",
+    
     # Hounsfield Units (HU) range for normalization
     "min_hu": -1000,
     "max_hu": 1000,
@@ -12,12 +26,133 @@ config = {
     # Output folder for saving preprocessed scans
     "output_folder": "/workspace/project-data/PREPROCESSED_CT_SCANS",
     
+    # Folder of the per-case summaries (crop box, HU statistics) read by the QC montage,
+    # None keeps them in case_summaries inside the output folder
+    "case_summary_folder": None,
+    
+    # Streaming HU statistics of the voxels inside the body of every cropped scan: mean,
+    # variance, extremes and a histogram over hu_histogram_range in hu_histogram_bins bins
+    # (1 HU each by default) for quantiles. Stored per case in its summary and merged into
+    # the dataset statistics at hu_statistics_path (None writes hu_statistics.json into
+    # the output folder)
+    "hu_statistics": True,
+    "hu_histogram_range": (-1024, 3072),
+    "hu_histogram_bins": 4096,
+    "hu_statistics_path": None,
+    
+    # Output backend: "nifti" writes one .nii.gz per case, "packed" appends every case to
+    # a sharded memory-mappable store (export cases with python -m utils.packed_store)
+    "output_backend": "nifti",
+    "packed_store_folder": "/workspace/project-data/PREPROCESSED_CT_STORE",
+    # Storage dtype of the packed store: float32, float16, or uint8/int16 with a scale factor.
+    # A store keeps the dtype it was created with, so a new dtype needs a new store folder
+    "packed_store_dtype": "float16",
+    "packed_store_shard_capacity": 256,
+    
     # Folder containing zipped data
     "data_zipped_folder": "/workspace/project-data/data-zipped",
     
     # Folder for unzipped data
     "data_folder": "/workspace/project-data/data_unzipped",
     
+    # Segmentation backend ("totalsegmentator", or "threshold" for a local stand-in model)
+    "segmentation_backend": "totalsegmentator",
+    
+    # Segment all cases in one persistent worker process before preprocessing them
+    "segmentation_service": False,
+    
+    # Shared content-addressed cache of segmentation masks (None disables it) and its size limit
+    "segmentation_cache_folder": None,
+    "segmentation_cache_max_gb": 50,
+    
+    # Read only the ROI sub-volume of the high res CT scan instead of the full volume
+    "crop_first": True,
+    
+    # Resampling of the body mask onto the high res grid: "linear" keeps voxels whose
+    # interpolated value exceeds the threshold, "nearest" copies the nearest label
+    "mask_resample_mode": "linear",
+    "mask_resample_threshold": 0.0,
+    
+    # Bit-pack the compact label masks held in memory (8x smaller, slower to expand)
+    "pack_masks": False,
+    
+    # Select the segment and scan series of every case from the DICOM catalog; entries of
+    # scan_choice.json take precedence (rules default to DEFAULT_SELECTION_RULES)
+    "auto_scan_choice": False,
+    "dicom_catalog_path": "/workspace/project-data/dicom_catalog.sqlite",
+    "scan_selection_rules": None,
+    
+    # Read the DICOM series of each case straight from its ZIP file into memory while it is
+    # preprocessed, instead of converting all cases to intermediate NIfTI files first
+    # (the segmentation service is not used in this mode)
+    "direct_dicom": False,
+    # Keep the intermediate CT_scan and CT_scan_segmentation files in direct mode, and
+    # their extension (".nii" skips the gzip compression)
+    "persist_intermediate_nifti": True,
+    "intermediate_nifti_extension": ".nii.gz",
+    
+    # Number of ZIP archives ingested in parallel
+    "ingest_workers": 1,
+    
+    # Stream DICOM files from the ZIP archives into the converter instead of extracting them
+    "ingest_in_memory": True,
+    
+    # SQLite manifest of the pipeline stages run per case (None disables incremental reruns)
+    "manifest_path": "/workspace/project-data/pipeline_manifest.sqlite",
+    
+    # Per-stage timing and memory report (.jsonl or .csv, None disables it). CPU time is
+    # per thread; peak RSS is per process and left empty in pipelined mode
+    "profile_report": "profile_report.jsonl",
+    
+    # Case to run under cProfile and tracemalloc, and the folder for its reports
+    "profile_deep_case": None,
+    "profile_deep_folder": "profiles",
+    
+    # Overlap loading, computing and writing of consecutive cases when running serially,
+    # with the number of prefetched cases and pending writes bounding memory
+    "pipelined": False,
+    "prefetch_cases": 1,
+    "max_pending_writes": 2,
+    "writer_threads": 2,
+    
+    # Memory-aware admission: with a RAM budget, cases run in their own processes and are
+    # admitted largest first while their estimated peak memory fits the budget. The
+    # estimate comes from the NIfTI headers (see utils.scheduler.DEFAULT_MEMORY_MODEL,
+    # overridable with "memory_model"), or the default for cases without headers yet
+    "memory_budget_gb": None,
+    "default_case_memory_gb": 4,
+    # Wall-clock limit per case (None disables it), and retries after a crashed worker
+    "case_timeout_s": 3600,
+    "case_retries": 1,
+    "retry_timeouts": False,
+    
+    # Watch-folder daemon (python main.py --watch): archives are processed once their size
+    # and mtime have been unchanged for watch_stable_seconds; inotify_simple is used when
+    # installed, polling otherwise. Queue depth and latencies go to the status file
+    "watch_stable_seconds": 10,
+    "watch_poll_interval": 2,
+    "watch_status_path": "watch_status.json",
+    
+    # Distributed mode for nodes sharing the data folders: "i/N" processes only shard i of
+    # N, and a claims folder lets nodes claim cases dynamically, with claims refreshed by
+    # a heartbeat and taken over once their lease expires. Each node writes its own error
+    # and profile reports (named after node_id, hostname-pid by default), appended to the shared
+    # reports and removed when the node finishes
+    "shard": None,
+    "claims_folder": None,
+    "node_id": None,
+    "claim_lease_s": 300,
+    "claim_heartbeat_s": 30,
+    
+    # Error log CSV, appended to as cases finish
+    "error_log": "error_log.csv",
+    
+    # Number of worker processes used to preprocess cases (1 runs serially)
+    "num_workers": 1,
+    
+    # Number of torch threads per worker process
+    "torch_threads": 1,
+    
     # Bounds for ROI cropping
     "roi_bounds": {
         "left": {"label": "skull", "task": "total", "type": "min", "padding": 15},
@@ -31,6 +166,25 @@ config = {
     }
 }
 
-# Load scan choices from a separate JSON file
-with open('/workspace/project-data/CT_preprocessing_2025/scan_choice.json', 'r') as f:
-    config["scan_choice"] = json.load(f)
+def load_config(path: Optional[str] = None) -> dict:
+    """
+    Returns the pipeline config: a copy of the defaults above, updated with the entries of
+    a JSON file or of the config dict of a Python file if a path is given, and with the
+    scan choices read from scan_choice_path. Importing this module reads no files.
+    """
+    loaded = copy.deepcopy(config)
+    if path is not None:
+        if path.endswith(".py"):
+            loaded.update(runpy.run_path(path)["config"])
+        else:
+            with open(path, 'r') as f:
+                loaded.update(json.load(f))
+    if "scan_choice" not in loaded:
+        scan_choice_path = loaded.get("scan_choice_path")
+        if scan_choice_path and os.path.exists(scan_choice_path):
+            with open(scan_choice_path, 'r') as f:
+                loaded["scan_choice"] = json.load(f)
+        else:
+            # Cases without a scan choice are reported by the ingest stage
+            loaded["scan_choice"] = {}
+    return loaded
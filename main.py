@@ -1,6 +1,8 @@
 import os
 import time
+import shutil
 import gc  # Import garbage collection module
+import argparse
 import pandas as pd  # Import pandas for DataFrame
 from preprocessing import (
     downsampling, 
@@ -9,144 +11,810 @@ from preprocessing import (
     ROI_cropping,
     process_zipped_data
 )
-from utils import file_utils
-from utils.common import verbose_print, transform_coordinates
-from config import config
-from typing import Tuple
+from utils import file_utils, bounding_box_index
+from utils.segmentation_cache import create_segmentation_cache
+from utils.manifest import PipelineManifest, files_fingerprint, stage_config_hash
+from utils.profiling import CaseProfiler, write_profile_report
+from utils.packed_store import PackedVolumeStore
+from utils.dicom_catalog import DicomCatalog, build_scan_choice, scan_choice_overrides
+from utils.scheduler import AdmissionScheduler, estimate_case_memory
+from utils.folder_watcher import FolderWatcher, WatchStatus
+from utils.work_claims import WorkClaims, default_node_id, in_shard, merge_node_file, node_file, node_order, parse_shard
+from utils.compact_mask import CompactMask
+from utils.mask_resampling import load_resampled_mask
+from utils.case_summary import case_summary_folder, crop_summary, write_case_summary
+from utils.hu_statistics import dataset_statistics_path, statistics_from_config, write_dataset_statistics
+from utils.common import verbose_print
+from config import load_config
+from typing import Callable, Dict, Tuple, List, Optional
 import numpy as np
 import nibabel as nib
 from preprocessing.segmentation import run_segmentation  # Import the segmentation function
+from preprocessing.segmentation_backends import create_backend
+from preprocessing.segmentation_service import SegmentationService
 import torch
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from contextlib import ExitStack
+from functools import partial
+from itertools import repeat
 
-# Initialize a DataFrame to store errors
-error_log = []
+def open_packed_store(config: dict) -> PackedVolumeStore:
+    """
+    Opens the packed output store, creating it for the configured target shape and dtype.
+    """
+    return PackedVolumeStore(
+        config["packed_store_folder"],
+        volume_shape=tuple(config["target_shape"]),
+        dtype=config.get("packed_store_dtype", "float32"),
+        shard_capacity=config.get("packed_store_shard_capacity", 256)
+    )
 
-def preprocess_ct_scan(case_path: str, ct_scan_path: str, segmentation_ct_path: str, config: dict, verbose: bool = False) -> None:
+def output_exists(config: dict, case_name: str, output_file: str) -> bool:
     """
-    Preprocesses a CT scan by loading NIfTI files, applying various preprocessing steps,
-    and saving the preprocessed scan to an output file.
+    Checks if the preprocessed scan of a case was written by the configured output backend.
     """
-    global error_log
-    try:
-        case_name = os.path.basename(case_path)
-        output_file = os.path.join(config["output_folder"], f"{case_name}_NORMAL.nii.gz")
-        
-        if os.path.exists(output_file):
-            verbose_print(f"Preprocessed scan already exists for {case_path}.", verbose)
-            return
-        
-        segmentation_path = os.path.join(case_path, "segmentation")
-        if not run_segmentation(segmentation_ct_path, segmentation_path, config["roi_bounds"], verbose=verbose):
-            error_log.append([case_name, "Segmentation failed or missing files"])
-            return
+    if config.get("output_backend", "nifti") == "packed":
+        with open_packed_store(config) as store:
+            return store.contains(case_name)
+    return os.path.exists(output_file)
 
-        try:
-            # Load NIfTI files dynamically based on the labels in the config
-            nifti_files = file_utils.load_nifti_files_dynamic(ct_scan_path, segmentation_path, config["roi_bounds"], verbose=verbose)
-            ct_scan = nifti_files.pop("ct_scan")
-            ct_data = ct_scan.get_fdata()
-            mask_data = {label: nifti_files[label].get_fdata() for label in nifti_files}
-        except Exception as e:
-            error_log.append([case_name, str(e)])
-            return
-        
-        # Convert to PyTorch tensor and move to appropriate device
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        ct_tensor = torch.tensor(ct_data, dtype=torch.float32).to(device)
-        mask_tensors = {label: torch.tensor(mask_data[label], dtype=torch.float32).to(device) for label in mask_data}
-
-        # Setting values outside the body to -1000 HU
-        body_mask = nifti_files.get("body")
-        if body_mask and (body_mask.affine != ct_scan.affine).any():
-            body_data_transformed = nib.processing.resample_from_to(body_mask, ct_scan, order=1).get_fdata()
-        else:
-            body_data_transformed = mask_data.get("body")
-        if body_data_transformed is not None:
-            body_tensor = torch.tensor(body_data_transformed, dtype=torch.float32).to(device)
-            body_data_with_padding = removing_excess.expand_mask(body_tensor, config["roi_bounds"]["outside"]["padding"], verbose=verbose)
-            ct_tensor = removing_excess.set_values_outside_body(ct_tensor, body_data_with_padding, verbose=verbose)
+def write_output(config: dict, case_name: str, scan_array: np.ndarray, affine: np.ndarray, output_file: str, verbose: bool = False) -> None:
+    """
+    Writes the preprocessed scan of a case with the configured output backend.
+    """
+    if config.get("output_backend", "nifti") == "packed":
+        with open_packed_store(config) as store:
+            shard, offset = store.append(case_name, scan_array, affine)
+        verbose_print(f"Preprocessed scan stored in shard {shard} at offset {offset}.", verbose)
+    else:
+        file_utils.save_nifti(scan_array, affine, output_file, verbose=verbose)
 
-        # Compute bounding boxes for masks
-        bounding_boxes = ROI_cropping.compute_bounding_boxes(mask_tensors, config["roi_bounds"], verbose=verbose)
-
-        # Define cropping limits using the bounding boxes and config bounds
-        z_min, z_max = bounding_boxes["down"], bounding_boxes["up"]
-        y_min, y_max = bounding_boxes["back"], bounding_boxes["front"]
-        x_min, x_max = bounding_boxes["left"], bounding_boxes["right"]
-
-        # Transform coordinates from segmentation scan to high res scan        
-        coords = [
-            [0, 0, z_min-config["roi_bounds"]["down"]["padding"]],
-            [0, 0, z_max+config["roi_bounds"]["up"]["padding"]],
-            [0, y_min-config["roi_bounds"]["back"]["padding"], 0],
-            [0, y_max+config["roi_bounds"]["front"]["padding"], 0],
-            [x_min-config["roi_bounds"]["left"]["padding"], 0, 0],
-            [x_max+config["roi_bounds"]["right"]["padding"], 0, 0]
-        ]
-        z_min_transformed, z_max_transformed, y_min_transformed, y_max_transformed, x_min_transformed, x_max_transformed = transform_coordinates(
-            coords, 
-            torch.tensor(body_mask.affine if body_mask else ct_scan.affine, dtype=torch.float32), 
-            torch.tensor(ct_scan.affine, dtype=torch.float32), 
+def output_targets(config: dict, case_name: str) -> List[Tuple[dict, str]]:
+    """
+    Returns the config and output file of every output level of a case. Without pyramid
+    shapes this is the target shape alone; each pyramid level gets its own file and its
+    own packed store subfolder, since a packed store holds a single shape.
+    """
+    if not config.get("pyramid_shapes"):
+        return [(config, os.path.join(config["output_folder"], f"{case_name}_NORMAL.nii.gz"))]
+    targets = []
+    for shape in config["pyramid_shapes"]:
+        level_name = "x".join(str(size) for size in shape)
+        level_config = dict(
+            config,
+            target_shape=tuple(shape),
+            packed_store_folder=os.path.join(config.get("packed_store_folder", config["output_folder"]), level_name)
+        )
+        targets.append((level_config, os.path.join(config["output_folder"], f"{case_name}_NORMAL_{level_name}.nii.gz")))
+    return targets
+
+def load_case_data(ct_scan_path: str, segmentation_path: str, config: dict, profiler: CaseProfiler, verbose: bool = False) -> dict:
+    """
+    Loads the cropped CT scan and the body mask around the crop box of a case, with
+    the crop box derived from the segmentation masks.
+    """
+    with profiler.stage("bounding_boxes"):
+        # Bounding boxes and mask affines are reused from the sidecar index when the masks
+        # are unchanged, so only the CT scan is opened here
+        labels = list(dict.fromkeys(bound["label"] for bound in config["roi_bounds"].values()))
+        label_boxes = bounding_box_index.load_bounding_boxes(segmentation_path, labels, verbose=verbose)
+        ct_scan = file_utils.as_image(ct_scan_path)
+        body_affine = np.array(label_boxes["body"]["affine"]) if "body" in labels else None
+
+        # Select the bounding boxes for the ROI bounds and transform them to the high res scan
+        bounding_boxes = ROI_cropping.select_roi_bounds(label_boxes, config["roi_bounds"])
+        crop_box = ROI_cropping.compute_crop_box(
+            bounding_boxes,
+            config["roi_bounds"],
+            body_affine if body_affine is not None else ct_scan.affine,
+            ct_scan.affine,
+            ct_scan.shape,
             verbose=verbose
         )
-        
-        # Crop CT scan using ROI bounds
-        ct_tensor = ROI_cropping.crop_ct_scan(ct_tensor, x_min_transformed, x_max_transformed, y_min_transformed, y_max_transformed, z_min_transformed, z_max_transformed, verbose=verbose)
+    x_min, x_max, y_min, y_max, z_min, z_max = crop_box
+
+    with profiler.stage("load_ct"):
+        # Crop CT scan using ROI bounds, reading only the crop box in crop-first mode
+        if config.get("crop_first", False):
+            ct_data = ROI_cropping.load_ct_region(ct_scan, crop_box, verbose=verbose)
+        else:
+            full_ct_data = ct_scan.get_fdata()
+            profiler.note(full_ct_data)
+            ct_data = np.asarray(full_ct_data[x_min:x_max, y_min:y_max, z_min:z_max], dtype=np.float32)
+            del full_ct_data
+        profiler.note(ct_data)
+
+    # The body mask is only needed inside the crop box plus the padding margin that can
+    # still reach into it
+    outside_padding = config["roi_bounds"]["outside"]["padding"]
+    body_region = ROI_cropping.grow_box(crop_box, outside_padding, ct_scan.shape)
+    body_path = os.path.join(segmentation_path, "body.nii.gz")
+    with profiler.stage("load_body_mask"):
+        # The mask is kept as a compact crop of its bounding box. When it lives on another
+        # grid it is resampled onto the body region only, and cached for later reruns
+        if body_affine is not None and (body_affine != ct_scan.affine).any():
+            body_data = load_resampled_mask(
+                body_path,
+                label_boxes["body"]["sha256"],
+                ct_scan.affine,
+                body_region,
+                mode=config.get("mask_resample_mode", "linear"),
+                threshold=config.get("mask_resample_threshold", 0.0),
+                pack=config.get("pack_masks", False),
+                verbose=verbose
+            )
+        elif body_affine is not None:
+            body_mask = nib.load(body_path, mmap=True)
+            body_data = np.asarray(body_mask.dataobj[body_region[0]:body_region[1], body_region[2]:body_region[3], body_region[4]:body_region[5]], dtype=np.uint8)
+            profiler.note(body_data)
+            body_data = CompactMask.from_array(body_data, pack=config.get("pack_masks", False))
+        else:
+            body_data = None
+
+    box_in_body_region = (
+        x_min - body_region[0], x_max - body_region[0],
+        y_min - body_region[2], y_max - body_region[2],
+        z_min - body_region[4], z_max - body_region[4]
+    )
+    return {
+        "ct_affine": ct_scan.affine.copy(),
+        "crop_box": crop_box,
+        "ct_data": ct_data,
+        "body_data": body_data,
+        "box_in_body_region": box_in_body_region,
+    }
+
+def compute_case(case_data: dict, config: dict, profiler: CaseProfiler, verbose: bool = False, summary: Optional[dict] = None) -> List[Tuple[torch.Tensor, np.ndarray]]:
+    """
+    Masks, downsamples and normalizes the cropped CT scan of a case. Returns the
+    preprocessed tensor and its affine for every output level, in the order of
+    output_targets. The HU statistics of the masked scan are added to the summary.
+    """
+    # Convert to PyTorch tensor and move to appropriate device
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    ct_tensor = torch.from_numpy(case_data["ct_data"]).to(device)
+
+    # Setting values outside the body to -1000 HU
+    if case_data["body_data"] is not None:
+        with profiler.stage("expand_mask"):
+            body_data_with_padding = removing_excess.expand_mask(
+                case_data["body_data"], config["roi_bounds"]["outside"]["padding"], box=case_data["box_in_body_region"], device=device, verbose=verbose
+            )
+            profiler.note(case_data["body_data"], body_data_with_padding)
+        with profiler.stage("set_values_outside_body"):
+            ct_tensor = removing_excess.set_values_outside_body(ct_tensor, body_data_with_padding, verbose=verbose)
+
+    # Statistics of the voxels inside the body, gathered while the scan is in memory anyway
+    if config.get("hu_statistics", True) and summary is not None:
+        with profiler.stage("hu_statistics"):
+            hu_statistics = statistics_from_config(config)
+            hu_statistics.update(ct_tensor, mask=body_data_with_padding if case_data["body_data"] is not None else None)
+            summary["hu_statistics"] = hu_statistics.to_dict()
+
+    # Downsample every output level in one pass and normalize the CT scan
+    target_shapes = config.get("pyramid_shapes") or [config["target_shape"]]
+    with profiler.stage("downsample"):
+        level_tensors = downsampling.downsample_pyramid(ct_tensor, target_shapes, mode=config.get("downsample_mode", "trilinear"), verbose=verbose)
+    levels = []
+    for ct_tensor in level_tensors:
+        with profiler.stage("normalize"):
+            ct_tensor = normalization.normalize_hu(ct_tensor, config["min_hu"], config["max_hu"], verbose=verbose)
 
-        # Downsample and normalize the CT scan        
-        ct_tensor = downsampling.downsample_ct(ct_tensor, config["target_shape"], verbose=verbose)
-        ct_tensor = normalization.normalize_hu(ct_tensor, config["min_hu"], config["max_hu"], verbose=verbose)
-        
         # Center the image and resample to 1mm voxels
         center = torch.tensor(ct_tensor.shape, dtype=torch.float32) / 2.0
-        final_affine = ct_scan.affine
+        final_affine = case_data["ct_affine"].copy()
         final_affine[:3, :3] = torch.eye(3)
         final_affine[:3, 3] = -center
-        print(ct_tensor.shape)
-        file_utils.save_nifti(ct_tensor.cpu().numpy(), final_affine, output_file, verbose=verbose)
+        levels.append((ct_tensor, final_affine))
+    return levels
+
+def record_failure(state: dict, error: Exception) -> None:
+    """
+    Records an unexpected error of a case.
+    """
+    state["errors"].append([state["case_name"], str(error)])
+    state["result"]["Status"] = "failed"
+    print(f"An error occurred while preprocessing {state['case_path']}: {error}")
+
+def load_case(case_path: str, ct_scan_path: str, segmentation_ct_path: str, config: dict, verbose: bool = False, source_paths: Optional[List[str]] = None, decode_inputs: Optional[Callable[[], tuple]] = None, shared_process: bool = False) -> dict:
+    """
+    Runs the stages of a case up to loading its data: the already-done check, the
+    segmentation and the loading of the cropped CT scan and body mask.
+    The CT scans are file paths or in-memory images. With decode_inputs, they are only
+    produced by calling it once the case is known to need work, and source_paths
+    (by default the CT scans) are the files the case is fingerprinted by.
+    shared_process tells the profiler that other cases run in threads of this process.
+    Returns the state of the case; its "case_data" is None when the case is already
+    finished (skipped or failed) and only needs finish_case.
+    """
+    source_paths = source_paths or [ct_scan_path, segmentation_ct_path]
+    case_name = os.path.basename(case_path)
+    profiler = CaseProfiler(case_name, deep=case_name == config.get("profile_deep_case"), deep_output_folder=config.get("profile_deep_folder"), shared_process=shared_process)
+    state = {
+        "case_name": case_name,
+        "case_path": case_path,
+        "errors": [],
+        "manifest": PipelineManifest(config["manifest_path"]) if config.get("manifest_path") else None,
+        "profiler": profiler,
+        "result": {"Case": case_name, "Status": "failed", "Output": None, "Profile": profiler.records},
+        "output_targets": output_targets(config, case_name),
+        "case_data": None,
+    }
+    manifest, errors = state["manifest"], state["errors"]
+    output_files = [output_file for _, output_file in state["output_targets"]]
+    profiler.start_deep()
+    try:
+        if manifest is None:
+            if outputs_exist(state):
+                verbose_print(f"Preprocessed scan already exists for {case_path}.", verbose)
+                state["result"].update(Status="skipped", Output=output_files)
+                return state
+        else:
+            # Upstream stages are checked first, so a stale segmentation also makes the output stale
+            segmentation_fingerprint = files_fingerprint(source_paths[-1:])
+            segmentation_config_hash = stage_config_hash(config, "segmentation")
+            segmentation_stale = manifest.record(case_name, "segmentation") is not None and not manifest.is_fresh(case_name, "segmentation", segmentation_fingerprint, segmentation_config_hash)
+            state["output_fingerprint"] = files_fingerprint(source_paths)
+            state["output_config_hash"] = stage_config_hash(config, "final_output")
+            existing_output = outputs_exist(state)
+            if existing_output and manifest.record(case_name, "final_output") is None:
+                # Output written before the manifest existed
+                manifest.mark(case_name, "final_output", "done", state["output_fingerprint"], state["output_config_hash"])
+            if existing_output and not segmentation_stale and manifest.is_fresh(case_name, "final_output", state["output_fingerprint"], state["output_config_hash"]):
+                verbose_print(f"Preprocessed scan already exists for {case_path}.", verbose)
+                state["result"].update(Status="skipped", Output=output_files)
+                return state
+        
+        if decode_inputs is not None:
+            with profiler.stage("decode_dicom"):
+                ct_scan_path, segmentation_ct_path = decode_inputs()
+
+        segmentation_path = os.path.join(case_path, "segmentation")
+        if manifest is not None:
+            if segmentation_stale:
+                verbose_print(f"Removing stale segmentation of {case_name}...", verbose)
+                shutil.rmtree(segmentation_path, ignore_errors=True)
+            manifest.mark(case_name, "segmentation", "running", segmentation_fingerprint, segmentation_config_hash)
+        with profiler.stage("segmentation"):
+            backend = create_backend(config.get("segmentation_backend", "totalsegmentator"), verbose=verbose)
+            cache = create_segmentation_cache(config, verbose=verbose)
+            segmented = run_segmentation(segmentation_ct_path, segmentation_path, config["roi_bounds"], verbose=verbose, backend=backend, cache=cache)
+        if not segmented:
+            errors.append([case_name, "Segmentation failed or missing files"])
+            if manifest is not None:
+                manifest.mark(case_name, "segmentation", "failed", segmentation_fingerprint, segmentation_config_hash)
+            return state
+        if manifest is not None:
+            manifest.mark(case_name, "segmentation", "done", segmentation_fingerprint, segmentation_config_hash)
+
+        try:
+            case_data = load_case_data(ct_scan_path, segmentation_path, config, profiler, verbose=verbose)
+        except Exception as e:
+            errors.append([case_name, str(e)])
+            return state
+        if manifest is not None:
+            manifest.mark(case_name, "final_output", "running", state["output_fingerprint"], state["output_config_hash"])
+        state["case_data"] = case_data
+        state["summary"] = crop_summary(case_data["crop_box"], case_data["ct_affine"])
+    except Exception as e:
+        record_failure(state, e)
+    return state
+
+def outputs_exist(state: dict) -> bool:
+    """
+    Checks if every output level of a case has been written.
+    """
+    return all(output_exists(level_config, state["case_name"], output_file) for level_config, output_file in state["output_targets"])
+
+def write_case(state: dict, levels: List[Tuple[np.ndarray, np.ndarray]], config: dict, verbose: bool = False) -> None:
+    """
+    Writes the preprocessed scan of every output level of a case and records its final
+    output stage.
+    """
+    case_name, manifest = state["case_name"], state["manifest"]
+    try:
+        with state["profiler"].stage("save"):
+            for (level_config, output_file), (scan_array, final_affine) in zip(state["output_targets"], levels):
+                write_output(level_config, case_name, scan_array, final_affine, output_file, verbose=verbose)
+
+        if "summary" in state:
+            write_case_summary(case_summary_folder(config), case_name, state["summary"])
+        if manifest is not None and outputs_exist(state):
+            manifest.mark(case_name, "final_output", "done", state["output_fingerprint"], state["output_config_hash"])
 
         verbose_print(f"Preprocessing complete for: {case_name}", verbose)
+        state["result"].update(Status="done", Output=[output_file for _, output_file in state["output_targets"]])
     except Exception as e:
-        error_log = error_log.append([case_name, str(e)])
-        print(f"An error occurred while preprocessing {case_path}: {e}")
-        return
+        record_failure(state, e)
+
+def finish_case(state: dict) -> Tuple[dict, List[list]]:
+    """
+    Releases the resources of a case and returns its result record and error records.
+    """
+    state["profiler"].stop_deep()
+    if state["manifest"] is not None:
+        state["manifest"].close()
+    return state["result"], state["errors"]
+
+def preprocess_ct_scan(case_path: str, ct_scan_path: str, segmentation_ct_path: str, config: dict, verbose: bool = False, may_write: Optional[Callable[[], bool]] = None, **load_options) -> Tuple[dict, List[list]]:
+    """
+    Preprocesses a CT scan by loading NIfTI files, applying various preprocessing steps,
+    and saving the preprocessed scan to an output file.
+    Returns the result record of the case, including its stage profile, and the error
+    records collected for it. The load options are passed on to load_case. If may_write
+    returns False once the scan is computed, e.g. because the claim of the case was lost,
+    nothing is written and the case is reported as "claim_lost".
+    """
+    state = load_case(case_path, ct_scan_path, segmentation_ct_path, config, verbose=verbose, **load_options)
+    if state["case_data"] is not None:
+        try:
+            levels = compute_case(state.pop("case_data"), config, state["profiler"], verbose=verbose, summary=state.get("summary"))
+            if may_write is not None and not may_write():
+                state["errors"].append([state["case_name"], "Claim lost to another node, output not written", "claim_lost"])
+                state["result"]["Status"] = "claim_lost"
+                return finish_case(state)
+            write_case(state, [(ct_tensor.cpu().numpy(), final_affine) for ct_tensor, final_affine in levels], config, verbose=verbose)
+        except Exception as e:
+            record_failure(state, e)
+    return finish_case(state)
 
-def main() -> None:
+def process_case(case_folder: str, config: dict, verbose: bool = False, may_write: Optional[Callable[[], bool]] = None) -> Tuple[dict, List[list]]:
+    """
+    Preprocesses a single case folder inside the data folder.
+    """
+    case_path, ct_scan_path, segmentation_ct_path = case_paths(case_folder, config)
+    return preprocess_ct_scan(case_path, ct_scan_path, segmentation_ct_path, config, verbose=verbose, may_write=may_write, **case_load_options(case_folder, config, verbose))
+
+def case_paths(case_folder: str, config: dict) -> Tuple[str, str, str]:
+    """
+    Returns the case path, CT scan path and segmentation CT path of a case folder.
+    """
+    case_path = os.path.join(config["data_folder"], case_folder)
+    segmentation_ct_path, ct_scan_path = process_zipped_data.intermediate_nifti_paths(case_path, config.get("intermediate_nifti_extension", ".nii.gz"))
+    return case_path, ct_scan_path, segmentation_ct_path
+
+def decode_case_inputs(zip_path: str, case_folder: str, config: dict, verbose: bool = False) -> Tuple[nib.Nifti1Image, nib.Nifti1Image]:
+    """
+    Assembles the CT scan and segmentation CT of a case straight from its ZIP file,
+    writing them as intermediate NIfTI files only if they are to be persisted.
+    """
+    segmentation_ct, ct_scan = process_zipped_data.read_case_volumes(zip_path, config["scan_choice"], verbose=verbose)
+    if segmentation_ct is None or ct_scan is None:
+        raise ValueError(f"Chosen DICOM series not found in {zip_path}")
+    if config.get("persist_intermediate_nifti", True):
+        case_path, ct_scan_path, segmentation_ct_path = case_paths(case_folder, config)
+        os.makedirs(case_path, exist_ok=True)
+        nib.save(segmentation_ct, segmentation_ct_path)
+        nib.save(ct_scan, ct_scan_path)
+    return ct_scan, segmentation_ct
+
+def case_load_options(case_folder: str, config: dict, verbose: bool = False) -> dict:
+    """
+    Returns the load_case options of a case. In direct DICOM mode the case is read from
+    its ZIP file and fingerprinted by it.
+    """
+    if not config.get("direct_dicom", False):
+        return {}
+    zip_path = os.path.join(config["data_zipped_folder"], f"{case_folder}.zip")
+    return {"source_paths": [zip_path], "decode_inputs": partial(decode_case_inputs, zip_path, case_folder, config, verbose)}
+
+def process_cases_pipelined(case_folders: List[str], config: dict, verbose: bool = False) -> List[Tuple[dict, List[list]]]:
+    """
+    Preprocesses cases with overlapped I/O: a loader thread loads and decodes the next
+    cases while the current one is computed, and finished scans are written by a pool
+    of writer threads. Both queues are bounded so memory stays bounded.
+    """
+    loaded_cases = queue.Queue(maxsize=config.get("prefetch_cases", 1))
+    write_slots = threading.BoundedSemaphore(config.get("max_pending_writes", 2))
+
+    def load_cases() -> None:
+        # A case that fails outside load_case is handed on as its finished result, and the
+        # end marker is always sent so the compute loop never waits for a dead loader
+        try:
+            for case_folder in case_folders:
+                try:
+                    case_path, ct_scan_path, segmentation_ct_path = case_paths(case_folder, config)
+                    loaded_cases.put(load_case(case_path, ct_scan_path, segmentation_ct_path, config, verbose=verbose, shared_process=True, **case_load_options(case_folder, config, verbose)))
+                except Exception as e:
+                    print(f"An error occurred while loading {case_folder}: {e}")
+                    loaded_cases.put(({"Case": case_folder, "Status": "failed", "Output": None, "Profile": []}, [[case_folder, str(e)]]))
+        finally:
+            loaded_cases.put(None)
+
+    def write_and_finish(state: dict, levels: List[Tuple[np.ndarray, np.ndarray]]) -> Tuple[dict, List[list]]:
+        try:
+            write_case(state, levels, config, verbose=verbose)
+            return finish_case(state)
+        finally:
+            write_slots.release()
+
+    loader = threading.Thread(target=load_cases, daemon=True)
+    loader.start()
+    pending = []
+    with ThreadPoolExecutor(max_workers=config.get("writer_threads", 2)) as writers:
+        while True:
+            state = loaded_cases.get()
+            if state is None:
+                break
+            if isinstance(state, tuple):
+                pending.append(state)
+                continue
+            if state["case_data"] is None:
+                pending.append(finish_case(state))
+                continue
+            try:
+                levels = [(ct_tensor.cpu().numpy(), final_affine) for ct_tensor, final_affine in compute_case(state.pop("case_data"), config, state["profiler"], verbose=verbose, summary=state.get("summary"))]
+            except Exception as e:
+                record_failure(state, e)
+                pending.append(finish_case(state))
+                continue
+            # Blocks while the writers are behind, which in turn stops the loader
+            write_slots.acquire()
+            pending.append(writers.submit(write_and_finish, state, levels))
+    loader.join()
+    return [item.result() if isinstance(item, Future) else item for item in pending]
+
+def init_worker(torch_threads: int) -> None:
+    """
+    Limits the number of torch threads used by a worker process.
+    """
+    torch.set_num_threads(torch_threads)
+
+def process_case_in_worker(case_folder: str, config: dict, verbose: bool = False) -> Tuple[dict, List[list]]:
+    """
+    Preprocesses a case in a worker process started by the admission scheduler.
+    """
+    init_worker(config.get("torch_threads", 1))
+    return process_case(case_folder, config, verbose)
+
+def process_cases_scheduled(case_folders: List[str], config: dict, verbose: bool = False, on_case_done: Optional[Callable[[dict, List[list]], None]] = None) -> List[Tuple[dict, List[list]]]:
+    """
+    Preprocesses cases under the memory-aware admission scheduler: the peak memory of
+    every case is estimated from its NIfTI headers, and cases are admitted largest first
+    within config["memory_budget_gb"], each in its own process with a wall-clock timeout.
+    Cases that time out or crash are reported as structured failures.
+    """
+    default_bytes = int(config.get("default_case_memory_gb", 4) * 1024**3)
+    jobs = []
+    for case_folder in case_folders:
+        _, ct_scan_path, segmentation_ct_path = case_paths(case_folder, config)
+        estimate = estimate_case_memory(ct_scan_path, segmentation_ct_path, config.get("memory_model"), default_bytes)
+        jobs.append((case_folder, (case_folder, config, verbose), estimate))
+
+    def case_output(case_folder: str, outcome: dict) -> Tuple[dict, List[list]]:
+        if outcome["status"] == "done":
+            return outcome["result"]
+        result = {"Case": case_folder, "Status": outcome["status"], "Output": None, "Profile": []}
+        return result, [[case_folder, f"{outcome['error']} (after {outcome['attempts']} attempts)", outcome["status"]]]
+
+    def report(case_folder: str, outcome: dict) -> None:
+        if on_case_done is not None:
+            on_case_done(*case_output(case_folder, outcome))
+
+    scheduler = AdmissionScheduler(
+        process_case_in_worker,
+        int(config["memory_budget_gb"] * 1024**3),
+        max_workers=config.get("num_workers", 1),
+        timeout=config.get("case_timeout_s"),
+        retries=config.get("case_retries", 1),
+        retry_timeouts=config.get("retry_timeouts", False),
+        verbose=verbose
+    )
+    outcomes = scheduler.run(jobs, on_outcome=report)
+    return [case_output(case_folder, outcomes[case_folder]) for case_folder in case_folders]
+
+def segment_with_service(service: SegmentationService, case_folders: List[str], config: dict, verbose: bool = False) -> Dict[str, Tuple[dict, List[list]]]:
+    """
+    Segments cases in the segmentation service ahead of preprocessing. Failures are marked
+    in the manifest like failures of the segmentation stage in load_case, and a case whose
+    segmentation already failed for the same segment scan and config is not submitted
+    again. Returns the result and error records of the failed cases by case folder.
+    """
+    failed, cases = {}, []
+    segmentation_config_hash = stage_config_hash(config, "segmentation")
+    with ExitStack() as stack:
+        manifest = stack.enter_context(PipelineManifest(config["manifest_path"])) if config.get("manifest_path") else None
+        fingerprints = {}
+        for case_folder in case_folders:
+            segmentation_ct_path = case_paths(case_folder, config)[2]
+            if manifest is not None and os.path.exists(segmentation_ct_path):
+                fingerprints[case_folder] = files_fingerprint([segmentation_ct_path])
+                record = manifest.record(case_folder, "segmentation")
+                if record == {"input_fingerprint": fingerprints[case_folder], "config_hash": segmentation_config_hash, "status": "failed"}:
+                    failed[case_folder] = [[case_folder, "Segmentation failed in an earlier run for the same scan and config"]]
+                    continue
+            cases.append((case_folder, segmentation_ct_path, os.path.join(config["data_folder"], case_folder, "segmentation")))
+
+        for case_folder, error in service.segment_cases(cases):
+            failed[case_folder] = [[case_folder, error]]
+            if manifest is not None and case_folder in fingerprints:
+                manifest.mark(case_folder, "segmentation", "failed", fingerprints[case_folder], segmentation_config_hash)
+    return {case_folder: ({"Case": case_folder, "Status": "failed", "Output": None, "Profile": []}, errors) for case_folder, errors in failed.items()}
+
+def process_cases(case_folders: List[str], config: dict, verbose: bool = False, on_case_done: Optional[Callable[[dict, List[list]], None]] = None) -> Tuple[List[dict], List[list]]:
+    """
+    Preprocesses the given case folders, serially, in a process pool depending on
+    config["num_workers"], or under the admission scheduler when a memory budget is set.
+    Results and errors are returned in the order of case_folders; on_case_done is called
+    with the result and errors of every case as soon as they are known.
+    """
+    segmentation_failures = {}
+    if config.get("segmentation_service", False) and not config.get("direct_dicom", False):
+        # Segment all cases in one long-lived worker that keeps the models loaded; cases
+        # that fail here are reported as failed and not preprocessed
+        with SegmentationService(
+            config["roi_bounds"],
+            config.get("segmentation_backend", "totalsegmentator"),
+            cache_folder=config.get("segmentation_cache_folder"),
+            cache_max_bytes=int(config.get("segmentation_cache_max_gb", 0) * 1024**3),
+            verbose=verbose
+        ) as service:
+            segmentation_failures = segment_with_service(service, case_folders, config, verbose)
+        for case_output in segmentation_failures.values():
+            if on_case_done is not None:
+                on_case_done(*case_output)
+    all_case_folders = case_folders
+    case_folders = [case_folder for case_folder in case_folders if case_folder not in segmentation_failures]
+
+    num_workers = config.get("num_workers", 1)
+    if config.get("memory_budget_gb"):
+        # The scheduler reports every case as it finishes
+        case_outputs = process_cases_scheduled(case_folders, config, verbose, on_case_done)
+    elif num_workers <= 1 and config.get("pipelined", False):
+        case_outputs = process_cases_pipelined(case_folders, config, verbose)
+        for case_output in case_outputs:
+            if on_case_done is not None:
+                on_case_done(*case_output)
+    elif num_workers <= 1:
+        case_outputs = []
+        for case_folder in case_folders:
+            case_outputs.append(process_case(case_folder, config, verbose))
+            if on_case_done is not None:
+                on_case_done(*case_outputs[-1])
+    else:
+        verbose_print(f"Preprocessing {len(case_folders)} cases with {num_workers} workers...", verbose)
+        # Spawn fresh interpreters so torch/CUDA state is never shared with the parent
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(config.get("torch_threads", 1),)
+        ) as executor:
+            case_outputs = []
+            for case_output in executor.map(process_case, case_folders, repeat(config), repeat(verbose)):
+                case_outputs.append(case_output)
+                if on_case_done is not None:
+                    on_case_done(*case_output)
+
+    outputs_by_case = dict(zip(case_folders, case_outputs), **segmentation_failures)
+    case_outputs = [outputs_by_case[case_folder] for case_folder in all_case_folders]
+    results = [result for result, _ in case_outputs]
+    errors = [error for _, case_errors in case_outputs for error in case_errors]
+    return results, errors
+
+ERROR_LOG_COLUMNS = ["Case", "Error", "Kind"]
+
+def append_error_log(errors: List[list], error_log_path: str) -> None:
+    """
+    Appends error records to the error log CSV right away, so a crash of the run never
+    loses the errors collected before it. Records without a kind are plain case errors.
+    """
+    rows = [list(error) + ["error"] * (len(ERROR_LOG_COLUMNS) - len(error)) for error in errors]
+    pd.DataFrame(rows, columns=ERROR_LOG_COLUMNS).to_csv(error_log_path, mode="a", header=False, index=False)
+
+def ingest_case(zip_path: str, config: dict, catalog: Optional[DicomCatalog] = None, verbose: bool = False) -> str:
+    """
+    Brings a newly arrived archive up to preprocessing: selects its scans from the DICOM
+    catalog if automatic scan choice is on, and converts its series unless they are read
+    directly. Returns the case folder.
+    """
+    if catalog is not None:
+        catalog.update(config["data_zipped_folder"], verbose=verbose)
+        config["scan_choice"] = build_scan_choice(catalog, config.get("scan_selection_rules"), overrides=scan_choice_overrides(config))
+    if not config.get("direct_dicom", False):
+        process_zipped_data.process_zip_file(
+            zip_path,
+            config["data_folder"],
+            config["scan_choice"],
+            in_memory=config["ingest_in_memory"],
+            manifest_path=config.get("manifest_path"),
+            extension=config.get("intermediate_nifti_extension", ".nii.gz"),
+            verbose=verbose
+        )
+    return os.path.splitext(os.path.basename(zip_path))[0]
+
+def watch_folder(config: dict, verbose: bool = True) -> None:
+    """
+    Daemon mode: watches the zipped data folder and pushes every archive through
+    conversion, segmentation and preprocessing as soon as it has stopped growing.
+    The catalog and the segmentation service stay open between cases, and the queue
+    depth and latencies are written to the status file.
+    """
+    error_log_path = config.get("error_log", "error_log.csv")
+    if not os.path.exists(error_log_path):
+        pd.DataFrame(columns=ERROR_LOG_COLUMNS).to_csv(error_log_path, index=False)
+    status = WatchStatus(config.get("watch_status_path", "watch_status.json"))
+    queued = []
+    print(f"Watching {config['data_zipped_folder']} for new cases...")
+    with ExitStack() as stack:
+        watcher = stack.enter_context(FolderWatcher(
+            config["data_zipped_folder"],
+            stable_seconds=config.get("watch_stable_seconds", 10),
+            poll_interval=config.get("watch_poll_interval", 2),
+            verbose=verbose
+        ))
+        catalog = stack.enter_context(DicomCatalog(config["dicom_catalog_path"])) if config.get("auto_scan_choice", False) else None
+        service = None
+        if config.get("segmentation_service", False) and not config.get("direct_dicom", False):
+            service = stack.enter_context(SegmentationService(
+                config["roi_bounds"],
+                config.get("segmentation_backend", "totalsegmentator"),
+                cache_folder=config.get("segmentation_cache_folder"),
+                cache_max_bytes=int(config.get("segmentation_cache_max_gb", 0) * 1024**3),
+                verbose=verbose
+            ))
+
+        while True:
+            queued.extend(watcher.ready())
+            status.update(growing=watcher.growing, queued=len(queued))
+            if not queued:
+                watcher.wait()
+                continue
+
+            arrival = queued.pop(0)
+            case_folder = os.path.splitext(os.path.basename(arrival["path"]))[0]
+            status.update(queued=len(queued), processing=case_folder)
+            try:
+                ingest_case(arrival["path"], config, catalog, verbose=verbose)
+                segmentation_failures = segment_with_service(service, [case_folder], config, verbose) if service is not None else {}
+                if case_folder in segmentation_failures:
+                    result, errors = segmentation_failures[case_folder]
+                else:
+                    result, errors = process_case(case_folder, config, verbose)
+            except Exception as e:
+                result, errors = {"Case": case_folder, "Status": "failed", "Output": None, "Profile": []}, [[case_folder, str(e), "exception"]]
+            append_error_log(errors, error_log_path)
+            if config.get("profile_report"):
+                write_profile_report(result["Profile"], config["profile_report"])
+            status.finished(case_folder, arrival["arrived"], result["Status"] not in ("done", "skipped"))
+            verbose_print(f"Finished {case_folder} ({result['Status']}), {len(queued)} cases queued.", verbose)
+
+def process_cases_claimed(zip_filenames: List[str], config: dict, claims: WorkClaims, verbose: bool = False, on_case_done: Optional[Callable[[dict, List[list]], None]] = None) -> Tuple[List[dict], List[list]]:
+    """
+    Processes cases end to end, from their archive to the preprocessed scan, claiming
+    every case first so that nodes sharing the data folders take work from the same pool
+    without ever processing a case twice. Cases claimed by other nodes are skipped, and so
+    are cases finished with the same config of every stage and the same archive; the
+    manifest decides which stages of the other cases are rerun.
+    """
+    results, errors = [], []
+    stages_config_hash = f"{stage_config_hash(config, 'segmentation')}:{stage_config_hash(config, 'final_output')}"
+    for zip_filename in node_order(zip_filenames, claims.node_id):
+        case_folder = os.path.splitext(zip_filename)[0]
+        done_key = f"{stage_config_hash(config, 'dicom_conversion', case_folder)}:{stages_config_hash}:{files_fingerprint([os.path.join(config['data_zipped_folder'], zip_filename)])}"
+        if not claims.claim(case_folder, done_key):
+            continue
+        verbose_print(f"{claims.node_id} claimed {case_folder}", verbose)
+        try:
+            ingest_case(os.path.join(config["data_zipped_folder"], zip_filename), config, verbose=verbose)
+            # A node whose claim was taken over as stale leaves the output to the new owner
+            result, case_errors = process_case(case_folder, config, verbose, may_write=partial(claims.holds, case_folder))
+        except Exception as e:
+            result, case_errors = {"Case": case_folder, "Status": "failed", "Output": None, "Profile": []}, [[case_folder, str(e), "exception"]]
+        claims.release(case_folder, done=result["Status"] in ("done", "skipped"), key=done_key)
+        results.append(result)
+        errors.extend(case_errors)
+        if on_case_done is not None:
+            on_case_done(result, case_errors)
+    return results, errors
+
+def main(config: dict) -> None:
     """
     Main function to start the preprocessing pipeline. It processes zipped data,
     iterates through each case folder, and preprocesses the CT scans.
+    In distributed mode, the node only takes its shard of the cases (config["shard"]
+    as "i/N") and/or claims cases from the shared claims folder, and writes per-node
+    error and profile reports that are appended to the shared ones when it finishes.
     """
-    global error_log
+    node_id = config.get("node_id") or default_node_id()
+    distributed = bool(config.get("shard") or config.get("claims_folder"))
+    error_log_path = config.get("error_log", "error_log.csv")
+    profile_report = config.get("profile_report")
+    if distributed:
+        error_log_path = node_file(error_log_path, node_id)
+        profile_report = node_file(profile_report, node_id) if profile_report else None
+    pd.DataFrame(columns=ERROR_LOG_COLUMNS).to_csv(error_log_path, index=False)
     print("Starting preprocessing pipeline...")
     start_time = time.time()
     try:
-        process_zipped_data.process_zipped_data(
-            config["data_zipped_folder"], 
-            config["data_folder"], 
-            config["scan_choice"],
-            verbose=True
-        )
+        scan_choice = config["scan_choice"]
+        if config.get("auto_scan_choice", False):
+            with DicomCatalog(config["dicom_catalog_path"]) as catalog:
+                catalog.update(config["data_zipped_folder"], num_workers=config.get("ingest_workers", 1), verbose=True)
+                scan_choice = build_scan_choice(catalog, config.get("scan_selection_rules"), overrides=scan_choice_overrides(config))
+        config["scan_choice"] = scan_choice
 
-        # Clear memory after unzipping
-        gc.collect()
+        zip_filenames = sorted(f for f in os.listdir(config["data_zipped_folder"]) if f.endswith(".zip"))
+        if config.get("shard"):
+            shard_index, shard_count = parse_shard(config["shard"])
+            zip_filenames = [f for f in zip_filenames if in_shard(os.path.splitext(f)[0], shard_index, shard_count)]
+            verbose_print(f"Shard {config['shard']}: {len(zip_filenames)} cases", True)
+        log_errors = lambda result, errors: append_error_log(errors, error_log_path)
 
-        for case_folder in os.listdir(config["data_folder"]):
-            case_path = os.path.join(config["data_folder"], case_folder)
-            if os.path.isdir(case_path):
-                ct_scan_path = os.path.join(case_path, "CT_scan.nii.gz")
-                segmentation_ct_path = os.path.join(case_path, "CT_scan_segmentation.nii.gz")
-                preprocess_ct_scan(case_path, ct_scan_path, segmentation_ct_path, config, verbose=True)
+        if config.get("claims_folder"):
+            with WorkClaims(
+                config["claims_folder"],
+                node_id,
+                lease_seconds=config.get("claim_lease_s", 300),
+                heartbeat_seconds=config.get("claim_heartbeat_s", 30),
+                verbose=True
+            ) as claims:
+                results, _ = process_cases_claimed(zip_filenames, config, claims, verbose=True, on_case_done=log_errors)
+            case_folders = None
+        elif config.get("direct_dicom", False):
+            # Cases are read from their ZIP files while they are preprocessed
+            case_folders = [os.path.splitext(f)[0] for f in zip_filenames]
+        else:
+            process_zipped_data.process_zipped_data(
+                config["data_zipped_folder"], 
+                config["data_folder"], 
+                scan_choice,
+                num_workers=config.get("ingest_workers", 1),
+                in_memory=config["ingest_in_memory"],
+                manifest_path=config.get("manifest_path"),
+                extension=config.get("intermediate_nifti_extension", ".nii.gz"),
+                zip_filenames=zip_filenames,
+                verbose=True
+            )
+
+            # Clear memory after unzipping
+            gc.collect()
+
+            # Sorted so that the error log has a stable order regardless of worker count
+            case_folders = sorted(
+                case_folder for case_folder in os.listdir(config["data_folder"])
+                if not case_folder.startswith(".") and os.path.isdir(os.path.join(config["data_folder"], case_folder))
+                and (not config.get("shard") or in_shard(case_folder, shard_index, shard_count))
+            )
+        if case_folders is not None:
+            results, _ = process_cases(case_folders, config, verbose=True, on_case_done=log_errors)
+        if profile_report:
+            write_profile_report([record for result in results for record in result["Profile"]], profile_report)
+        if config.get("hu_statistics", True):
+            # Merged from the case summaries, so skipped cases and other nodes are included
+            write_dataset_statistics(case_summary_folder(config), dataset_statistics_path(config))
 
         print("Preprocessing pipeline complete.")
     except Exception as e:
         print(f"An error occurred: {e}")
+        append_error_log([["pipeline", str(e), "exception"]], error_log_path)
+
+    if distributed:
+        # Every node appends its own reports when it finishes and removes them
+        merge_node_file(config.get("error_log", "error_log.csv"), node_id)
+        if config.get("profile_report"):
+            merge_node_file(config["profile_report"], node_id)
 
     end_time = time.time()
     elapsed_time = end_time - start_time
     print(f"Total execution time: {elapsed_time:.2f} seconds")
-    # Save error log to CSV
-    error_log_df = pd.DataFrame(error_log, columns=["Case", "Error"])
-    error_log_df.to_csv("error_log.csv", index=False)
 
 if __name__ == "__main__": 
-    main()
+    parser = argparse.ArgumentParser(description="Runs the CT preprocessing pipeline.")
+    parser.add_argument("--config", default=None, help="JSON or Python file overriding the defaults of config.py")
+    parser.add_argument("--watch", action="store_true", help="Keep watching the zipped data folder and process cases as they arrive")
+    parser.add_argument("--shard", default=None, help="Only process shard i/N of the cases")
+    parser.add_argument("--claims-folder", default=None, help="Shared folder of claim files for dynamic work sharing between nodes")
+    parser.add_argument("--node-id", default=None, help="Name of this node in claims and per-node reports")
+    args = parser.parse_args()
+    config = load_config(args.config)
+    for key in ("shard", "claims_folder", "node_id"):
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+    if args.watch:
+        watch_folder(config)
+    else:
+        main(config)
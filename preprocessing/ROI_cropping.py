@@ -16,15 +16,22 @@ def compute_bounding_boxes(mask_data: dict, roi_bounds: dict, verbose: bool = Fa
         min_bounds, max_bounds = find_bounding_box(data)
         bounding_boxes[label] = {"min": min_bounds, "max": max_bounds}
 
-    # Extract the required bounds from the computed bounding boxes
+    bounding_boxes.update(select_roi_bounds(bounding_boxes, roi_bounds))
+
+    verbose_print("Bounding boxes computed.", verbose)
+    return bounding_boxes
+
+def select_roi_bounds(label_boxes: dict, roi_bounds: dict) -> dict:
+    """
+    Extracts the required bounds from the bounding boxes of each label.
+    """
+    bounds = {}
     for bound, settings in roi_bounds.items():
         if bound != "outside":
             label = settings["label"]
             bound_type = settings["type"]
-            bounding_boxes[bound] = bounding_boxes[label][bound_type][{"left": 0, "right": 0, "up": 2, "down": 2, "front": 1, "back": 1}[bound]]
-
-    verbose_print("Bounding boxes computed.", verbose)
-    return bounding_boxes
+            bounds[bound] = label_boxes[label][bound_type][{"left": 0, "right": 0, "up": 2, "down": 2, "front": 1, "back": 1}[bound]]
+    return bounds
 
 def crop_ct_scan(ct_tensor: torch.Tensor, x_min: int, x_max: int, y_min: int, y_max: int, z_min: int, z_max: int, verbose: bool = False) -> torch.Tensor:
     """
@@ -36,4 +43,62 @@ def crop_ct_scan(ct_tensor: torch.Tensor, x_min: int, x_max: int, y_min: int, y_
     cropped_ct_tensor = ct_tensor[x_min:x_max, y_min:y_max, z_min:z_max]
 
     verbose_print("CT scan cropped.", verbose)
-    return cropped_ct_tensor
\ No newline at end of file
+    return cropped_ct_tensor
+
+def compute_crop_box(bounding_boxes: dict, roi_bounds: dict, source_affine: np.ndarray, target_affine: np.ndarray, target_shape: Tuple[int, int, int], verbose: bool = False) -> Tuple[int, int, int, int, int, int]:
+    """
+    Computes the padded crop box (x_min, x_max, y_min, y_max, z_min, z_max) on the target
+    grid from the bounding boxes found on the source grid, clamped to the target shape.
+    """
+    # Define cropping limits using the bounding boxes and config bounds
+    z_min, z_max = bounding_boxes["down"], bounding_boxes["up"]
+    y_min, y_max = bounding_boxes["back"], bounding_boxes["front"]
+    x_min, x_max = bounding_boxes["left"], bounding_boxes["right"]
+
+    # Transform coordinates from segmentation scan to high res scan
+    coords = [
+        [0, 0, int(z_min) - roi_bounds["down"]["padding"]],
+        [0, 0, int(z_max) + roi_bounds["up"]["padding"]],
+        [0, int(y_min) - roi_bounds["back"]["padding"], 0],
+        [0, int(y_max) + roi_bounds["front"]["padding"], 0],
+        [int(x_min) - roi_bounds["left"]["padding"], 0, 0],
+        [int(x_max) + roi_bounds["right"]["padding"], 0, 0]
+    ]
+    z_min, z_max, y_min, y_max, x_min, x_max = transform_coordinates(
+        coords,
+        torch.tensor(source_affine, dtype=torch.float32),
+        torch.tensor(target_affine, dtype=torch.float32),
+        verbose=verbose
+    )
+
+    x_min, x_max = max(x_min, 0), min(x_max, target_shape[0])
+    y_min, y_max = max(y_min, 0), min(y_max, target_shape[1])
+    z_min, z_max = max(z_min, 0), min(z_max, target_shape[2])
+    return x_min, x_max, y_min, y_max, z_min, z_max
+
+def grow_box(box: Tuple[int, int, int, int, int, int], margin: int, shape: Tuple[int, int, int]) -> Tuple[int, int, int, int, int, int]:
+    """
+    Grows a crop box by a margin on every side, clamped to the given shape.
+    """
+    x_min, x_max, y_min, y_max, z_min, z_max = box
+    return (
+        max(x_min - margin, 0), min(x_max + margin, shape[0]),
+        max(y_min - margin, 0), min(y_max + margin, shape[1]),
+        max(z_min - margin, 0), min(z_max + margin, shape[2])
+    )
+
+def box_affine(affine: np.ndarray, box: Tuple[int, int, int, int, int, int]) -> np.ndarray:
+    """
+    Returns the affine of the sub-volume that starts at the lower corner of the box.
+    """
+    offset = np.eye(4)
+    offset[:3, 3] = box[0], box[2], box[4]
+    return affine @ offset
+
+def load_ct_region(ct_scan: nib.Nifti1Image, box: Tuple[int, int, int, int, int, int], verbose: bool = False) -> np.ndarray:
+    """
+    Reads only the given box of the CT scan through the memory-mapped data object, as float32.
+    """
+    verbose_print(f"Reading CT region {box}...", verbose)
+    x_min, x_max, y_min, y_max, z_min, z_max = box
+    return np.asarray(ct_scan.dataobj[x_min:x_max, y_min:y_max, z_min:z_max], dtype=np.float32)
@@ -1,20 +1,75 @@
+import math
+import warnings
 import torch
 import scipy.ndimage
 from utils.common import verbose_print
 import numpy as np
-from typing import Tuple
+from typing import List, Optional, Sequence, Tuple
 
-def downsample_ct(scan_tensor: torch.Tensor, target_shape: Tuple[int, int, int], order: int = 3, verbose=True) -> torch.Tensor:
-    verbose_print(f"Original shape: {scan_tensor.shape}", verbose=True)
-    verbose_print(f"Target shape: {target_shape}", verbose=True)
+DOWNSAMPLE_MODES = ("trilinear", "antialiased", "area")
+
+def gaussian_smooth(scan_tensor: torch.Tensor, sigmas: Sequence[float]) -> torch.Tensor:
+    """
+    Smooths a 3D tensor with a separable Gaussian filter, one sigma per axis (in voxels).
+    Borders are handled by replicating the edge voxels.
+    """
+    smoothed = scan_tensor.unsqueeze(0).unsqueeze(0)
+    for axis, sigma in enumerate(sigmas):
+        if sigma <= 0:
+            continue
+        radius = max(1, math.ceil(3 * sigma))
+        offsets = torch.arange(-radius, radius + 1, dtype=smoothed.dtype, device=smoothed.device)
+        kernel = torch.exp(-0.5 * (offsets / sigma) ** 2)
+        kernel_shape = [1, 1, 1, 1, 1]
+        kernel_shape[2 + axis] = kernel.numel()
+        padding = [0] * 6
+        # F.pad lists the padding of the last axis first
+        padding[2 * (2 - axis)] = padding[2 * (2 - axis) + 1] = radius
+        smoothed = torch.nn.functional.pad(smoothed, padding, mode="replicate")
+        smoothed = torch.nn.functional.conv3d(smoothed, (kernel / kernel.sum()).view(kernel_shape))
+    return smoothed.squeeze(0).squeeze(0)
+
+def downsample_ct(scan_tensor: torch.Tensor, target_shape: Tuple[int, int, int], order: Optional[int] = None, verbose=True, mode: str = "trilinear") -> torch.Tensor:
+    """
+    Resizes the scan to the target shape. "trilinear" interpolates directly, "antialiased"
+    first smooths every reduced axis with a Gaussian of sigma (factor - 1) / 2 voxels, and
+    "area" averages the input voxels covered by each output voxel.
+    order is deprecated and ignored, the interpolation is chosen by mode.
+    """
+    if order is not None:
+        warnings.warn("The order argument of downsample_ct is ignored and will be removed, use mode instead", DeprecationWarning, stacklevel=2)
+    verbose_print(f"Original shape: {scan_tensor.shape}", verbose)
+    verbose_print(f"Target shape: {target_shape}", verbose)
 
     zoom_factors = torch.tensor(target_shape, dtype=torch.float32) / torch.tensor(scan_tensor.shape, dtype=torch.float32)
-    verbose_print(f"Zoom factors: {zoom_factors}", verbose=True)
+    verbose_print(f"Zoom factors: {zoom_factors}", verbose)
+
+    if mode not in DOWNSAMPLE_MODES:
+        raise ValueError(f"Unknown downsampling mode: {mode}")
+    if mode == "antialiased":
+        scan_tensor = gaussian_smooth(scan_tensor, [max(0.0, (1 / zoom - 1) / 2) for zoom in zoom_factors.tolist()])
 
     # Perform downsampling using PyTorch
-    downsampled_scan = torch.nn.functional.interpolate(scan_tensor.unsqueeze(0).unsqueeze(0), size=target_shape, mode='trilinear', align_corners=False)
+    if mode == "area":
+        downsampled_scan = torch.nn.functional.interpolate(scan_tensor.unsqueeze(0).unsqueeze(0), size=target_shape, mode="area")
+    else:
+        downsampled_scan = torch.nn.functional.interpolate(scan_tensor.unsqueeze(0).unsqueeze(0), size=target_shape, mode='trilinear', align_corners=False)
     downsampled_scan = downsampled_scan.squeeze()
 
-    verbose_print("Downsampling (trilinear interpolation) complete.", verbose=True)
+    verbose_print(f"Downsampling ({mode}) complete.", verbose)
 
     return downsampled_scan
+
+def downsample_pyramid(scan_tensor: torch.Tensor, target_shapes: List[Tuple[int, int, int]], mode: str = "trilinear", verbose=True) -> List[torch.Tensor]:
+    """
+    Downsamples the scan to several target shapes in one pass. Levels are computed from
+    the largest to the smallest, each from the smallest level already computed that is at
+    least as large along every axis, so the full-resolution scan is only reduced once.
+    Returns the levels in the order of target_shapes.
+    """
+    levels = {}
+    for target_shape in sorted(set(tuple(shape) for shape in target_shapes), key=lambda shape: np.prod(shape), reverse=True):
+        sources = [level for shape, level in levels.items() if all(size >= target for size, target in zip(shape, target_shape))]
+        source = min(sources, key=lambda level: level.numel()) if sources else scan_tensor
+        levels[target_shape] = downsample_ct(source, target_shape, mode=mode, verbose=verbose)
+    return [levels[tuple(shape)] for shape in target_shapes]
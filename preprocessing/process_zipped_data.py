@@ -1,78 +1,211 @@
 import os
 import zipfile
-import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from utils.common import verbose_print
-from utils.file_utils import convert_dicom_to_nifti
-from typing import List
+from utils.manifest import PipelineManifest, files_fingerprint, stage_config_hash
+from utils.file_utils import convert_dicom_to_nifti, convert_zipped_dicom_to_nifti, read_zipped_dicom_volume
+from typing import List, Dict, Optional, Tuple
+import nibabel as nib
 
-def find_target_folder(zip_ref, target_folder):
+def build_prefix_index(zip_ref: zipfile.ZipFile) -> Dict[str, List[zipfile.ZipInfo]]:
     """
-    Finds the full path of the target folder inside a ZIP file.
+    Builds an index of every folder inside a ZIP file and the file members stored
+    directly in it, in a single pass over the archive's member list.
     """
-    for file in zip_ref.namelist():
-        if file.endswith('/') and target_folder in file:
-            return file
+    prefix_index = {}
+    for info in zip_ref.infolist():
+        if info.is_dir():
+            prefix_index.setdefault(info.filename, [])
+            continue
+        folder = info.filename.rsplit('/', 1)[0] + '/' if '/' in info.filename else ''
+        prefix_index.setdefault(folder, []).append(info)
+    return prefix_index
+
+def find_target_folder_indexed(prefix_index: Dict[str, List[zipfile.ZipInfo]], target_folder: str) -> Optional[str]:
+    """
+    Finds the full path of the target folder using a prefix index. A full folder path,
+    as chosen from the DICOM catalog, is matched exactly.
+    """
+    if target_folder in prefix_index:
+        return target_folder
+    for folder in prefix_index:
+        if folder and target_folder in folder:
+            return folder
     return None
 
-def process_zipped_data(data_zipped_folder: str, data_folder: str, scan_choice: dict, verbose: bool = False) -> None:
+def members_under(prefix_index: Dict[str, List[zipfile.ZipInfo]], folder: str) -> List[zipfile.ZipInfo]:
+    """
+    Returns the file members stored in a folder or any of its subfolders.
+    """
+    members = []
+    for prefix, infos in prefix_index.items():
+        if prefix.startswith(folder):
+            members.extend(infos)
+    return members
+
+def intermediate_nifti_paths(case_destination: str, extension: str = ".nii.gz") -> Tuple[str, str]:
+    """
+    Returns the paths of the segment and scan NIfTI files of a case folder.
+    """
+    return os.path.join(case_destination, f"CT_scan_segmentation{extension}"), os.path.join(case_destination, f"CT_scan{extension}")
+
+def remove_conversion_outputs(case_destination: str, extension: str = ".nii.gz") -> None:
+    """
+    Deletes the converted scans of a case folder, leaving its segmentation in place.
+    """
+    for nifti_output in intermediate_nifti_paths(case_destination, extension):
+        if os.path.exists(nifti_output):
+            os.remove(nifti_output)
+
+def convert_case(zip_path: str, case_destination: str, scan_choice: dict, in_memory: bool = False, extension: str = ".nii.gz", verbose: bool = False) -> None:
+    """
+    Converts the chosen series of a ZIP file, reporting a failed conversion instead of
+    stopping the other archives. The partial outputs of a failed conversion are removed,
+    together with the case folder if nothing else is in it, so the case is converted
+    again on the next run.
+    """
+    try:
+        process_zip_contents(zip_path, case_destination, scan_choice, in_memory=in_memory, extension=extension, verbose=verbose)
+    except Exception as e:
+        print(f"Failed to convert {os.path.basename(zip_path)}: {e}")
+        remove_conversion_outputs(case_destination, extension)
+        if os.path.isdir(case_destination) and not os.listdir(case_destination):
+            os.rmdir(case_destination)
+
+def process_zip_file(zip_path: str, data_folder: str, scan_choice: dict, in_memory: bool = False, manifest_path: Optional[str] = None, extension: str = ".nii.gz", verbose: bool = False) -> None:
+    """
+    Converts the segment and scan series of one ZIP file to NIfTI inside its case folder.
+    In memory mode the DICOM members are streamed into the converter, otherwise they are
+    extracted to a scratch folder private to this archive.
+    """
+    zip_filename = os.path.basename(zip_path)
+    case_name = os.path.splitext(zip_filename)[0]
+    case_destination = os.path.join(data_folder, case_name)
+    nifti_output_segment, nifti_output_scan = intermediate_nifti_paths(case_destination, extension)
+
+    if manifest_path is None:
+        if os.path.exists(case_destination):
+            verbose_print(f"Skipping {case_name}: already exists in {data_folder}", verbose)
+            return
+        convert_case(zip_path, case_destination, scan_choice, in_memory=in_memory, extension=extension, verbose=verbose)
+        return
+
+    with PipelineManifest(manifest_path) as manifest:
+        input_fingerprint = files_fingerprint([zip_path])
+        config_hash = stage_config_hash({"scan_choice": scan_choice}, "dicom_conversion", case_name)
+        outputs_exist = os.path.exists(nifti_output_segment) and os.path.exists(nifti_output_scan)
+        if outputs_exist and manifest.record(case_name, "dicom_conversion") is None:
+            # Case converted before the manifest existed
+            manifest.mark(case_name, "dicom_conversion", "done", input_fingerprint, config_hash)
+        if outputs_exist and manifest.is_fresh(case_name, "dicom_conversion", input_fingerprint, config_hash):
+            verbose_print(f"Skipping {case_name}: already exists in {data_folder}", verbose)
+            return
+
+        # Stale or interrupted conversion, only the converted scans are redone; the
+        # segmentation is checked against the new segment scan when the case is loaded
+        if os.path.exists(case_destination):
+            verbose_print(f"Reconverting stale case {case_name}...", verbose)
+        remove_conversion_outputs(case_destination, extension)
+        manifest.mark(case_name, "dicom_conversion", "running", input_fingerprint, config_hash)
+        convert_case(zip_path, case_destination, scan_choice, in_memory=in_memory, extension=extension, verbose=verbose)
+        status = "done" if os.path.exists(nifti_output_segment) and os.path.exists(nifti_output_scan) else "failed"
+        manifest.mark(case_name, "dicom_conversion", status, input_fingerprint, config_hash)
+
+def chosen_series(zip_ref: zipfile.ZipFile, case_name: str, scan_choice: dict, verbose: bool = False) -> Optional[Tuple[str, str, List[zipfile.ZipInfo], List[zipfile.ZipInfo]]]:
+    """
+    Finds the chosen segment and scan series inside a ZIP file. Returns their folders and
+    file members, or None when they are not specified or not found.
+    """
+    # Find target folders inside the ZIP
+    segment_folder = scan_choice.get(f"{case_name}-SEGMENT")
+    scan_folder = scan_choice.get(f"{case_name}-SCAN")
+    if not segment_folder or not scan_folder:
+        verbose_print(f"No target folders specified for {case_name} in config.", verbose)
+        return None
+
+    prefix_index = build_prefix_index(zip_ref)
+    matched_segment_folder = find_target_folder_indexed(prefix_index, segment_folder)
+    matched_scan_folder = find_target_folder_indexed(prefix_index, scan_folder)
+    if not matched_segment_folder or not matched_scan_folder:
+        verbose_print(f"No matching folders found in {zip_ref.filename} for targets {segment_folder} and {scan_folder}", verbose)
+        return None
+    return matched_segment_folder, matched_scan_folder, members_under(prefix_index, matched_segment_folder), members_under(prefix_index, matched_scan_folder)
+
+def read_case_volumes(zip_path: str, scan_choice: dict, verbose: bool = False) -> Tuple[Optional[nib.Nifti1Image], Optional[nib.Nifti1Image]]:
+    """
+    Assembles the chosen segment and scan series of a ZIP file into in-memory volumes,
+    without writing any file. Returns None for both when the series are not found.
+    """
+    case_name = os.path.splitext(os.path.basename(zip_path))[0]
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        series = chosen_series(zip_ref, case_name, scan_choice, verbose=verbose)
+        if series is None:
+            return None, None
+        _, _, segment_members, scan_members = series
+        verbose_print(f"Reading the DICOM series of {case_name} into memory...", verbose)
+        return read_zipped_dicom_volume(zip_ref, segment_members), read_zipped_dicom_volume(zip_ref, scan_members)
+
+def process_zip_contents(zip_path: str, case_destination: str, scan_choice: dict, in_memory: bool = False, extension: str = ".nii.gz", verbose: bool = False) -> None:
+    """
+    Extracts or streams the chosen series of a ZIP file and converts them to NIfTI.
+    """
+    zip_filename = os.path.basename(zip_path)
+    case_name = os.path.splitext(zip_filename)[0]
+    data_folder = os.path.dirname(case_destination)
+
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        series = chosen_series(zip_ref, case_name, scan_choice, verbose=verbose)
+        if series is None:
+            return
+        matched_segment_folder, matched_scan_folder, segment_members, scan_members = series
+
+        os.makedirs(case_destination, exist_ok=True)
+        nifti_output_segment, nifti_output_scan = intermediate_nifti_paths(case_destination, extension)
+
+        if in_memory:
+            convert_zipped_dicom_to_nifti(zip_ref, segment_members, nifti_output_segment, verbose=verbose)
+            convert_zipped_dicom_to_nifti(zip_ref, scan_members, nifti_output_scan, verbose=verbose)
+            return
+
+        # Extract only the relevant folders to a scratch folder owned by this archive
+        with tempfile.TemporaryDirectory(prefix=f".{case_name}_", dir=data_folder) as temp_extract_path:
+            for info in segment_members + scan_members:
+                zip_ref.extract(info, temp_extract_path)
+
+            extracted_segment_folder = os.path.join(temp_extract_path, matched_segment_folder)
+            extracted_scan_folder = os.path.join(temp_extract_path, matched_scan_folder)
+
+            if os.path.exists(extracted_segment_folder):
+                # Convert extracted DICOM folders to NIfTI
+                convert_dicom_to_nifti(extracted_segment_folder, nifti_output_segment, verbose=verbose)
+
+            if os.path.exists(extracted_scan_folder):
+                # Convert extracted DICOM folders to NIfTI
+                convert_dicom_to_nifti(extracted_scan_folder, nifti_output_scan, verbose=verbose)
+
+    # Delete the initially zipped folder
+    #os.remove(zip_path)
+
+def process_zipped_data(data_zipped_folder: str, data_folder: str, scan_choice: dict, num_workers: int = 1, in_memory: bool = False, manifest_path: Optional[str] = None, extension: str = ".nii.gz", zip_filenames: Optional[List[str]] = None, verbose: bool = False) -> None:
     """
     Extracts relevant folders from ZIP files, converts DICOM scans to NIfTI,
     and cleans up temporary folders. Ensures correct placement inside case folders.
+    Archives are processed in parallel when num_workers is larger than 1. Only the
+    given archives are processed if zip_filenames is set, e.g. the shard of a node.
     """
     os.makedirs(data_folder, exist_ok=True)
 
-    for zip_filename in os.listdir(data_zipped_folder):
-        if zip_filename.endswith(".zip"):
-            case_name = os.path.splitext(zip_filename)[0]
-            case_destination = os.path.join(data_folder, case_name)
-
-            if os.path.exists(case_destination):
-                verbose_print(f"Skipping {case_name}: already exists in {data_folder}", verbose)
-                continue
-
-            zip_path = os.path.join(data_zipped_folder, zip_filename)
-
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                os.makedirs(case_destination, exist_ok=True)
-
-                # Find target folders inside the ZIP
-                segment_folder = scan_choice.get(f"{case_name}-SEGMENT")
-                scan_folder = scan_choice.get(f"{case_name}-SCAN")
-                if not segment_folder or not scan_folder:
-                    verbose_print(f"No target folders specified for {case_name} in config.", verbose)
-                    continue
-
-                matched_segment_folder = find_target_folder(zip_ref, segment_folder)
-                matched_scan_folder = find_target_folder(zip_ref, scan_folder)
-                if not matched_segment_folder or not matched_scan_folder:
-                    verbose_print(f"No matching folders found in {zip_filename} for targets {segment_folder} and {scan_folder}", verbose)
-                    continue
-
-                # Extract only the relevant folders
-                temp_extract_path = os.path.join(data_folder, "temp_extract")
-                os.makedirs(temp_extract_path, exist_ok=True)
-
-                for file in zip_ref.namelist():
-                    if file.startswith(matched_segment_folder) or file.startswith(matched_scan_folder):
-                        zip_ref.extract(file, temp_extract_path)
-
-                # Move extracted files to the correct case destination
-                extracted_segment_folder = os.path.join(temp_extract_path, matched_segment_folder)
-                extracted_scan_folder = os.path.join(temp_extract_path, matched_scan_folder)
-                
-                if os.path.exists(extracted_segment_folder):
-                    # Convert extracted DICOM folders to NIfTI
-                    nifti_output_segment = os.path.join(case_destination, "CT_scan_segmentation.nii.gz")
-                    convert_dicom_to_nifti(extracted_segment_folder, nifti_output_segment, verbose=verbose)
-
-                if os.path.exists(extracted_scan_folder) :
-                    # Convert extracted DICOM folders to NIfTI
-                    nifti_output_scan = os.path.join(case_destination, "CT_scan.nii.gz")
-                    convert_dicom_to_nifti(extracted_scan_folder, nifti_output_scan, verbose=verbose)
-
-                shutil.rmtree(temp_extract_path, ignore_errors=True)  # Cleanup temp folder
-
-            # Delete the initially zipped folder
-            #os.remove(zip_path)
+    if zip_filenames is None:
+        zip_filenames = [zip_filename for zip_filename in sorted(os.listdir(data_zipped_folder)) if zip_filename.endswith(".zip")]
+    zip_paths = [os.path.join(data_zipped_folder, zip_filename) for zip_filename in zip_filenames]
+
+    if num_workers <= 1:
+        for zip_path in zip_paths:
+            process_zip_file(zip_path, data_folder, scan_choice, in_memory=in_memory, manifest_path=manifest_path, extension=extension, verbose=verbose)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            list(executor.map(process_zip_file, zip_paths, repeat(data_folder), repeat(scan_choice), repeat(in_memory), repeat(manifest_path), repeat(extension), repeat(verbose)))
 
     verbose_print(f"Processing complete. Extracted cases and NIfTI files are in: {data_folder}", verbose)
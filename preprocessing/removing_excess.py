@@ -1,17 +1,59 @@
 import torch
-from scipy.ndimage import binary_dilation
 from utils.common import verbose_print
-import numpy as np
+from utils.compact_mask import CompactMask
+from typing import Optional, Tuple, Union
 
-def expand_mask(body_tensor: torch.Tensor, padding: int, verbose: bool = False) -> torch.Tensor:
+def taxicab_distance(mask: torch.Tensor, limit: int) -> torch.Tensor:
     """
-    Expands the body mask with the specified padding.
+    Computes the taxicab (L1) distance of every voxel to the nearest voxel of the mask,
+    saturated at limit + 1. Each axis is processed with a forward and a backward running
+    minimum, so the cost does not depend on the limit.
+    """
+    saturation = limit + 1
+    distance = torch.full(mask.shape, saturation, dtype=torch.int32, device=mask.device)
+    distance[mask] = 0
+    for dim in range(mask.dim()):
+        index_shape = [1] * mask.dim()
+        index_shape[dim] = mask.shape[dim]
+        index = torch.arange(mask.shape[dim], dtype=torch.int32, device=mask.device).view(index_shape)
+        forward = torch.cummin(distance - index, dim=dim).values + index
+        backward = torch.flip(torch.cummin(torch.flip(distance + index, [dim]), dim=dim).values, [dim]) - index
+        distance = torch.minimum(forward, backward).clamp_(max=saturation)
+    return distance
+
+def expand_mask(body_tensor: Union[torch.Tensor, CompactMask], padding: int, box: Optional[Tuple[int, int, int, int, int, int]] = None, device: Optional[torch.device] = None, verbose: bool = False) -> torch.Tensor:
+    """
+    Expands the body mask with the specified padding. This matches a binary dilation with
+    a 6-connected structuring element repeated padding times. When a box
+    (x_min, x_max, y_min, y_max, z_min, z_max) is given, only the box plus the padding
+    margin is processed and the returned mask covers the box only.
+    A compact mask is only expanded to that region, on the given device.
     """
     verbose_print(f"Expanding body mask with padding of {padding}...", verbose)
 
+    if isinstance(body_tensor, CompactMask):
+        box = box if box is not None else (0, body_tensor.shape[0], 0, body_tensor.shape[1], 0, body_tensor.shape[2])
+        x_min, x_max, y_min, y_max, z_min, z_max = box
+        margin_min = [low - padding for low in (x_min, y_min, z_min)]
+        margin_max = [high + padding for high in (x_max, y_max, z_max)]
+        region = body_tensor.region((margin_min[0], margin_max[0], margin_min[1], margin_max[1], margin_min[2], margin_max[2]))
+        body_tensor = torch.from_numpy(region).to(device)
+    elif box is not None:
+        x_min, x_max, y_min, y_max, z_min, z_max = box
+        # Mask voxels up to padding outside the box can still reach into it
+        margin_min = [max(low - padding, 0) for low in (x_min, y_min, z_min)]
+        margin_max = [min(high + padding, size) for high, size in zip((x_max, y_max, z_max), body_tensor.shape)]
+        body_tensor = body_tensor[margin_min[0]:margin_max[0], margin_min[1]:margin_max[1], margin_min[2]:margin_max[2]]
+
     # Perform mask expansion using PyTorch
-    body_data_with_padding = binary_dilation(body_tensor.cpu().numpy(), iterations=padding).astype(bool)
-    body_data_with_padding = torch.tensor(body_data_with_padding, dtype=torch.bool).to(body_tensor.device)
+    body_data_with_padding = taxicab_distance(body_tensor != 0, padding) <= padding
+
+    if box is not None:
+        body_data_with_padding = body_data_with_padding[
+            x_min - margin_min[0]:x_max - margin_min[0],
+            y_min - margin_min[1]:y_max - margin_min[1],
+            z_min - margin_min[2]:z_max - margin_min[2]
+        ]
 
     verbose_print("Mask expansion complete.", verbose)
     return body_data_with_padding
@@ -22,8 +64,12 @@ def set_values_outside_body(ct_tensor: torch.Tensor, body_data_with_padding: tor
     """
     verbose_print("Setting values outside the body to -1000...", verbose)
 
+    # A compact mask covering the same grid is expanded to a full boolean mask first
+    if isinstance(body_data_with_padding, CompactMask):
+        body_data_with_padding = torch.from_numpy(body_data_with_padding.region((0, ct_tensor.shape[0], 0, ct_tensor.shape[1], 0, ct_tensor.shape[2])))
+
     # Set values outside the body to -1000 using PyTorch
-    ct_tensor[~body_data_with_padding] = -1000
+    ct_tensor.masked_fill_(~body_data_with_padding.to(ct_tensor.device), -1000)
 
     verbose_print("Values outside the body have been set.", verbose)
-    return ct_tensor
\ No newline at end of file
+    return ct_tensor
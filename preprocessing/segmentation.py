@@ -1,30 +1,77 @@
-from totalsegmentator.python_api import totalsegmentator
-from totalsegmentator.map_to_binary import class_map
 from utils.segmentation_checker import check_segmentation_files
-from utils.common import verbose_print
+from utils.segmentation_cache import segmentation_cache_key, read_provenance, record_provenance, snapshot_folder, detach_links
+from utils.common import verbose_print, file_content_hash, image_content_hash
+from preprocessing.segmentation_backends import create_backend
+from typing import Dict, Optional
 
 
-def run_segmentation(segmentation_ct_path: str, segmentation_path: str, roi_bounds: dict, verbose: bool = False) -> bool:
+def task_options_for(task: str, roi_bounds: dict) -> dict:
     """
-    Runs the necessary totalsegmentator tasks based on the roi_bounds.
+    Returns the options a totalsegmentator task runs with.
+    """
+    if task == "body":
+        return {"fast": True}
+    if task == "total":
+        roi_subset = sorted(set(bound["label"] for bound in roi_bounds.values() if bound["task"] == "total"))
+        return {"fastest": True, "roi_subset": roi_subset}
+    return {}
+
+def segmentation_tasks(segmentation_path: str, roi_bounds: dict, input_hash: Optional[str] = None) -> Dict[str, dict]:
+    """
+    Returns the totalsegmentator tasks needed for the missing segmentation files,
+    mapped to the options each task runs with. When the hash of the input CT scan is
+    given, tasks whose masks were produced from another input or other options are
+    needed as well.
+    """
+    missing_segmentations = check_segmentation_files(segmentation_path, roi_bounds)
+    tasks = set(bound["task"] for bound in roi_bounds.values() if bound["label"] in missing_segmentations)
+
+    if input_hash is not None:
+        provenance = read_provenance(segmentation_path)
+        for task in set(bound["task"] for bound in roi_bounds.values()):
+            if task in provenance and provenance[task] != segmentation_cache_key(input_hash, task, task_options_for(task, roi_bounds)):
+                tasks.add(task)
+
+    tasks.discard("total_v1")
+    return {task: task_options_for(task, roi_bounds) for task in sorted(tasks)}
+
+def run_segmentation_tasks(task_options: Dict[str, dict], segmentation_ct_path: str, segmentation_path: str, backend, cache=None, input_hash: Optional[str] = None, verbose: bool = False) -> None:
+    """
+    Runs the given segmentation tasks, restoring them from the cache when possible and
+    adding newly computed masks to it.
+    """
+    for task, options in task_options.items():
+        key = segmentation_cache_key(input_hash, task, options) if input_hash is not None else None
+        if cache is not None and key is not None and cache.restore(key, segmentation_path):
+            record_provenance(segmentation_path, task, key)
+            continue
+
+        verbose_print(f"Running segmentation task: {task}...", verbose)
+        # Masks restored from the cache are hardlinks that the backend would overwrite in place
+        detach_links(segmentation_path)
+        before = snapshot_folder(segmentation_path)
+        backend.run(task, options, segmentation_ct_path, segmentation_path)
+        if key is None:
+            continue
+        after = snapshot_folder(segmentation_path)
+        produced = [filename for filename, mtime in after.items() if before.get(filename) != mtime and not filename.startswith(".")]
+        if cache is not None:
+            cache.store(key, segmentation_path, produced)
+        record_provenance(segmentation_path, task, key)
+
+def run_segmentation(segmentation_ct_path: str, segmentation_path: str, roi_bounds: dict, verbose: bool = False, backend: Optional[object] = None, cache: Optional[object] = None) -> bool:
+    """
+    Runs the necessary totalsegmentator tasks based on the roi_bounds. The CT scan is a
+    file path or an in-memory image.
     """
     try:
-        missing_segmentations = check_segmentation_files(segmentation_path)
-        if len(missing_segmentations)!=0:
-            tasks = set([bound["task"] if bound["label"] in missing_segmentations else None for bound in roi_bounds.values()])
-            tasks.remove(None)
-            if "total_v1" in tasks:
-                tasks.remove("total_v1")
-            for task in tasks:
-                roi_subset = set([bound["label"] if bound["task"]=="total" else None for bound in roi_bounds.values()])
-                roi_subset.remove(None)
-                verbose_print(f"Running segmentation task: {task}...", verbose)
-                if task == "body":
-                    totalsegmentator(segmentation_ct_path, segmentation_path, task=task, fast=True, quiet=not(verbose))
-                elif task =="total":
-                    totalsegmentator(segmentation_ct_path, segmentation_path, task=task, fastest=True, roi_subset=roi_subset, quiet=not(verbose))
-                else:
-                    totalsegmentator(segmentation_ct_path, segmentation_path, task=task, quiet=not(verbose))
+        input_hash = None
+        if cache is not None:
+            input_hash = file_content_hash(segmentation_ct_path) if isinstance(segmentation_ct_path, str) else image_content_hash(segmentation_ct_path)
+        task_options = segmentation_tasks(segmentation_path, roi_bounds, input_hash)
+        if task_options and backend is None:
+            backend = create_backend("totalsegmentator", verbose=verbose)
+        run_segmentation_tasks(task_options, segmentation_ct_path, segmentation_path, backend, cache, input_hash, verbose=verbose)
         return True
     except Exception as e:
         verbose_print(f"Segmentation error: {e}", verbose)
@@ -0,0 +1,129 @@
+import os
+import numpy as np
+import nibabel as nib
+from utils.common import verbose_print
+from utils.file_utils import as_image
+
+class ResidentPredictor:
+    """
+    Stands in for an nnU-Net predictor inside TotalSegmentator. The first time a model
+    folder is initialised the real predictor is built and its weights are loaded; later
+    initialisations with the same model reuse it, so the weights stay on the device.
+    """
+    def __init__(self, predictors: "ResidentPredictors", args: tuple, kwargs: dict):
+        self.predictors = predictors
+        self.args = args
+        self.kwargs = kwargs
+        self.predictor = None
+
+    def initialize_from_trained_model_folder(self, model_folder: str, use_folds=None, checkpoint_name: str = "checkpoint_final.pth", **kwargs) -> None:
+        key = repr((str(model_folder), use_folds, checkpoint_name, kwargs, self.args, sorted(self.kwargs.items())))
+        if key not in self.predictors.loaded:
+            predictor = self.predictors.predictor_class(*self.args, **self.kwargs)
+            predictor.initialize_from_trained_model_folder(model_folder, use_folds, checkpoint_name=checkpoint_name, **kwargs)
+            self.predictors.loaded[key] = predictor
+        self.predictor = self.predictors.loaded[key]
+
+    def __getattr__(self, name: str):
+        if name == "predictor" or self.predictor is None:
+            raise AttributeError(name)
+        return getattr(self.predictor, name)
+
+    def __setattr__(self, name: str, value) -> None:
+        if name in ("predictors", "args", "kwargs", "predictor"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.predictor, name, value)
+
+class ResidentPredictors:
+    """
+    Replacement for the nnUNetPredictor class used by TotalSegmentator that keeps one
+    loaded predictor per model for the lifetime of the process.
+    """
+    def __init__(self, predictor_class):
+        self.predictor_class = predictor_class
+        self.loaded = {}
+
+    def __call__(self, *args, **kwargs) -> ResidentPredictor:
+        return ResidentPredictor(self, args, kwargs)
+
+class TotalSegmentatorBackend:
+    """
+    Runs segmentation tasks with TotalSegmentator, keeping the nnU-Net model of every task
+    loaded after its first case.
+    """
+    def __init__(self, verbose: bool = False):
+        self.verbose = verbose
+        self.totalsegmentator = None
+
+    def load(self, task: str, options: dict) -> None:
+        """
+        Imports TotalSegmentator once and makes it reuse its nnU-Net predictors. The
+        TotalSegmentator API builds a predictor and reads the weights on every call, so the
+        predictor class it uses is replaced by one that keeps every loaded model; the
+        resampling, cropping and label handling of TotalSegmentator stay unchanged.
+        """
+        if self.totalsegmentator is None:
+            import totalsegmentator.nnunet as totalsegmentator_nnunet
+            from totalsegmentator.python_api import totalsegmentator
+            if not hasattr(totalsegmentator_nnunet, "nnUNetPredictor"):
+                verbose_print("This TotalSegmentator version builds its predictors elsewhere, models are loaded for every case.", self.verbose)
+            elif not isinstance(totalsegmentator_nnunet.nnUNetPredictor, ResidentPredictors):
+                totalsegmentator_nnunet.nnUNetPredictor = ResidentPredictors(totalsegmentator_nnunet.nnUNetPredictor)
+            self.totalsegmentator = totalsegmentator
+
+    def run(self, task: str, options: dict, segmentation_ct_path: str, segmentation_path: str) -> None:
+        """
+        Segments the CT scan, a file path or an in-memory image, and writes one mask per
+        label to the segmentation folder.
+        """
+        self.load(task, options)
+        self.totalsegmentator(segmentation_ct_path, segmentation_path, task=task, quiet=not(self.verbose), **options)
+
+class ThresholdSegmentationBackend:
+    """
+    Lightweight stand-in for TotalSegmentator that segments labels by HU thresholds.
+    Meant for tests and for running the pipeline without model weights.
+    """
+    label_thresholds = {"body": (-500, None), "skull": (300, None)}
+    default_threshold = (200, None)
+
+    def __init__(self, verbose: bool = False):
+        self.verbose = verbose
+        self.models = {}
+
+    def load(self, task: str, options: dict) -> None:
+        """
+        Builds the threshold table of a task once.
+        """
+        if task not in self.models:
+            labels = sorted(options.get("roi_subset") or [task])
+            self.models[task] = {label: self.label_thresholds.get(label, self.default_threshold) for label in labels}
+
+    def run(self, task: str, options: dict, segmentation_ct_path: str, segmentation_path: str) -> None:
+        """
+        Thresholds the CT scan and writes one mask per label to the segmentation folder.
+        """
+        self.load(task, options)
+        ct_scan = as_image(segmentation_ct_path)
+        ct_data = np.asarray(ct_scan.dataobj, dtype=np.float32)
+        os.makedirs(segmentation_path, exist_ok=True)
+        for label, (low, high) in self.models[task].items():
+            mask = ct_data >= low
+            if high is not None:
+                mask &= ct_data <= high
+            nib.save(nib.Nifti1Image(mask.astype(np.uint8), ct_scan.affine), os.path.join(segmentation_path, f"{label}.nii.gz"))
+            verbose_print(f"Threshold segmentation written for {label}.", self.verbose)
+
+SEGMENTATION_BACKENDS = {
+    "totalsegmentator": TotalSegmentatorBackend,
+    "threshold": ThresholdSegmentationBackend,
+}
+
+def create_backend(name: str, verbose: bool = False):
+    """
+    Creates the segmentation backend registered under the given name.
+    """
+    if name not in SEGMENTATION_BACKENDS:
+        raise ValueError(f"Unknown segmentation backend: {name}")
+    return SEGMENTATION_BACKENDS[name](verbose=verbose)
@@ -0,0 +1,107 @@
+import queue
+import multiprocessing
+from preprocessing.segmentation import segmentation_tasks, run_segmentation_tasks
+from preprocessing.segmentation_backends import create_backend
+from utils.segmentation_cache import SegmentationCache
+from utils.common import verbose_print, file_content_hash
+from typing import List, Tuple, Optional
+
+def serve_segmentation(backend_name: str, requests, results, cache_folder: Optional[str] = None, cache_max_bytes: int = 0, verbose: bool = False) -> None:
+    """
+    Worker loop of the segmentation service. The backend is created once and every task
+    model is loaded the first time it is requested, then kept for all following cases.
+    """
+    backend = create_backend(backend_name, verbose=verbose)
+    cache = SegmentationCache(cache_folder, cache_max_bytes, verbose=verbose) if cache_folder else None
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, segmentation_ct_path, segmentation_path, task_options, input_hash = request
+        try:
+            for task, options in task_options.items():
+                backend.load(task, options)
+            run_segmentation_tasks(task_options, segmentation_ct_path, segmentation_path, backend, cache, input_hash, verbose=verbose)
+            results.put((request_id, None))
+        except Exception as e:
+            results.put((request_id, str(e)))
+
+class SegmentationService:
+    """
+    Persistent segmentation worker process that accepts many cases over a queue.
+    The set of tasks each case needs is still decided by check_segmentation_files.
+    """
+    def __init__(self, roi_bounds: dict, backend_name: str = "totalsegmentator", cache_folder: Optional[str] = None, cache_max_bytes: int = 0, verbose: bool = False):
+        self.roi_bounds = roi_bounds
+        self.use_cache = bool(cache_folder)
+        self.verbose = verbose
+        context = multiprocessing.get_context("spawn")
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(
+            target=serve_segmentation,
+            args=(backend_name, self.requests, self.results, cache_folder, cache_max_bytes, verbose),
+            daemon=True
+        )
+        self.pending = 0
+
+    def start(self) -> "SegmentationService":
+        self.process.start()
+        return self
+
+    def stop(self) -> None:
+        self.requests.put(None)
+        self.process.join()
+
+    def __enter__(self) -> "SegmentationService":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.stop()
+
+    def submit(self, request_id: str, segmentation_ct_path: str, segmentation_path: str) -> bool:
+        """
+        Queues a case for segmentation. Returns False when the case needs no segmentation.
+        """
+        input_hash = file_content_hash(segmentation_ct_path) if self.use_cache else None
+        task_options = segmentation_tasks(segmentation_path, self.roi_bounds, input_hash)
+        if not task_options:
+            return False
+        self.requests.put((request_id, segmentation_ct_path, segmentation_path, task_options, input_hash))
+        self.pending += 1
+        return True
+
+    def collect(self) -> Tuple[str, str]:
+        """
+        Waits for the next finished case and returns its id and error message, or None on success.
+        """
+        while True:
+            try:
+                request_id, error = self.results.get(timeout=1.0)
+                break
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError("Segmentation service stopped unexpectedly")
+        self.pending -= 1
+        return request_id, error
+
+    def segment_cases(self, cases: List[Tuple[str, str, str]]) -> List[list]:
+        """
+        Segments (case_name, segmentation_ct_path, segmentation_path) cases and returns the
+        error records of the cases that failed.
+        """
+        errors = []
+        for case_name, segmentation_ct_path, segmentation_path in cases:
+            try:
+                self.submit(case_name, segmentation_ct_path, segmentation_path)
+            except OSError as e:
+                # E.g. the CT scan is missing because its conversion failed; the case is
+                # reported here and fails again when it is preprocessed
+                verbose_print(f"Segmentation error for {case_name}: {e}", self.verbose)
+                errors.append([case_name, f"Segmentation failed: {e}"])
+        while self.pending:
+            case_name, error = self.collect()
+            if error is not None:
+                verbose_print(f"Segmentation error for {case_name}: {error}", self.verbose)
+                errors.append([case_name, f"Segmentation failed: {error}"])
+        return sorted(errors)
@@ -1,26 +1,98 @@
 import nibabel as nib
 import numpy as np
 import random
+import scipy.ndimage
+from typing import Callable, Dict, Optional, Tuple
 
-def inject_cube_anomaly(input_nifti_path, output_nifti_path, cube_size=10, cube_hu=2000):
-    import nibabel as nib
-    import numpy as np
+def patch_grid(size: int) -> np.ndarray:
+    """
+    Returns the coordinates of the voxel centres of a size^3 patch relative to its centre,
+    as an array of shape (3, size, size, size).
+    """
+    axis = np.arange(size, dtype=np.float32) + 0.5 - size / 2
+    return np.stack(np.meshgrid(axis, axis, axis, indexing="ij"))
 
-    # Load the original NIfTI file
-    nifti_img = nib.load(input_nifti_path)
-    img_data = nifti_img.get_fdata()
+def cube_weights(size: int, rng: np.random.Generator) -> np.ndarray:
+    return np.ones((size, size, size), dtype=np.float32)
+
+def sphere_weights(size: int, rng: np.random.Generator) -> np.ndarray:
+    return (np.linalg.norm(patch_grid(size), axis=0) <= size / 2).astype(np.float32)
+
+def ellipsoid_weights(size: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Randomly oriented ellipsoid whose longest semi-axis is half the patch size.
+    """
+    semi_axes = size / 2 * np.array([1.0, *rng.uniform(0.4, 1.0, 2)], dtype=np.float32)
+    rotation, _ = np.linalg.qr(rng.standard_normal((3, 3)))
+    coords = np.tensordot(rotation.T.astype(np.float32), patch_grid(size), axes=1)
+    return (np.sum((coords / semi_axes[:, None, None, None]) ** 2, axis=0) <= 1).astype(np.float32)
+
+def blob_weights(size: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Sphere with a boundary and an intensity texture perturbed by smoothed noise.
+    """
+    noise = scipy.ndimage.gaussian_filter(rng.standard_normal((size, size, size)).astype(np.float32), sigma=max(size / 8, 1))
+    noise = (noise - noise.min()) / max(float(noise.max() - noise.min()), 1e-6)
+    radius = np.linalg.norm(patch_grid(size), axis=0) / (size / 2)
+    inside = radius + 0.4 * (noise - 0.5) <= 1
+    return np.where(inside, 0.6 + 0.4 * noise, 0).astype(np.float32)
+
+def graded_weights(size: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Sphere whose intensity falls off linearly from its centre to the surrounding tissue.
+    """
+    radius = np.linalg.norm(patch_grid(size), axis=0) / (size / 2)
+    return np.clip(1 - radius, 0, 1).astype(np.float32)
 
-    # Image dimensions
-    dims = img_data.shape
+# Anomaly shapes as functions of the patch size and a random generator that return the
+# blending weight of the anomaly intensity for every voxel of a size^3 patch
+ANOMALY_SHAPES: Dict[str, Callable[[int, np.random.Generator], np.ndarray]] = {
+    "cube": cube_weights,
+    "sphere": sphere_weights,
+    "ellipsoid": ellipsoid_weights,
+    "blob": blob_weights,
+    "graded": graded_weights,
+}
 
-    # Choose random location ensuring cube fits inside, around the middle
-    x = np.random.randint(dims[0]//4, 3*dims[0]//4 - cube_size)
-    y = np.random.randint(dims[1]//4, 3*dims[1]//4 - cube_size)
-    z = np.random.randint(dims[2]//4, 3*dims[2]//4 - cube_size)
+def anomaly_location(volume_shape: Tuple[int, int, int], patch_shape: Tuple[int, int, int], rng: np.random.Generator) -> Tuple[int, int, int]:
+    """
+    Chooses the corner of a patch at random so that it fits inside the middle half of the volume.
+    """
+    location = []
+    for dim, size in zip(volume_shape, patch_shape):
+        low = dim // 4
+        location.append(int(rng.integers(low, max(low + 1, 3 * dim // 4 - size))))
+    return tuple(location)
+
+def inject_anomaly(img_data: np.ndarray, shape: str = "cube", size: int = 10, intensity: float = 1, rng: Optional[np.random.Generator] = None) -> Tuple[np.ndarray, Tuple[int, int, int]]:
+    """
+    Injects an anomaly of the given shape into the volume in place, blending it towards
+    the anomaly intensity (1 is the maximum of a normalized scan). Returns the boolean
+    anomaly mask of the volume and the corner of the anomaly patch.
+    """
+    if shape not in ANOMALY_SHAPES:
+        raise ValueError(f"Unknown anomaly shape: {shape}")
+    rng = rng if rng is not None else np.random.default_rng()
+    weights = ANOMALY_SHAPES[shape](size, rng)
+    x, y, z = anomaly_location(img_data.shape, weights.shape, rng)
+
+    # Patches near the border of small volumes are clipped to the volume
+    region = tuple(slice(start, min(start + size, dim)) for start, dim in zip((x, y, z), img_data.shape))
+    weights = weights[tuple(slice(0, part.stop - part.start) for part in region)]
+    img_data[region] = img_data[region] * (1 - weights) + intensity * weights
+
+    mask = np.zeros(img_data.shape, dtype=bool)
+    mask[region] = weights > 0
+    return mask, (x, y, z)
+
+def inject_cube_anomaly(input_nifti_path, output_nifti_path, cube_size=10, cube_hu=2000):
+    # Load the original NIfTI file
+    nifti_img = nib.load(input_nifti_path)
+    img_data = np.asarray(nifti_img.dataobj, dtype=np.float32)
 
-    # Inject cube with high HU (normalized so max = 1)
+    # Inject cube with high HU (normalized so max = 1), around the middle
     anomaly_hu = 1
-    img_data[x:x+cube_size, y:y+cube_size, z:z+cube_size] = anomaly_hu
+    _, (x, y, z) = inject_anomaly(img_data, "cube", cube_size, anomaly_hu)
 
     # Save the modified image as a new NIfTI file
     anomaly_img = nib.Nifti1Image(img_data, affine=nifti_img.affine, header=nifti_img.header)
@@ -0,0 +1,91 @@
+import os
+import numpy as np
+import nibabel as nib
+import torch
+from collections import OrderedDict
+from synthetic_abnormality.abnormality_creator import ANOMALY_SHAPES, inject_anomaly
+from utils.packed_store import INDEX_FILENAME, PackedVolumeStore
+from typing import List, Optional, Sequence, Tuple
+
+class AnomalyDataset(torch.utils.data.Dataset):
+    """
+    Preprocessed normal volumes with synthetic anomalies injected in memory at load time.
+    The source is a folder of {case}_NORMAL.nii.gz files or a packed volume store.
+    Every item is a (volume, mask) pair of tensors of shape (1, X, Y, Z), the mask being
+    the ground truth of the injected anomaly (empty for the normal samples).
+
+    The anomaly of an item only depends on the seed, the epoch and the index, so samples
+    are reproducible whatever the number of DataLoader workers. Decoded volumes are kept
+    in a per-worker LRU cache so repeated samples of a case are not read again.
+    """
+    def __init__(
+        self,
+        source: str,
+        case_names: Optional[List[str]] = None,
+        shapes: Sequence[str] = ("cube",),
+        sizes: Sequence[int] = (5, 10, 15),
+        intensity: float = 1,
+        anomaly_probability: float = 1.0,
+        samples_per_volume: int = 1,
+        seed: int = 0,
+        cache_size: int = 16,
+    ):
+        for shape in shapes:
+            if shape not in ANOMALY_SHAPES:
+                raise ValueError(f"Unknown anomaly shape: {shape}")
+        self.source = source
+        self.packed = os.path.exists(os.path.join(source, INDEX_FILENAME))
+        if case_names is None:
+            if self.packed:
+                with PackedVolumeStore(source) as store:
+                    case_names = list(store.index())
+            else:
+                case_names = sorted(f[:-len("_NORMAL.nii.gz")] for f in os.listdir(source) if f.endswith("_NORMAL.nii.gz"))
+        self.case_names = case_names
+        self.shapes = list(shapes)
+        self.sizes = list(sizes)
+        self.intensity = intensity
+        self.anomaly_probability = anomaly_probability
+        self.samples_per_volume = samples_per_volume
+        self.seed = seed
+        self.epoch = 0
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        # Opened lazily so that every DataLoader worker gets its own connection
+        self.store = None
+
+    def __len__(self) -> int:
+        return len(self.case_names) * self.samples_per_volume
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Draws a different set of anomalies for every epoch.
+        """
+        self.epoch = epoch
+
+    def load_volume(self, case_name: str) -> np.ndarray:
+        """
+        Returns the decoded float32 volume of a case from the LRU cache, reading it on a miss.
+        """
+        if case_name in self.cache:
+            self.cache.move_to_end(case_name)
+            return self.cache[case_name]
+        if self.packed:
+            if self.store is None:
+                self.store = PackedVolumeStore(self.source)
+            volume, _ = self.store.load(case_name, dequantize=True)
+        else:
+            volume = np.asarray(nib.load(os.path.join(self.source, f"{case_name}_NORMAL.nii.gz")).dataobj, dtype=np.float32)
+        self.cache[case_name] = volume
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return volume
+
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        rng = np.random.default_rng([self.seed, self.epoch, index])
+        volume = self.load_volume(self.case_names[index // self.samples_per_volume]).copy()
+        if rng.random() < self.anomaly_probability:
+            mask, _ = inject_anomaly(volume, self.shapes[rng.integers(len(self.shapes))], int(self.sizes[rng.integers(len(self.sizes))]), self.intensity, rng=rng)
+        else:
+            mask = np.zeros(volume.shape, dtype=bool)
+        return torch.from_numpy(volume).unsqueeze(0), torch.from_numpy(mask).unsqueeze(0)
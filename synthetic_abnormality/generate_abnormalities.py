@@ -1,46 +1,123 @@
 import os
+import json
 import random
+import argparse
+import multiprocessing
 import nibabel as nib
 import numpy as np
-from abnormality_creator import inject_cube_anomaly
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import List, Optional
 
-def generate_abnormalities(input_folder, output_folder, num_scans, cube_sizes):
+from synthetic_abnormality.abnormality_creator import ANOMALY_SHAPES, inject_anomaly
+from utils import file_utils
+
+MANIFEST_FILENAME = "anomaly_manifest.json"
+
+def scan_name_of(scan: str) -> str:
+    # Remove .nii extension before adding anomaly suffix
+    return str.split(os.path.splitext(os.path.splitext(scan)[0])[0], '_')[0]
+
+def plan_variants(selected_scans: List[str], shapes: List[str], sizes: List[int], intensity: float, seed: Optional[int]) -> List[dict]:
+    """
+    Lists every anomalous variant to generate, one per scan, shape and size, each with its
+    own seed drawn from the base seed so that any variant can be regenerated on its own.
+    """
+    variant_seeds = np.random.SeedSequence(seed).generate_state(len(selected_scans) * len(shapes) * len(sizes), dtype=np.uint32)
+    variants = []
+    for scan in selected_scans:
+        for shape in shapes:
+            for size in sizes:
+                variants.append({
+                    "scan": scan,
+                    "output": f"{scan_name_of(scan)}_ANOMALY_{shape.upper()}{size}.nii.gz",
+                    "shape": shape,
+                    "size": size,
+                    "intensity": intensity,
+                    "seed": int(variant_seeds[len(variants)]),
+                })
+    return variants
+
+def generate_scan_variants(input_folder: str, output_folder: str, variants: List[dict], save_masks: bool = False) -> List[dict]:
+    """
+    Loads a scan once and writes all of its anomalous variants. Returns the variants with
+    the location and voxel count of each injected anomaly.
+    """
+    nifti_img = nib.load(os.path.join(input_folder, variants[0]["scan"]))
+    img_data = np.asarray(nifti_img.dataobj, dtype=np.float32)
+    records = []
+    for variant in variants:
+        anomaly_data = img_data.copy()
+        mask, location = inject_anomaly(anomaly_data, variant["shape"], variant["size"], variant["intensity"], rng=np.random.default_rng(variant["seed"]))
+        file_utils.save_nifti(anomaly_data, nifti_img.affine, os.path.join(output_folder, variant["output"]), header=nifti_img.header)
+        record = dict(variant, location=list(location), voxels=int(mask.sum()))
+        if save_masks:
+            record["mask"] = variant["output"].replace("_ANOMALY_", "_MASK_")
+            file_utils.save_nifti(mask.astype(np.uint8), nifti_img.affine, os.path.join(output_folder, record["mask"]), header=nifti_img.header)
+        records.append(record)
+        print(f"Generated {variant['output']}")
+    return records
+
+def generate_abnormalities(input_folder, output_folder, num_scans, cube_sizes, shapes=("cube",), intensity=1, seed=None, num_workers=1, save_masks=False):
     """
     Generates synthetic abnormalities in a specified number of CT scans.
-    
+
     Parameters:
     - input_folder: Folder containing the original CT scans.
     - output_folder: Folder to save the modified CT scans.
     - num_scans: Number of CT scans to modify.
-    - cube_sizes: List of cube sizes for the abnormalities.
+    - cube_sizes: List of sizes (edge length or diameter in voxels) for the abnormalities.
+    - shapes: Anomaly shapes from ANOMALY_SHAPES to generate for every size.
+    - intensity: Intensity of the anomalies in the normalized scans.
+    - seed: Base seed of the scan selection and of every variant (None draws one).
+    - num_workers: Number of worker processes, each generating all variants of a scan.
+    - save_masks: Also write the ground-truth anomaly mask of every variant.
+
+    The seed, location and size of every variant are recorded in anomaly_manifest.json
+    in the output folder.
     """
+    for shape in shapes:
+        if shape not in ANOMALY_SHAPES:
+            raise ValueError(f"Unknown anomaly shape: {shape}")
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
+    # A random base seed is drawn and recorded so the run can be reproduced
+    seed = seed if seed is not None else int(np.random.SeedSequence().entropy % 2**32)
 
     # Get list of all CT scans in the input folder
-    ct_scans = [f for f in os.listdir(input_folder) if f.endswith('.nii.gz')]
-    
+    ct_scans = sorted(f for f in os.listdir(input_folder) if f.endswith('.nii.gz'))
+
     # Randomly select the specified number of CT scans
-    selected_scans = random.sample(ct_scans, num_scans)
-    
-    for scan in selected_scans:
-        input_path = os.path.join(input_folder, scan)
-        
-        for cube_size in cube_sizes:
-            # Remove .nii extension before adding anomaly suffix
-            scan_name = str.split(os.path.splitext(os.path.splitext(scan)[0])[0], '_')[0]
-            output_filename = f"{scan_name}_ANOMALY_CUBE{cube_size}.nii.gz"
-            output_path = os.path.join(output_folder, output_filename)
-            
-            # Inject anomaly and save the modified scan
-            inject_cube_anomaly(input_path, output_path, cube_size)
-            print(f"Generated {output_filename}")
+    selected_scans = random.Random(seed).sample(ct_scans, num_scans)
+    variants = plan_variants(selected_scans, list(shapes), list(cube_sizes), intensity, seed)
+    variants_per_scan = [[variant for variant in variants if variant["scan"] == scan] for scan in selected_scans]
+
+    if num_workers <= 1:
+        scan_records = [generate_scan_variants(input_folder, output_folder, scan_variants, save_masks) for scan_variants in variants_per_scan]
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            scan_records = list(executor.map(generate_scan_variants, repeat(input_folder), repeat(output_folder), variants_per_scan, repeat(save_masks)))
+
+    manifest_path = os.path.join(output_folder, MANIFEST_FILENAME)
+    with open(manifest_path, "w") as f:
+        json.dump({"seed": seed, "variants": [record for records in scan_records for record in records]}, f, indent=4)
+    print(f"Anomaly manifest saved to {manifest_path}")
 
 
 if __name__ == "__main__":
-    input_folder = 'PREPROCESSED_CT_SCANS'
-    output_folder = 'PREPROCESSED_CT_SCANS/synthetic_abnormalities'
-    num_scans = 2
-    cube_sizes = [5, 10, 15]
+    parser = argparse.ArgumentParser(description="Generates synthetic anomalies in preprocessed CT scans.")
+    parser.add_argument("--input-folder", default='PREPROCESSED_CT_SCANS')
+    parser.add_argument("--output-folder", default='PREPROCESSED_CT_SCANS/synthetic_abnormalities')
+    parser.add_argument("--num-scans", type=int, default=2)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 10, 15])
+    parser.add_argument("--shapes", nargs="+", default=["cube"], choices=sorted(ANOMALY_SHAPES))
+    parser.add_argument("--intensity", type=float, default=1)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--save-masks", action="store_true")
+    args = parser.parse_args()
 
-    generate_abnormalities(input_folder, output_folder, num_scans, cube_sizes)
+    generate_abnormalities(
+        args.input_folder, args.output_folder, args.num_scans, args.sizes,
+        shapes=args.shapes, intensity=args.intensity, seed=args.seed, num_workers=args.workers, save_masks=args.save_masks
+    )
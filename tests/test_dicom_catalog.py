@@ -0,0 +1,19 @@
+from utils.dicom_catalog import select_series
+
+def series_entry(folder_name: str, description: str, slice_thickness: float, slice_count: int) -> dict:
+    return {
+        "folder": f"case/{folder_name}/", "folder_name": folder_name, "description": description, "kernel": None,
+        "modality": "CT", "slice_thickness": slice_thickness, "slice_count": slice_count,
+    }
+
+def test_keyword_preference_only_applies_to_the_scan():
+    thin_bone = series_entry("SER_THIN", "HEAD BONE 0.6", 0.6, 400)
+    soft = series_entry("SER_SOFT", "HEAD SOFT 3.0", 3.0, 80)
+
+    segment, scan = select_series([thin_bone, soft])
+
+    assert scan is thin_bone
+    assert segment is soft
+
+def test_too_short_series_are_ignored():
+    assert select_series([series_entry("SCOUT", "TOPOGRAM", 1.0, 2)]) == (None, None)
@@ -0,0 +1,95 @@
+import os
+import io
+import zipfile
+import numpy as np
+import nibabel as nib
+import pytest
+from preprocessing.process_zipped_data import intermediate_nifti_paths, process_zip_file
+
+pydicom = pytest.importorskip("pydicom")
+pytest.importorskip("dicom2nifti")
+
+def dicom_slice(pixels: np.ndarray, index: int, slice_thickness: float, series_uid: str) -> bytes:
+    """
+    Encodes one axial slice of a CT series as a DICOM file.
+    """
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CTImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dataset = Dataset()
+    dataset.file_meta = meta
+    dataset.SOPClassUID = CTImageStorage
+    dataset.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    dataset.StudyInstanceUID = "1.2.3.4"
+    dataset.SeriesInstanceUID = series_uid
+    dataset.Modality = "CT"
+    dataset.Manufacturer = "Synthetic"
+    dataset.InstanceNumber = index + 1
+    dataset.ImagePositionPatient = [-10.0, -12.0, index * slice_thickness]
+    dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dataset.PixelSpacing = [1.0, 1.0]
+    dataset.SliceThickness = slice_thickness
+    dataset.Rows, dataset.Columns = pixels.shape
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = "MONOCHROME2"
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 16
+    dataset.HighBit = 15
+    dataset.PixelRepresentation = 1
+    dataset.RescaleIntercept = 0
+    dataset.RescaleSlope = 1
+    dataset.PixelData = pixels.astype(np.int16).tobytes()
+    buffer = io.BytesIO()
+    dataset.save_as(buffer, enforce_file_format=True)
+    return buffer.getvalue()
+
+def write_case_zip(zip_path: str) -> None:
+    """
+    Writes a case archive with a 3 mm segment series and a 1 mm scan series.
+    """
+    rng = np.random.default_rng(0)
+    with zipfile.ZipFile(zip_path, "w") as zip_ref:
+        for folder, slices, thickness in (("case/SEG_3MM/", 6, 3.0), ("case/SCAN_THIN/", 18, 1.0)):
+            series_uid = pydicom.uid.generate_uid()
+            for index in range(slices):
+                pixels = rng.integers(-1000, 1000, size=(20, 24))
+                zip_ref.writestr(f"{folder}{index:04d}.dcm", dicom_slice(pixels, index, thickness, series_uid))
+            zip_ref.writestr(f"{folder}README.txt", "not a DICOM file")
+
+@pytest.mark.parametrize("in_memory", [True, False])
+def test_zip_is_converted_to_nifti(tmp_path, in_memory):
+    zip_path = str(tmp_path / "case-1.zip")
+    write_case_zip(zip_path)
+    scan_choice = {"case-1-SEGMENT": "SEG_3MM", "case-1-SCAN": "SCAN_THIN"}
+
+    process_zip_file(zip_path, str(tmp_path / "data"), scan_choice, in_memory=in_memory)
+
+    segment_path, scan_path = intermediate_nifti_paths(str(tmp_path / "data" / "case-1"))
+    assert nib.load(segment_path).shape == (24, 20, 6)
+    assert nib.load(scan_path).shape == (24, 20, 18)
+
+def test_in_memory_conversion_matches_file_conversion(tmp_path):
+    zip_path = str(tmp_path / "case-1.zip")
+    write_case_zip(zip_path)
+    scan_choice = {"case-1-SEGMENT": "SEG_3MM", "case-1-SCAN": "SCAN_THIN"}
+
+    process_zip_file(zip_path, str(tmp_path / "memory"), scan_choice, in_memory=True)
+    process_zip_file(zip_path, str(tmp_path / "disk"), scan_choice, in_memory=False)
+
+    for memory_path, disk_path in zip(intermediate_nifti_paths(str(tmp_path / "memory" / "case-1")), intermediate_nifti_paths(str(tmp_path / "disk" / "case-1"))):
+        memory_image, disk_image = nib.load(memory_path), nib.load(disk_path)
+        np.testing.assert_allclose(memory_image.affine, disk_image.affine)
+        np.testing.assert_array_equal(np.asarray(memory_image.dataobj), np.asarray(disk_image.dataobj))
+
+def test_failed_conversion_leaves_no_case_folder(tmp_path):
+    zip_path = str(tmp_path / "case-1.zip")
+    with zipfile.ZipFile(zip_path, "w") as zip_ref:
+        zip_ref.writestr("case/SEG_3MM/0000.dcm", b"not a DICOM file")
+        zip_ref.writestr("case/SCAN_THIN/0000.dcm", b"not a DICOM file")
+
+    process_zip_file(zip_path, str(tmp_path / "data"), {"case-1-SEGMENT": "SEG_3MM", "case-1-SCAN": "SCAN_THIN"}, in_memory=True)
+
+    assert not os.path.exists(tmp_path / "data" / "case-1")
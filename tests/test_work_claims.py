@@ -0,0 +1,37 @@
+import os
+import time
+import multiprocessing
+from utils.work_claims import WorkClaims, node_order
+
+NAMES = [f"case{index:03d}" for index in range(200)]
+
+def claim_all(claims_folder: str, node_id: str) -> int:
+    claimed = 0
+    with WorkClaims(claims_folder, node_id) as claims:
+        for name in node_order(NAMES, node_id):
+            if claims.claim(name, "key"):
+                claimed += 1
+                claims.release(name, done=True, key="key")
+    return claimed
+
+def test_every_case_is_claimed_once(tmp_path):
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(6) as pool:
+        claimed = pool.starmap(claim_all, [(str(tmp_path), f"node{index}") for index in range(6)])
+    assert sum(claimed) == len(NAMES)
+
+def test_taken_over_claim_is_lost_and_kept(tmp_path):
+    with WorkClaims(str(tmp_path), "old", lease_seconds=0.1) as old, WorkClaims(str(tmp_path), "new", lease_seconds=0.1) as new:
+        assert old.claim("case", "key")
+        past = time.time() - 10
+        os.utime(old.claim_path("case"), (past, past))
+        assert new.claim("case", "key")
+
+        assert not old.holds("case")
+        old.release("case", done=True, key="key")
+        assert new.holds("case")
+        assert not new.is_done("case", "key")
+
+        new.release("case", done=True, key="key")
+        assert not os.path.exists(new.claim_path("case"))
+        assert new.is_done("case", "key")
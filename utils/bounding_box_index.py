@@ -0,0 +1,59 @@
+import os
+import json
+import nibabel as nib
+from utils.common import verbose_print, file_content_hash
+from utils.compact_mask import CompactMask
+from typing import Dict, List
+
+INDEX_FILENAME = "bounding_boxes.json"
+
+def compute_mask_entry(mask_path: str) -> dict:
+    """
+    Loads a mask in compact form and computes its bounding box, shape and affine.
+    """
+    mask_img = nib.load(mask_path, mmap=True)
+    min_bounds, max_bounds = CompactMask.from_nifti(mask_img).bounding_box()
+    return {"min": min_bounds, "max": max_bounds, "shape": list(mask_img.shape), "affine": mask_img.affine.tolist()}
+
+def load_bounding_boxes(segmentation_path: str, labels: List[str], verbose: bool = False) -> Dict[str, dict]:
+    """
+    Returns the bounding box, shape and affine of each label mask in the segmentation folder.
+    Entries are kept in a sidecar index keyed by the mask's size, mtime and content hash, so
+    unchanged masks are never opened again.
+    """
+    index_path = os.path.join(segmentation_path, INDEX_FILENAME)
+    index = {}
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+
+    changed = False
+    boxes = {}
+    for label in labels:
+        mask_path = os.path.join(segmentation_path, f"{label}.nii.gz")
+        stat = os.stat(mask_path)
+        entry = index.get(label)
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            boxes[label] = entry
+            continue
+
+        # The stat changed, only recompute the box if the content changed as well
+        content_hash = file_content_hash(mask_path)
+        if not entry or entry["sha256"] != content_hash:
+            verbose_print(f"Computing bounding box for {label}...", verbose)
+            entry = compute_mask_entry(mask_path)
+        entry.update({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": content_hash})
+        index[label] = entry
+        boxes[label] = entry
+        changed = True
+
+    if changed:
+        temp_path = f"{index_path}.tmp{os.getpid()}"
+        with open(temp_path, 'w') as f:
+            json.dump(index, f, indent=4)
+        os.replace(temp_path, index_path)
+
+    return boxes
@@ -0,0 +1,47 @@
+import os
+import json
+import numpy as np
+from typing import Dict, Sequence
+
+def case_summary_folder(config: dict) -> str:
+    """
+    Returns the folder of the per-case summaries, by default next to the outputs.
+    """
+    return config.get("case_summary_folder") or os.path.join(config["output_folder"], "case_summaries")
+
+def crop_summary(crop_box: Sequence[int], ct_affine: np.ndarray) -> dict:
+    """
+    Describes the crop box of a case in voxels of the high res scan and in millimetres.
+    """
+    voxel_size = np.linalg.norm(np.asarray(ct_affine)[:3, :3], axis=0)
+    box_shape = [int(crop_box[2 * axis + 1] - crop_box[2 * axis]) for axis in range(3)]
+    return {
+        "crop_box": [int(bound) for bound in crop_box],
+        "voxel_size_mm": [round(float(size), 4) for size in voxel_size],
+        "crop_extent_mm": [round(float(size * count), 2) for size, count in zip(voxel_size, box_shape)],
+    }
+
+def write_case_summary(folder: str, case_name: str, summary: dict) -> None:
+    """
+    Writes the summary of a case to its own JSON file, so parallel workers and nodes
+    never write to the same file.
+    """
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{case_name}.json")
+    temp_path = f"{path}.tmp{os.getpid()}"
+    with open(temp_path, "w") as f:
+        json.dump(summary, f, indent=4)
+    os.replace(temp_path, path)
+
+def load_case_summaries(folder: str) -> Dict[str, dict]:
+    """
+    Returns the summaries of all cases in a folder by case name.
+    """
+    if not os.path.isdir(folder):
+        return {}
+    summaries = {}
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith(".json"):
+            with open(os.path.join(folder, filename), "r") as f:
+                summaries[filename[:-len(".json")]] = json.load(f)
+    return summaries
@@ -1,7 +1,13 @@
+import os
+import hashlib
 import nibabel as nib
 import numpy as np
-import torch
-from typing import List, Tuple
+from typing import TYPE_CHECKING, List, Tuple
+
+# torch is imported by the functions that need it, so that importing the shared helpers
+# does not load it in stages that never touch tensors
+if TYPE_CHECKING:
+    import torch
 
 def verbose_print(message: str, verbose: bool) -> None:
     """
@@ -10,19 +16,81 @@ def verbose_print(message: str, verbose: bool) -> None:
     if verbose:
         print(message)
 
-def find_bounding_box(mask: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+# Filesystems shared between nodes, on which SQLite's write-ahead log does not work since
+# it relies on shared memory between the processes using the database
+NETWORK_FILESYSTEMS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "ceph", "glusterfs", "lustre", "fuse.sshfs", "9p"}
+
+def on_network_filesystem(path: str) -> bool:
+    """
+    Tells whether a path lies on a network filesystem, from the longest mount point in
+    /proc/mounts that contains it. Returns False where /proc/mounts is not available.
+    """
+    path = os.path.realpath(path)
+    try:
+        with open("/proc/mounts", "r") as f:
+            mounts = [line.split()[1:3] for line in f if len(line.split()) > 2]
+    except OSError:
+        return False
+    best_mount, best_type = "", ""
+    for mount_point, filesystem_type in mounts:
+        mount_point = mount_point.replace("\\040", " ")
+        if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) > len(best_mount):
+            best_mount, best_type = mount_point, filesystem_type
+    return best_type in NETWORK_FILESYSTEMS
+
+def sqlite_journal_mode(database_path: str) -> str:
+    """
+    Returns the journal mode for a SQLite database: write-ahead logging on local disks,
+    so readers do not block the writer, and the default rollback journal on network
+    filesystems, where write-ahead logging is unsupported.
+    """
+    folder = os.path.dirname(os.path.abspath(database_path))
+    return "DELETE" if on_network_filesystem(folder) else "WAL"
+
+def file_content_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Computes the SHA-256 hash of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def image_content_hash(image: nib.Nifti1Image) -> str:
+    """
+    Computes the SHA-256 hash of an in-memory image from its voxels and affine.
+    """
+    digest = hashlib.sha256(np.ascontiguousarray(np.asarray(image.dataobj)).tobytes())
+    digest.update(np.asarray(image.affine, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+def find_bounding_box(mask: "torch.Tensor") -> Tuple["torch.Tensor", "torch.Tensor"]:
     """
-    Finds the bounding box of a given mask.
+    Finds the bounding box of a given mask from its projections onto each axis.
+    Compact masks already know their bounding box.
     """
-    indices = torch.nonzero(mask > 0, as_tuple=False)
-    min_bounds = indices.min(axis=0).values
-    max_bounds = indices.max(axis=0).values
-    return min_bounds, max_bounds
+    import torch
+    if hasattr(mask, "bounding_box"):
+        min_bounds, max_bounds = mask.bounding_box()
+        return torch.tensor(min_bounds), torch.tensor(max_bounds)
+    mask = mask > 0
+    projection_xy = mask.any(dim=2)
+    projections = [projection_xy.any(dim=1), projection_xy.any(dim=0), mask.any(dim=0).any(dim=0)]
+    min_bounds, max_bounds = [], []
+    for projection in projections:
+        indices = torch.nonzero(projection, as_tuple=True)[0]
+        if indices.numel() == 0:
+            raise ValueError("Cannot compute the bounding box of an empty mask")
+        min_bounds.append(indices[0])
+        max_bounds.append(indices[-1])
+    return torch.stack(min_bounds), torch.stack(max_bounds)
 
-def transform_coordinates(coords: List[List[int]], source_affine: torch.Tensor, target_affine: torch.Tensor, verbose: bool = False) -> List[int]:
+def transform_coordinates(coords: List[List[int]], source_affine: "torch.Tensor", target_affine: "torch.Tensor", verbose: bool = False) -> List[int]:
     """
     Transforms coordinates from the source affine to the target affine.
     """
+    import torch
     verbose_print("Transforming coordinates...", verbose)
     transformed_coords = []
     for coord in coords:
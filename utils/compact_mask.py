@@ -0,0 +1,98 @@
+import numpy as np
+import nibabel as nib
+from typing import List, Optional, Tuple
+
+class CompactMask:
+    """
+    Binary label mask stored as the crop of its bounding box, one byte per voxel or
+    bit-packed, together with the shape of the full grid it lives on.
+    """
+    def __init__(self, shape: Tuple[int, int, int], offset: Tuple[int, int, int], crop: np.ndarray, packed: bool = False, affine: Optional[np.ndarray] = None):
+        self.shape = tuple(int(size) for size in shape)
+        self.offset = tuple(int(start) for start in offset)
+        self.crop_shape = tuple(int(size) for size in crop.shape)
+        self.packed = packed
+        self.data = np.packbits(crop, axis=None) if packed else np.ascontiguousarray(crop, dtype=bool)
+        self.affine = affine
+
+    @classmethod
+    def from_array(cls, mask: np.ndarray, pack: bool = False, affine: Optional[np.ndarray] = None) -> "CompactMask":
+        """
+        Compacts a full mask array, treating every non-zero voxel as part of the mask.
+        """
+        mask = np.asarray(mask) != 0
+        projection_xy = mask.any(axis=2)
+        projections = [projection_xy.any(axis=1), projection_xy.any(axis=0), mask.any(axis=(0, 1))]
+        bounds = [np.flatnonzero(projection) for projection in projections]
+        if any(indices.size == 0 for indices in bounds):
+            return cls(mask.shape, (0, 0, 0), np.zeros((0, 0, 0), dtype=bool), packed=pack, affine=affine)
+        slices = tuple(slice(indices[0], indices[-1] + 1) for indices in bounds)
+        return cls(mask.shape, tuple(indices[0] for indices in bounds), mask[slices], packed=pack, affine=affine)
+
+    @classmethod
+    def from_nifti(cls, mask_img: nib.Nifti1Image, pack: bool = False) -> "CompactMask":
+        """
+        Loads a mask as uint8 straight from the memory-mapped data object and compacts it.
+        """
+        return cls.from_array(np.asarray(mask_img.dataobj, dtype=np.uint8), pack=pack, affine=mask_img.affine)
+
+    @property
+    def empty(self) -> bool:
+        return 0 in self.crop_shape
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.data.nbytes)
+
+    def bounding_box(self) -> Tuple[List[int], List[int]]:
+        """
+        Returns the inclusive minimum and maximum index of the mask along each axis.
+        """
+        if self.empty:
+            raise ValueError("Cannot compute the bounding box of an empty mask")
+        min_bounds = list(self.offset)
+        max_bounds = [start + size - 1 for start, size in zip(self.offset, self.crop_shape)]
+        return min_bounds, max_bounds
+
+    def crop(self) -> np.ndarray:
+        """
+        Returns the bounding-box crop of the mask as a boolean array.
+        """
+        if self.packed:
+            return np.unpackbits(self.data, count=int(np.prod(self.crop_shape))).reshape(self.crop_shape).astype(bool)
+        return self.data
+
+    def region(self, box: Tuple[int, int, int, int, int, int]) -> np.ndarray:
+        """
+        Returns the mask inside a box (x_min, x_max, y_min, y_max, z_min, z_max) of the full
+        grid as a boolean array, without ever expanding the mask to the full grid.
+        """
+        lows, highs = box[0::2], box[1::2]
+        region = np.zeros(tuple(high - low for low, high in zip(lows, highs)), dtype=bool)
+        if self.empty:
+            return region
+        overlap_low = [max(low, start) for low, start in zip(lows, self.offset)]
+        overlap_high = [min(high, start + size) for high, start, size in zip(highs, self.offset, self.crop_shape)]
+        if any(low >= high for low, high in zip(overlap_low, overlap_high)):
+            return region
+        crop = self.crop()
+        region[tuple(slice(low - box_low, high - box_low) for low, high, box_low in zip(overlap_low, overlap_high, lows))] = \
+            crop[tuple(slice(low - start, high - start) for low, high, start in zip(overlap_low, overlap_high, self.offset))]
+        return region
+
+    def save(self, path: str) -> None:
+        """
+        Saves the compact mask, bit-packed, to an .npz file.
+        """
+        packed = self.data if self.packed else np.packbits(self.data, axis=None)
+        np.savez(path, data=packed, shape=self.shape, offset=self.offset, crop_shape=self.crop_shape)
+
+    @classmethod
+    def load(cls, path: str, pack: bool = False) -> "CompactMask":
+        """
+        Loads a compact mask saved with save().
+        """
+        with np.load(path) as stored:
+            crop_shape = tuple(int(size) for size in stored["crop_shape"])
+            crop = np.unpackbits(stored["data"], count=int(np.prod(crop_shape))).reshape(crop_shape).astype(bool)
+            return cls(tuple(stored["shape"]), tuple(stored["offset"]), crop, packed=pack)
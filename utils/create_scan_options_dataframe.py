@@ -1,34 +1,16 @@
-import os
-import zipfile
 import pandas as pd
+from utils.dicom_catalog import DicomCatalog
 
-def get_dicom_parent_folders(zip_path: str) -> list:
-    """
-    Extracts the parent folders of all DICOM files in the ZIP file.
-    """
-    dicom_folders = set()
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        for file in zip_ref.namelist():
-            if file.lower().endswith('.dcm'):
-                parent_folder = os.path.basename(os.path.dirname(file))
-                dicom_folders.add(parent_folder)
-    return list(dicom_folders)
-
-def create_scan_options_dataframe(data_zipped_folder: str) -> pd.DataFrame:
+def create_scan_options_dataframe(data_zipped_folder: str, catalog_path: str = "dicom_catalog.sqlite", num_workers: int = 1) -> pd.DataFrame:
     """
     Creates a pandas DataFrame containing the different options for the scans
-    for each zipped folder name.
+    for each zipped folder name, one row per series with its header fields.
+    Only new or changed archives are opened, through the DICOM catalog.
     """
-    data = []
-    for zip_filename in os.listdir(data_zipped_folder):
-        if zip_filename.endswith(".zip"):
-            zip_path = os.path.join(data_zipped_folder, zip_filename)
-            dicom_folders = get_dicom_parent_folders(zip_path)
-            data.append({
-                "zip_filename": zip_filename,
-                "dicom_folders": dicom_folders
-            })
-    
+    with DicomCatalog(catalog_path) as catalog:
+        catalog.update(data_zipped_folder, num_workers=num_workers)
+        data = catalog.series()
+
     df = pd.DataFrame(data)
     return df
 
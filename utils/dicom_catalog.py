@@ -0,0 +1,278 @@
+import os
+import json
+import sqlite3
+import zipfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from preprocessing.process_zipped_data import build_prefix_index
+from utils.common import sqlite_journal_mode, verbose_print
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+# pydicom is imported when archives are scanned, so that importing the catalog (as main
+# does) does not load it
+if TYPE_CHECKING:
+    import pydicom
+
+# Rules of the automatic scan selection. Series with fewer slices or another modality are
+# ignored. The scan is the thinnest series (most slices on a tie), among the series that
+# mention a preferred keyword in their description, kernel or folder if there are any.
+# The segment series is the one closest to the segmentation slice thickness.
+DEFAULT_SELECTION_RULES = {
+    "modality": "CT",
+    "min_slices": 20,
+    "prefer_keywords": ["BONE"],
+    "segment_slice_thickness": 3.0,
+}
+
+# Version of the cataloged data, raised whenever archives must be scanned again
+CATALOG_VERSION = 1
+
+HEADER_FIELDS = ("SeriesInstanceUID", "SeriesDescription", "Modality", "SliceThickness", "SpacingBetweenSlices", "ConvolutionKernel", "PixelSpacing", "Rows", "Columns")
+
+def read_series_header(zip_ref: zipfile.ZipFile, members: List[zipfile.ZipInfo]) -> Tuple[Optional["pydicom.Dataset"], int]:
+    """
+    Reads the headers of the members of a series, without their pixel data. Returns the
+    header of the first DICOM image and the number of members that are DICOM images;
+    other files in the folder, such as DICOMDIRs or reports, are not counted.
+    """
+    import pydicom
+    header, image_count = None, 0
+    for info in members:
+        with zip_ref.open(info) as dicom_file:
+            try:
+                dataset = pydicom.dcmread(dicom_file, stop_before_pixels=True, specific_tags=list(HEADER_FIELDS))
+            except (pydicom.errors.InvalidDicomError, EOFError):
+                continue
+        if dataset.get("Rows") is None:
+            continue
+        image_count += 1
+        if header is None:
+            header = dataset
+    return header, image_count
+
+def header_value(dataset: "pydicom.Dataset", field: str):
+    """
+    Returns a header field as a JSON-compatible value, None if it is missing.
+    """
+    from pydicom.multival import MultiValue
+    value = dataset.get(field)
+    if value is None or value == "":
+        return None
+    if isinstance(value, MultiValue):
+        return [float(item) if field == "PixelSpacing" else str(item) for item in value]
+    if field in ("SliceThickness", "SpacingBetweenSlices"):
+        return float(value)
+    if field in ("Rows", "Columns"):
+        return int(value)
+    return str(value)
+
+def scan_archive(zip_path: str) -> List[dict]:
+    """
+    Lists the DICOM series of a ZIP file, one per folder containing DICOM images, with
+    the header of one representative image straight out of the archive.
+    """
+    series = []
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for folder, members in build_prefix_index(zip_ref).items():
+            if not members:
+                continue
+            dataset, image_count = read_series_header(zip_ref, members)
+            if dataset is None:
+                continue
+            kernel = header_value(dataset, "ConvolutionKernel")
+            pixel_spacing = header_value(dataset, "PixelSpacing") or [None, None]
+            series.append({
+                "folder": folder,
+                "folder_name": os.path.basename(folder.rstrip('/')),
+                "series_uid": header_value(dataset, "SeriesInstanceUID"),
+                "description": header_value(dataset, "SeriesDescription"),
+                "modality": header_value(dataset, "Modality"),
+                "slice_thickness": header_value(dataset, "SliceThickness"),
+                "slice_spacing": header_value(dataset, "SpacingBetweenSlices"),
+                "kernel": "\\".join(kernel) if isinstance(kernel, list) else kernel,
+                "pixel_spacing_x": pixel_spacing[0],
+                "pixel_spacing_y": pixel_spacing[1],
+                "rows": header_value(dataset, "Rows"),
+                "columns": header_value(dataset, "Columns"),
+                "slice_count": image_count,
+            })
+    return series
+
+class DicomCatalog:
+    """
+    SQLite catalog of the DICOM series inside the zipped cases. Archives are only
+    rescanned when their size or modification time changed.
+    """
+    def __init__(self, catalog_path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(catalog_path)), exist_ok=True)
+        self.connection = sqlite3.connect(catalog_path, timeout=60)
+        self.connection.execute(f"PRAGMA journal_mode={sqlite_journal_mode(catalog_path)}")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS archives (zip_filename TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS series ("
+            "zip_filename TEXT, folder TEXT, folder_name TEXT, series_uid TEXT, description TEXT, modality TEXT, "
+            "slice_thickness REAL, slice_spacing REAL, kernel TEXT, pixel_spacing_x REAL, pixel_spacing_y REAL, "
+            "rows INTEGER, columns INTEGER, slice_count INTEGER, PRIMARY KEY (zip_filename, folder))"
+        )
+        # Catalogs of older versions counted every file of a series folder as a slice, so
+        # their archives are forgotten and rescanned
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] < CATALOG_VERSION:
+            self.connection.execute("DELETE FROM archives")
+            self.connection.execute("DELETE FROM series")
+            self.connection.execute(f"PRAGMA user_version = {CATALOG_VERSION}")
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "DicomCatalog":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def is_current(self, zip_path: str) -> bool:
+        """
+        Checks if an archive was cataloged with its current size and modification time.
+        """
+        stat = os.stat(zip_path)
+        row = self.connection.execute("SELECT size, mtime_ns FROM archives WHERE zip_filename = ?", (os.path.basename(zip_path),)).fetchone()
+        return row is not None and tuple(row) == (stat.st_size, stat.st_mtime_ns)
+
+    def store(self, zip_path: str, series: List[dict]) -> None:
+        """
+        Replaces the series of an archive.
+        """
+        zip_filename = os.path.basename(zip_path)
+        stat = os.stat(zip_path)
+        with self.connection:
+            self.connection.execute("DELETE FROM series WHERE zip_filename = ?", (zip_filename,))
+            self.connection.executemany(
+                "INSERT INTO series VALUES (:zip_filename, :folder, :folder_name, :series_uid, :description, :modality, "
+                ":slice_thickness, :slice_spacing, :kernel, :pixel_spacing_x, :pixel_spacing_y, :rows, :columns, :slice_count)",
+                [dict(entry, zip_filename=zip_filename) for entry in series]
+            )
+            self.connection.execute("INSERT OR REPLACE INTO archives VALUES (?, ?, ?)", (zip_filename, stat.st_size, stat.st_mtime_ns))
+
+    def update(self, data_zipped_folder: str, num_workers: int = 1, verbose: bool = False) -> List[str]:
+        """
+        Scans the new and changed archives of a folder, in parallel when num_workers is
+        larger than 1, and forgets archives that no longer exist. Archives that cannot be
+        read are reported and skipped. Returns the archives that were scanned.
+        """
+        zip_filenames = sorted(f for f in os.listdir(data_zipped_folder) if f.endswith(".zip"))
+        with self.connection:
+            for (zip_filename,) in self.connection.execute("SELECT zip_filename FROM archives").fetchall():
+                if zip_filename not in zip_filenames:
+                    self.connection.execute("DELETE FROM archives WHERE zip_filename = ?", (zip_filename,))
+                    self.connection.execute("DELETE FROM series WHERE zip_filename = ?", (zip_filename,))
+
+        zip_paths = [os.path.join(data_zipped_folder, f) for f in zip_filenames if not self.is_current(os.path.join(data_zipped_folder, f))]
+        verbose_print(f"Cataloging {len(zip_paths)} new or changed archives...", verbose)
+        scanned = []
+
+        def store_scanned(zip_path: str, scan: Callable[[], List[dict]]) -> None:
+            # An unreadable archive is reported and left out, so it is rescanned next time
+            try:
+                self.store(zip_path, scan())
+            except Exception as e:
+                print(f"Failed to catalog {zip_path}: {e}")
+                return
+            scanned.append(os.path.basename(zip_path))
+
+        if num_workers <= 1:
+            for zip_path in zip_paths:
+                store_scanned(zip_path, partial(scan_archive, zip_path))
+        else:
+            # Workers only read the archives, the catalog is written from this process
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                futures = [executor.submit(scan_archive, zip_path) for zip_path in zip_paths]
+                for zip_path, future in zip(zip_paths, futures):
+                    store_scanned(zip_path, future.result)
+        return scanned
+
+    def series(self, case_name: Optional[str] = None) -> List[dict]:
+        """
+        Returns the cataloged series of one case, or of all cases.
+        """
+        self.connection.row_factory = sqlite3.Row
+        try:
+            if case_name is None:
+                rows = self.connection.execute("SELECT * FROM series ORDER BY zip_filename, folder").fetchall()
+            else:
+                rows = self.connection.execute("SELECT * FROM series WHERE zip_filename = ? ORDER BY folder", (f"{case_name}.zip",)).fetchall()
+        finally:
+            self.connection.row_factory = None
+        return [dict(row) for row in rows]
+
+def select_series(series: List[dict], rules: Optional[dict] = None) -> Tuple[Optional[dict], Optional[dict]]:
+    """
+    Chooses the segment and scan series of a case with the selection rules. Returns None
+    for both when no series qualifies.
+    """
+    rules = dict(DEFAULT_SELECTION_RULES, **(rules or {}))
+    candidates = [
+        entry for entry in series
+        if entry["slice_count"] >= rules["min_slices"]
+        and (not rules["modality"] or entry["modality"] in (None, rules["modality"]))
+    ]
+    keywords = [keyword.upper() for keyword in rules["prefer_keywords"]]
+    preferred = [
+        entry for entry in candidates
+        if any(keyword in " ".join(str(entry[field] or "") for field in ("description", "kernel", "folder_name")).upper() for keyword in keywords)
+    ]
+    if not candidates:
+        return None, None
+
+    def thickness(entry: dict) -> float:
+        return entry["slice_thickness"] if entry["slice_thickness"] is not None else float("inf")
+
+    # The keyword preference only applies to the scan; the segment series is chosen by
+    # its slice thickness alone
+    scan = min(preferred or candidates, key=lambda entry: (thickness(entry), -entry["slice_count"]))
+    segment = min(candidates, key=lambda entry: (abs(thickness(entry) - rules["segment_slice_thickness"]), entry["slice_count"]))
+    return segment, scan
+
+def build_scan_choice(catalog: DicomCatalog, rules: Optional[dict] = None, overrides: Optional[dict] = None) -> Dict[str, str]:
+    """
+    Builds the scan choice ({case}-SEGMENT and {case}-SCAN folders) of every cataloged case.
+    Entries of overrides, such as a hand-edited scan_choice.json, take precedence.
+    """
+    series_per_case = {}
+    for entry in catalog.series():
+        series_per_case.setdefault(os.path.splitext(entry["zip_filename"])[0], []).append(entry)
+
+    scan_choice = {}
+    for case_name, series in series_per_case.items():
+        segment, scan = select_series(series, rules)
+        if segment is not None:
+            scan_choice[f"{case_name}-SEGMENT"] = segment["folder"]
+            scan_choice[f"{case_name}-SCAN"] = scan["folder"]
+    scan_choice.update(overrides or {})
+    return scan_choice
+
+def scan_choice_overrides(config: dict) -> Dict[str, str]:
+    """
+    Returns the hand-made scan choices of a config, kept apart from the automatic choices
+    that get merged into config["scan_choice"], so a changed archive is selected anew
+    instead of keeping the series chosen for its earlier version. They are taken from
+    config["scan_choice"] the first time, before any automatic choice is merged into it.
+    """
+    return config.setdefault("scan_choice_overrides", dict(config["scan_choice"]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Catalogs the DICOM series of the zipped cases and selects the scans to use.")
+    parser.add_argument("data_zipped_folder")
+    parser.add_argument("--catalog", default="dicom_catalog.sqlite")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--scan-choice-output", default=None, help="Write the selected scans as a scan_choice.json")
+    args = parser.parse_args()
+
+    with DicomCatalog(args.catalog) as catalog:
+        scanned = catalog.update(args.data_zipped_folder, num_workers=args.workers, verbose=True)
+        print(f"Cataloged {len(scanned)} archives in {args.catalog}")
+        if args.scan_choice_output:
+            with open(args.scan_choice_output, "w") as f:
+                json.dump(build_scan_choice(catalog), f, indent=4)
+            print(f"Scan choice saved to {args.scan_choice_output}")
@@ -1,11 +1,23 @@
+import io
 import os
+import threading
 import nibabel as nib
-import dicom2nifti
-import nibabel.processing
+import zipfile
 from utils.common import verbose_print
-from typing import Tuple, Dict
+from typing import Tuple, Dict, List, Optional, Union
 import numpy as np
 
+# dicom2nifti and pydicom are imported by the functions that read DICOM files, so that
+# stages which never touch DICOM data do not pay for importing them
+
+def as_image(image_or_path: Union[str, nib.Nifti1Image]) -> nib.Nifti1Image:
+    """
+    Returns an in-memory image as is, or loads a NIfTI file memory-mapped.
+    """
+    if isinstance(image_or_path, str):
+        return nib.load(image_or_path, mmap=True)
+    return image_or_path
+
 def load_nifti_files(ct_scan_path: str, segmentation_folder: str, verbose: bool = False) -> Tuple[nib.Nifti1Image, nib.Nifti1Image, nib.Nifti1Image, nib.Nifti1Image, nib.Nifti1Image]:
     """
     Loads NIfTI files for the CT scan and segmentation masks.
@@ -54,25 +66,80 @@ def get_image_arrays(ct_scan: nib.Nifti1Image, nifti_files: Dict[str, nib.Nifti1
         print(f"Failed to extract image arrays: {e}")
         raise
 
-def save_nifti(scan_array: np.ndarray, affine: np.ndarray, output_file: str, verbose: bool = False) -> None:
+def save_nifti(scan_array: np.ndarray, affine: np.ndarray, output_file: str, verbose: bool = False, header: Optional[nib.Nifti1Header] = None) -> None:
     """
-    Saves the preprocessed scan array as a NIfTI file.
+    Saves the preprocessed scan array as a NIfTI file, keeping the fields of the source
+    header if one is given. The data type is always that of the array, so that e.g. a
+    uint8 mask is not stored with the data type of the scan it was derived from.
     """
+    # Written to a temporary file and renamed, so a crash never leaves a truncated output
+    output_folder, output_name = os.path.split(output_file)
+    temp_file = os.path.join(output_folder, f".{os.getpid()}_{threading.get_ident()}_{output_name}")
     try:
         verbose_print(f"Saving preprocessed scan to {output_file}...", verbose)
-        preprocessed_scan = nib.Nifti1Image(scan_array, affine)
-        nib.save(preprocessed_scan, output_file)
+        preprocessed_scan = nib.Nifti1Image(scan_array, affine, header)
+        preprocessed_scan.set_data_dtype(scan_array.dtype)
+        nib.save(preprocessed_scan, temp_file)
+        os.replace(temp_file, output_file)
         verbose_print(f"Preprocessed scan saved as {output_file}.", verbose)
     except Exception as e:
         print(f"Failed to save NIfTI file: {e}")
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
 
 def convert_dicom_to_nifti(dicom_directory: str, output_file: str, verbose: bool = False) -> None:
     """
     Converts a DICOM series to NIfTI format.
     """
+    import dicom2nifti
     try:
         dicom2nifti.dicom_series_to_nifti(dicom_directory, output_file)
         verbose_print(f"Converted DICOM to NIfTI: {output_file}", verbose)
     except Exception as e:
         print(f"Error converting {dicom_directory} to NIfTI: {e}")
+        raise
+
+def read_zipped_dicom_series(zip_ref: zipfile.ZipFile, members: List[zipfile.ZipInfo]) -> List["pydicom.Dataset"]:
+    """
+    Reads the DICOM members of a ZIP file into memory, skipping members that are not images.
+    """
+    import pydicom
+    datasets = []
+    for info in members:
+        # Read from a copy in memory, as dicom2nifti copies the datasets with their source
+        with zip_ref.open(info) as dicom_file:
+            try:
+                dataset = pydicom.dcmread(io.BytesIO(dicom_file.read()))
+            except pydicom.errors.InvalidDicomError:
+                continue
+        if "PixelData" in dataset:
+            datasets.append(dataset)
+    return datasets
 
+def read_zipped_dicom_volume(zip_ref: zipfile.ZipFile, members: List[zipfile.ZipInfo]) -> nib.Nifti1Image:
+    """
+    Assembles a DICOM series stored in a ZIP file into an in-memory volume and affine.
+    """
+    import dicom2nifti.convert_dicom
+    datasets = read_zipped_dicom_series(zip_ref, members)
+    # dicom2nifti can only reorient through a file, so the volume is converted as stored and
+    # reoriented here to the LAS orientation its file conversion produces
+    image = dicom2nifti.convert_dicom.dicom_array_to_nifti(datasets, None, reorient_nifti=False)["NII"]
+    orientation = nib.orientations.ornt_transform(nib.orientations.io_orientation(image.affine), nib.orientations.axcodes2ornt("LAS"))
+    image = image.as_reoriented(orientation)
+    image.header.set_slope_inter(1, 0)
+    image.header.set_xyzt_units(2)
+    return image
+
+def convert_zipped_dicom_to_nifti(zip_ref: zipfile.ZipFile, members: List[zipfile.ZipInfo], output_file: str, verbose: bool = False) -> None:
+    """
+    Converts a DICOM series stored in a ZIP file to NIfTI format without extracting it to
+    disk. The file is gzip-compressed only if its name ends with .nii.gz.
+    """
+    try:
+        nib.save(read_zipped_dicom_volume(zip_ref, members), output_file)
+        verbose_print(f"Converted DICOM to NIfTI: {output_file}", verbose)
+    except Exception as e:
+        print(f"Error converting {len(members)} zipped DICOM files to {output_file}: {e}")
+        raise
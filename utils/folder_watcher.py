@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import statistics
+from utils.common import verbose_print
+from typing import Dict, List
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+class FolderWatcher:
+    """
+    Reports the files of a folder once they have stopped growing, i.e. their size and
+    modification time did not change for stable_seconds. With inotify_simple installed,
+    the watcher wakes up as soon as the folder changes; otherwise it polls it.
+    """
+    def __init__(self, folder: str, suffix: str = ".zip", stable_seconds: float = 10, poll_interval: float = 2, verbose: bool = False):
+        self.folder = folder
+        self.suffix = suffix
+        self.stable_seconds = stable_seconds
+        self.poll_interval = poll_interval
+        self.verbose = verbose
+        # Path -> (size, mtime_ns, time of the last change, time first seen)
+        self.candidates = {}
+        # Path -> (size, mtime_ns) of the files already reported
+        self.reported = {}
+        self.inotify = None
+        if INotify is not None:
+            try:
+                self.inotify = INotify()
+                self.inotify.add_watch(folder, flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO | flags.DELETE | flags.MOVED_FROM)
+            except OSError as e:
+                verbose_print(f"inotify unavailable ({e}), polling {folder} instead.", verbose)
+                self.inotify = None
+
+    def close(self) -> None:
+        if self.inotify is not None:
+            self.inotify.close()
+
+    def __enter__(self) -> "FolderWatcher":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def wait(self) -> None:
+        """
+        Blocks until the folder changes, or for at most one poll interval.
+        """
+        if self.inotify is not None:
+            self.inotify.read(timeout=int(self.poll_interval * 1000))
+        else:
+            time.sleep(self.poll_interval)
+
+    def ready(self) -> List[Dict[str, float]]:
+        """
+        Returns the newly stable files as {"path", "arrived"} records, arrival being the
+        time the file was first seen, in order of arrival.
+        """
+        now = time.time()
+        present = set()
+        for entry in os.scandir(self.folder):
+            if not entry.is_file() or not entry.name.endswith(self.suffix) or entry.name.startswith("."):
+                continue
+            present.add(entry.path)
+            stat = entry.stat()
+            # A reported file that changes afterwards (e.g. replaced) is reported again
+            if self.reported.get(entry.path) == (stat.st_size, stat.st_mtime_ns):
+                continue
+            self.reported.pop(entry.path, None)
+            size, mtime_ns, changed, arrived = self.candidates.get(entry.path, (None, None, now, now))
+            if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                changed = now
+            self.candidates[entry.path] = (stat.st_size, stat.st_mtime_ns, changed, arrived)
+
+        ready = []
+        for path, (size, mtime_ns, changed, arrived) in list(self.candidates.items()):
+            if path not in present:
+                del self.candidates[path]
+            elif now - changed >= self.stable_seconds:
+                del self.candidates[path]
+                self.reported[path] = (size, mtime_ns)
+                ready.append({"path": path, "arrived": arrived})
+        # Files that were removed are reported again when they reappear
+        self.reported = {path: stat for path, stat in self.reported.items() if path in present}
+        return sorted(ready, key=lambda record: record["arrived"])
+
+    @property
+    def growing(self) -> int:
+        return len(self.candidates)
+
+class WatchStatus:
+    """
+    Status file of the watch-folder daemon: queue depth, the case in progress and the
+    latency from arrival to finished output, rewritten atomically on every change.
+    """
+    def __init__(self, status_path: str, history: int = 100):
+        self.status_path = status_path
+        self.history = history
+        self.latencies = []
+        self.status = {"started": time.time(), "growing": 0, "queued": 0, "processing": None, "processed": 0, "failed": 0}
+
+    def update(self, **fields) -> None:
+        self.status.update(fields)
+        self.write()
+
+    def finished(self, case_name: str, arrived: float, failed: bool) -> None:
+        """
+        Records a finished case and its latency from arrival.
+        """
+        latency = time.time() - arrived
+        self.latencies = (self.latencies + [latency])[-self.history:]
+        self.status["processed"] += 1
+        self.status["failed"] += int(failed)
+        self.status["processing"] = None
+        self.status["last_case"] = {"case": case_name, "latency_s": round(latency, 1), "failed": failed}
+        self.status["latency_s"] = {
+            "median": round(statistics.median(self.latencies), 1),
+            "max": round(max(self.latencies), 1),
+        }
+        self.write()
+
+    def write(self) -> None:
+        self.status["updated"] = time.time()
+        os.makedirs(os.path.dirname(os.path.abspath(self.status_path)), exist_ok=True)
+        temp_path = f"{self.status_path}.tmp{os.getpid()}"
+        with open(temp_path, "w") as f:
+            json.dump(self.status, f, indent=4)
+        os.replace(temp_path, self.status_path)
@@ -0,0 +1,192 @@
+import os
+import json
+import argparse
+import numpy as np
+from utils.case_summary import load_case_summaries
+from typing import TYPE_CHECKING, Iterable, Optional, Tuple
+
+if TYPE_CHECKING:
+    import torch
+
+# Quantiles stored with every set of statistics, enough to choose a window from
+QUANTILES = (0.001, 0.005, 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 0.995, 0.999)
+
+class HUStatistics:
+    """
+    Mergeable streaming statistics of HU values: the count, mean and variance (combined
+    with Chan's parallel update), the extremes and a fixed-bin histogram over [low, high)
+    from which quantiles are read, exact to the bin width. Statistics of slabs, cases and
+    workers combine with merge, giving the same result in any order.
+    """
+    def __init__(self, low: float = -1024, high: float = 3072, bins: int = 4096):
+        self.low = float(low)
+        self.high = float(high)
+        self.bins = int(bins)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = float("inf")
+        self.maximum = float("-inf")
+        self.histogram = np.zeros(self.bins, dtype=np.int64)
+        self.below = 0
+        self.above = 0
+
+    def add_moments(self, count: int, mean: float, m2: float, minimum: float, maximum: float) -> None:
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.minimum = min(self.minimum, minimum)
+        self.maximum = max(self.maximum, maximum)
+
+    def update(self, tensor: "torch.Tensor", mask: Optional["torch.Tensor"] = None, slab: int = 16) -> None:
+        """
+        Adds the values of a tensor, or only those inside a boolean mask of the same shape,
+        slab by slab along the first axis so that the temporary copies stay small.
+        """
+        import torch
+        for start in range(0, tensor.shape[0], slab):
+            values = tensor[start:start + slab]
+            values = values[mask[start:start + slab].to(values.device)] if mask is not None else values.reshape(-1)
+            if values.numel() == 0:
+                continue
+            values_64 = values.to(torch.float64)
+            mean = values_64.mean()
+            self.add_moments(values.numel(), mean.item(), ((values_64 - mean) ** 2).sum().item(), values.min().item(), values.max().item())
+            del values_64
+            # histc counts values equal to high in the last bin, those are moved to above
+            at_high = int((values == self.high).sum().item())
+            histogram = torch.histc(values.float(), bins=self.bins, min=self.low, max=self.high).cpu().numpy().astype(np.int64)
+            histogram[-1] -= at_high
+            self.histogram += histogram
+            self.below += int((values < self.low).sum().item())
+            self.above += int((values >= self.high).sum().item())
+
+    def merge(self, other: "HUStatistics") -> "HUStatistics":
+        if (self.low, self.high, self.bins) != (other.low, other.high, other.bins):
+            raise ValueError(f"Cannot merge histograms over [{self.low}, {self.high}) in {self.bins} bins and [{other.low}, {other.high}) in {other.bins} bins")
+        self.add_moments(other.count, other.mean, other.m2, other.minimum, other.maximum)
+        self.histogram += other.histogram
+        self.below += other.below
+        self.above += other.above
+        return self
+
+    @property
+    def std(self) -> float:
+        return float(np.sqrt(self.m2 / self.count)) if self.count else float("nan")
+
+    def quantile(self, q: float) -> float:
+        """
+        Reads a quantile from the histogram, interpolating linearly inside its bin.
+        Quantiles below low or above high are clamped to the extremes.
+        """
+        if self.count == 0:
+            return float("nan")
+        target = q * self.count
+        if target <= self.below:
+            return self.minimum
+        cumulative = np.cumsum(self.histogram) + self.below
+        index = int(np.searchsorted(cumulative, target))
+        if index >= self.bins:
+            return self.maximum
+        previous = cumulative[index - 1] if index > 0 else self.below
+        width = (self.high - self.low) / self.bins
+        value = self.low + (index + (target - previous) / max(self.histogram[index], 1)) * width
+        return float(min(max(value, self.minimum), self.maximum))
+
+    def to_dict(self) -> dict:
+        nonzero = np.nonzero(self.histogram)[0]
+        first, last = (int(nonzero[0]), int(nonzero[-1]) + 1) if len(nonzero) else (0, 0)
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "std": self.std,
+            "m2": self.m2,
+            "min": self.minimum if self.count else None,
+            "max": self.maximum if self.count else None,
+            "quantiles": {str(q): self.quantile(q) for q in QUANTILES},
+            # The histogram is stored from its first to its last non-empty bin
+            "histogram": {
+                "low": self.low, "high": self.high, "bins": self.bins, "below": self.below, "above": self.above,
+                "first_bin": first, "counts": self.histogram[first:last].tolist(),
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "HUStatistics":
+        histogram = data["histogram"]
+        statistics = cls(histogram["low"], histogram["high"], histogram["bins"])
+        statistics.count = data["count"]
+        statistics.mean = data["mean"]
+        statistics.m2 = data["m2"]
+        statistics.minimum = data["min"] if data["min"] is not None else float("inf")
+        statistics.maximum = data["max"] if data["max"] is not None else float("-inf")
+        statistics.histogram[histogram["first_bin"]:histogram["first_bin"] + len(histogram["counts"])] = histogram["counts"]
+        statistics.below = histogram["below"]
+        statistics.above = histogram["above"]
+        return statistics
+
+def statistics_from_config(config: dict) -> HUStatistics:
+    low, high = config.get("hu_histogram_range", (-1024, 3072))
+    return HUStatistics(low, high, config.get("hu_histogram_bins", 4096))
+
+def merge_case_statistics(summaries: Iterable[dict]) -> Tuple[Optional[HUStatistics], int]:
+    """
+    Merges the HU statistics of case summaries. Returns the merged statistics (None if no
+    case has any) and the number of cases merged.
+    """
+    merged, cases = None, 0
+    for summary in summaries:
+        if "hu_statistics" not in summary:
+            continue
+        case_statistics = HUStatistics.from_dict(summary["hu_statistics"])
+        merged = case_statistics if merged is None else merged.merge(case_statistics)
+        cases += 1
+    return merged, cases
+
+def write_dataset_statistics(summary_folder: str, output_path: str) -> Optional[dict]:
+    """
+    Merges the HU statistics of every case summary in the folder into the dataset-wide
+    statistics, with a compact per-case table for outlier checks, and writes them to
+    output_path. Cases of earlier runs and other nodes are included, since their
+    summaries live in the same folder.
+    """
+    summaries = load_case_summaries(summary_folder)
+    merged, cases = merge_case_statistics(summaries.values())
+    if merged is None:
+        return None
+    dataset = dict(merged.to_dict(), cases=cases)
+    dataset["per_case"] = {
+        case_name: dict(
+            {key: summary["hu_statistics"][key] for key in ("count", "mean", "std", "min", "max")},
+            p01=summary["hu_statistics"]["quantiles"]["0.01"], p99=summary["hu_statistics"]["quantiles"]["0.99"]
+        )
+        for case_name, summary in summaries.items() if "hu_statistics" in summary
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    temp_path = f"{output_path}.tmp{os.getpid()}"
+    with open(temp_path, "w") as f:
+        json.dump(dataset, f, indent=4)
+    os.replace(temp_path, output_path)
+    return dataset
+
+def dataset_statistics_path(config: dict) -> str:
+    return config.get("hu_statistics_path") or os.path.join(config["output_folder"], "hu_statistics.json")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merges the per-case HU statistics into dataset-wide statistics.")
+    parser.add_argument("summary_folder", help="Folder of the case summaries")
+    parser.add_argument("--output", default="hu_statistics.json")
+    args = parser.parse_args()
+
+    dataset = write_dataset_statistics(args.summary_folder, args.output)
+    if dataset is None:
+        print(f"No HU statistics found in {args.summary_folder}")
+    else:
+        quantiles = dataset["quantiles"]
+        print(f"{dataset['cases']} cases, {dataset['count']} voxels: mean {dataset['mean']:.1f} HU, std {dataset['std']:.1f} HU")
+        print(f"0.5%-99.5% window: [{quantiles['0.005']:.0f}, {quantiles['0.995']:.0f}] HU")
+        print(f"Statistics saved to {args.output}")
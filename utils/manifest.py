@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from utils.common import sqlite_journal_mode
+from typing import List, Optional
+
+STAGES = ["dicom_conversion", "segmentation", "final_output"]
+
+def files_fingerprint(paths: List[str]) -> str:
+    """
+    Fingerprints input files by their path, size and modification time.
+    """
+    description = []
+    for path in paths:
+        stat = os.stat(path)
+        description.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha256(json.dumps(description).encode()).hexdigest()
+
+def stage_config_hash(config: dict, stage: str, case_name: Optional[str] = None) -> str:
+    """
+    Hashes the subset of the config a pipeline stage depends on.
+    """
+    roi_labels = sorted(set((bound["label"], bound["task"]) for bound in config.get("roi_bounds", {}).values()))
+    scan_choice = config.get("scan_choice", {})
+    if stage == "dicom_conversion":
+        subset = {"segment": scan_choice.get(f"{case_name}-SEGMENT"), "scan": scan_choice.get(f"{case_name}-SCAN")}
+    elif stage == "segmentation":
+        subset = {"labels": roi_labels, "backend": config.get("segmentation_backend", "totalsegmentator")}
+    elif stage == "final_output":
+        subset = {key: config.get(key) for key in ("target_shape", "min_hu", "max_hu", "roi_bounds", "output_backend", "pyramid_shapes", "downsample_mode", "mask_resample_mode", "mask_resample_threshold", "packed_store_dtype")}
+    else:
+        raise ValueError(f"Unknown pipeline stage: {stage}")
+    return hashlib.sha256(json.dumps(subset, sort_keys=True, default=str).encode()).hexdigest()
+
+class PipelineManifest:
+    """
+    SQLite record of every pipeline stage per case, with the input fingerprint and the
+    config hash it ran with, so reruns only recompute the stages that are stale.
+    """
+    def __init__(self, manifest_path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+        # A case's manifest is handed between the loader, compute and writer threads
+        self.connection = sqlite3.connect(manifest_path, timeout=60, check_same_thread=False)
+        self.connection.execute(f"PRAGMA journal_mode={sqlite_journal_mode(manifest_path)}")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS stages ("
+            "case_name TEXT, stage TEXT, input_fingerprint TEXT, config_hash TEXT, "
+            "status TEXT, updated REAL, PRIMARY KEY (case_name, stage))"
+        )
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "PipelineManifest":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def record(self, case_name: str, stage: str) -> Optional[dict]:
+        """
+        Returns the stored record of a stage, or None if the stage never ran.
+        """
+        row = self.connection.execute(
+            "SELECT input_fingerprint, config_hash, status FROM stages WHERE case_name = ? AND stage = ?",
+            (case_name, stage)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"input_fingerprint": row[0], "config_hash": row[1], "status": row[2]}
+
+    def is_fresh(self, case_name: str, stage: str, input_fingerprint: str, config_hash: str) -> bool:
+        """
+        Checks if a stage completed with the same inputs and config.
+        """
+        record = self.record(case_name, stage)
+        return (
+            record is not None
+            and record["status"] == "done"
+            and record["input_fingerprint"] == input_fingerprint
+            and record["config_hash"] == config_hash
+        )
+
+    def mark(self, case_name: str, stage: str, status: str, input_fingerprint: str = "", config_hash: str = "") -> None:
+        """
+        Stores the status ("running", "done" or "failed") of a stage.
+        """
+        self.connection.execute(
+            "INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?)",
+            (case_name, stage, input_fingerprint, config_hash, status, time.time())
+        )
+        self.connection.commit()
+
+    def invalidate(self, case_name: str, stages: Optional[List[str]] = None) -> None:
+        """
+        Forgets the records of the given stages of a case, or of all its stages.
+        """
+        if stages is None:
+            self.connection.execute("DELETE FROM stages WHERE case_name = ?", (case_name,))
+        for stage in stages or []:
+            self.connection.execute("DELETE FROM stages WHERE case_name = ? AND stage = ?", (case_name, stage))
+        self.connection.commit()
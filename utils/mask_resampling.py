@@ -0,0 +1,86 @@
+import os
+import json
+import hashlib
+import numpy as np
+import nibabel as nib
+import scipy.ndimage
+from utils.common import verbose_print
+from utils.compact_mask import CompactMask
+from typing import Tuple
+
+CACHE_FOLDER = ".resampled_masks"
+
+def resample_mask_to_box(mask: CompactMask, mask_affine: np.ndarray, target_affine: np.ndarray, box: Tuple[int, int, int, int, int, int], mode: str = "linear", threshold: float = 0.0, slab_size: int = 16) -> CompactMask:
+    """
+    Resamples a compact mask onto a box (x_min, x_max, y_min, y_max, z_min, z_max) of a
+    target grid, evaluating only the voxels inside the box, a slab of slices at a time.
+    In "nearest" mode each voxel takes the label of the nearest mask voxel; in "linear"
+    mode the mask is trilinearly interpolated and voxels above the threshold are kept.
+    Returns a compact mask on the grid of the box.
+    """
+    box_shape = (box[1] - box[0], box[3] - box[2], box[5] - box[4])
+    result = np.zeros(box_shape, dtype=bool)
+    if mask.empty:
+        return CompactMask.from_array(result)
+
+    # Crop of the mask padded with one empty voxel so interpolation at its edges sees zeros
+    crop = np.pad(mask.crop(), 1).astype(np.float32 if mode == "linear" else bool)
+    crop_origin = np.array(mask.offset) - 1
+
+    # Target voxel -> mask voxel, relative to the padded crop
+    transform = np.linalg.inv(mask_affine) @ target_affine
+    x = np.arange(box[0], box[1], dtype=np.float32)
+    y = np.arange(box[2], box[3], dtype=np.float32)
+    for slab_start in range(box[4], box[5], slab_size):
+        z = np.arange(slab_start, min(slab_start + slab_size, box[5]), dtype=np.float32)
+        grid = np.stack(np.meshgrid(x, y, z, indexing="ij"), axis=0).reshape(3, -1)
+        coords = transform[:3, :3].astype(np.float32) @ grid + transform[:3, 3:].astype(np.float32) - crop_origin[:, None]
+        if mode == "nearest":
+            indices = np.rint(coords).astype(np.int64)
+            inside = np.all((indices >= 0) & (indices < np.array(crop.shape)[:, None]), axis=0)
+            values = np.zeros(indices.shape[1], dtype=bool)
+            values[inside] = crop[indices[0, inside], indices[1, inside], indices[2, inside]]
+        elif mode == "linear":
+            values = scipy.ndimage.map_coordinates(crop, coords, order=1, mode="constant", cval=0.0) > threshold
+        else:
+            raise ValueError(f"Unknown mask resampling mode: {mode}")
+        result[:, :, slab_start - box[4]:slab_start - box[4] + len(z)] = values.reshape(len(x), len(y), len(z))
+    return CompactMask.from_array(result, pack=mask.packed)
+
+def resampled_mask_key(mask_hash: str, target_affine: np.ndarray, box: Tuple[int, int, int, int, int, int], mode: str, threshold: float) -> str:
+    """
+    Computes the cache key of a resampled mask.
+    """
+    description = json.dumps({
+        "mask": mask_hash,
+        "affine": np.round(np.asarray(target_affine, dtype=np.float64), 6).tolist(),
+        "box": [int(bound) for bound in box],
+        "mode": mode,
+        "threshold": threshold,
+    }, sort_keys=True)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+def load_resampled_mask(mask_path: str, mask_hash: str, target_affine: np.ndarray, box: Tuple[int, int, int, int, int, int], mode: str = "linear", threshold: float = 0.0, pack: bool = False, verbose: bool = False) -> CompactMask:
+    """
+    Returns a mask resampled onto a box of the target grid, from a cache next to the mask
+    keyed by the mask's content hash, the target affine and the box. The mask file is only
+    opened on a cache miss.
+    """
+    cache_folder = os.path.join(os.path.dirname(mask_path), CACHE_FOLDER)
+    cache_path = os.path.join(cache_folder, f"{resampled_mask_key(mask_hash, target_affine, box, mode, threshold)}.npz")
+    if os.path.exists(cache_path):
+        try:
+            verbose_print(f"Loading resampled mask from {cache_path}...", verbose)
+            return CompactMask.load(cache_path, pack=pack)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    verbose_print(f"Resampling {mask_path} onto the crop box...", verbose)
+    mask_img = nib.load(mask_path, mmap=True)
+    resampled = resample_mask_to_box(CompactMask.from_nifti(mask_img, pack=pack), mask_img.affine, target_affine, box, mode=mode, threshold=threshold)
+
+    os.makedirs(cache_folder, exist_ok=True)
+    temp_path = f"{cache_path}.{os.getpid()}.npz"
+    resampled.save(temp_path)
+    os.replace(temp_path, cache_path)
+    return resampled
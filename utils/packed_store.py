@@ -0,0 +1,167 @@
+import os
+import json
+import sqlite3
+import argparse
+import numpy as np
+import nibabel as nib
+from typing import Dict, Optional, Tuple
+
+INDEX_FILENAME = "index.sqlite"
+
+# Value range of the preprocessed volumes, which are normalized to [0, 1]
+QUANTIZED_RANGES = {"uint8": (0.0, 1.0 / 255), "int16": (0.0, 1.0 / 32767)}
+
+class PackedVolumeStore:
+    """
+    Sharded store of fixed-shape volumes in memory-mappable .npy files, with an SQLite
+    index of case name, shard, offset and affine. Volumes can be kept as float32, float16,
+    or as uint8/int16 with a scale factor and offset. A case only counts as stored once
+    its volume is flushed to the shard and its index row is marked complete.
+    """
+    def __init__(self, root: str, volume_shape: Optional[Tuple[int, int, int]] = None, dtype: str = "float32", shard_capacity: int = 256):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.connection = sqlite3.connect(os.path.join(root, INDEX_FILENAME), timeout=60)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS volumes (case_name TEXT PRIMARY KEY, shard INTEGER, offset INTEGER, affine TEXT, complete INTEGER)")
+        # Volumes of stores created before the complete flag existed were all written
+        if "complete" not in [column[1] for column in self.connection.execute("PRAGMA table_info(volumes)")]:
+            self.connection.execute("ALTER TABLE volumes ADD COLUMN complete INTEGER DEFAULT 1")
+        self.connection.commit()
+
+        metadata = self.read_metadata()
+        if not metadata:
+            if volume_shape is None:
+                raise ValueError(f"No packed store found in {root} and no volume shape given to create one")
+            offset, scale = QUANTIZED_RANGES.get(dtype, (0.0, 1.0))
+            metadata = {"volume_shape": list(volume_shape), "dtype": dtype, "shard_capacity": shard_capacity, "offset": offset, "scale": scale}
+            with self.connection:
+                self.connection.executemany("INSERT OR IGNORE INTO metadata VALUES (?, ?)", [(key, json.dumps(value)) for key, value in metadata.items()])
+            metadata = self.read_metadata()
+        elif volume_shape is not None and tuple(metadata["volume_shape"]) != tuple(volume_shape):
+            raise ValueError(f"Packed store {root} holds volumes of shape {metadata['volume_shape']}, not {volume_shape}")
+        elif volume_shape is not None and metadata["dtype"] != dtype:
+            raise ValueError(f"Packed store {root} holds volumes of dtype {metadata['dtype']}, not {dtype}")
+
+        self.volume_shape = tuple(metadata["volume_shape"])
+        self.dtype = np.dtype(metadata["dtype"])
+        self.shard_capacity = metadata["shard_capacity"]
+        self.offset = metadata["offset"]
+        self.scale = metadata["scale"]
+        self.shards = {}
+
+    def read_metadata(self) -> dict:
+        return {key: json.loads(value) for key, value in self.connection.execute("SELECT key, value FROM metadata")}
+
+    def close(self) -> None:
+        self.shards.clear()
+        self.connection.close()
+
+    def __enter__(self) -> "PackedVolumeStore":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def shard_path(self, shard: int) -> str:
+        return os.path.join(self.root, f"shard_{shard:05d}.npy")
+
+    def shard(self, shard: int, writable: bool = False) -> np.memmap:
+        """
+        Opens a shard as a memory map, creating it on first write.
+        """
+        key = (shard, writable)
+        if key not in self.shards:
+            path = self.shard_path(shard)
+            if writable and not os.path.exists(path):
+                np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=(self.shard_capacity,) + self.volume_shape).flush()
+            self.shards[key] = np.load(path, mmap_mode="r+" if writable else "r")
+        return self.shards[key]
+
+    def contains(self, case_name: str) -> bool:
+        return self.connection.execute("SELECT 1 FROM volumes WHERE case_name = ? AND complete = 1", (case_name,)).fetchone() is not None
+
+    def quantize(self, volume: np.ndarray) -> np.ndarray:
+        """
+        Converts a float volume to the storage dtype.
+        """
+        if self.dtype.kind in "iu":
+            info = np.iinfo(self.dtype)
+            return np.clip(np.rint((volume - self.offset) / self.scale), info.min, info.max).astype(self.dtype)
+        return volume.astype(self.dtype)
+
+    def dequantize(self, stored: np.ndarray) -> np.ndarray:
+        """
+        Converts a stored volume back to float32.
+        """
+        if self.dtype.kind in "iu":
+            return stored.astype(np.float32) * np.float32(self.scale) + np.float32(self.offset)
+        return stored.astype(np.float32)
+
+    def append(self, case_name: str, volume: np.ndarray, affine: np.ndarray) -> Tuple[int, int]:
+        """
+        Writes a volume to the next free slot, or over the slot the case already has.
+        Returns the shard and offset it was written to. The slot is reserved first and only
+        marked complete after the volume is flushed, so a crash in between leaves the case
+        to be written again instead of pointing at an unwritten slot.
+        """
+        if tuple(volume.shape) != self.volume_shape:
+            raise ValueError(f"Volume of shape {volume.shape} does not fit the store shape {self.volume_shape}")
+
+        # The slot is reserved inside a write transaction so concurrent writers never share it
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            row = self.connection.execute("SELECT shard, offset FROM volumes WHERE case_name = ?", (case_name,)).fetchone()
+            if row is None:
+                count = self.connection.execute("SELECT COUNT(*) FROM volumes").fetchone()[0]
+                row = divmod(count, self.shard_capacity)
+            shard, offset = row
+            self.connection.execute("INSERT OR REPLACE INTO volumes VALUES (?, ?, ?, ?, 0)", (case_name, shard, offset, json.dumps(np.asarray(affine).tolist())))
+            # Shards are created under the lock as well
+            data = self.shard(shard, writable=True)
+        data[offset] = self.quantize(volume)
+        data.flush()
+        with self.connection:
+            self.connection.execute("UPDATE volumes SET complete = 1 WHERE case_name = ?", (case_name,))
+        return shard, offset
+
+    def location(self, case_name: str) -> Tuple[int, int, np.ndarray]:
+        row = self.connection.execute("SELECT shard, offset, affine FROM volumes WHERE case_name = ? AND complete = 1", (case_name,)).fetchone()
+        if row is None:
+            raise KeyError(f"Case {case_name} is not in the packed store {self.root}")
+        return row[0], row[1], np.array(json.loads(row[2]))
+
+    def load(self, case_name: str, dequantize: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns a volume and its affine. The volume is a zero-copy view into the shard,
+        in the storage dtype unless it is dequantized to float32.
+        """
+        shard, offset, affine = self.location(case_name)
+        volume = self.shard(shard)[offset]
+        return (self.dequantize(volume) if dequantize else volume), affine
+
+    def index(self) -> Dict[str, Tuple[int, int]]:
+        return {case_name: (shard, offset) for case_name, shard, offset in self.connection.execute("SELECT case_name, shard, offset FROM volumes WHERE complete = 1 ORDER BY case_name")}
+
+def export_nifti(store_root: str, case_name: str, output_file: str) -> None:
+    """
+    Exports one case of a packed store as a NIfTI file.
+    """
+    with PackedVolumeStore(store_root) as store:
+        volume, affine = store.load(case_name, dequantize=True)
+        nib.save(nib.Nifti1Image(volume, affine), output_file)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports cases of a packed volume store as NIfTI files.")
+    parser.add_argument("store_root")
+    parser.add_argument("case_names", nargs="*", help="Cases to export, all cases if omitted")
+    parser.add_argument("--output-folder", default=".")
+    args = parser.parse_args()
+
+    with PackedVolumeStore(args.store_root) as store:
+        case_names = args.case_names or list(store.index())
+    os.makedirs(args.output_folder, exist_ok=True)
+    for case_name in case_names:
+        output_file = os.path.join(args.output_folder, f"{case_name}_NORMAL.nii.gz")
+        export_nifti(args.store_root, case_name, output_file)
+        print(f"Exported {case_name} to {output_file}")
@@ -0,0 +1,154 @@
+import os
+import io
+import csv
+import json
+import time
+import pstats
+import cProfile
+import resource
+import tracemalloc
+from contextlib import contextmanager
+from typing import List, Optional
+
+def array_nbytes(array) -> int:
+    """
+    Returns the size in bytes of a NumPy array or torch tensor.
+    """
+    if hasattr(array, "nbytes"):
+        return int(array.nbytes)
+    if hasattr(array, "element_size"):
+        return int(array.element_size() * array.nelement())
+    return 0
+
+def reset_peak_rss() -> bool:
+    """
+    Resets the peak resident set size of this process (Linux only). Returns False when
+    the peak cannot be reset and only the lifetime peak is available.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb() -> float:
+    """
+    Returns the peak resident set size of this process in MB.
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class CaseProfiler:
+    """
+    Records wall time, CPU time, peak RSS and the largest array of every pipeline stage of a case.
+    CPU time is that of the calling thread. Peak RSS is process-wide, so it is only recorded
+    when the case has the process to itself; with shared_process (cases overlapping in
+    threads of one process) it is left out as None.
+    With deep profiling, the case additionally runs under cProfile and tracemalloc.
+    """
+    def __init__(self, case_name: str, deep: bool = False, deep_output_folder: Optional[str] = None, shared_process: bool = False):
+        self.case_name = case_name
+        self.records = []
+        self.deep = deep
+        self.deep_output_folder = deep_output_folder
+        self.shared_process = shared_process
+        self.current = None
+        self.profile = None
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Measures the enclosed pipeline stage. A nested stage resets the peak RSS, so the
+        peak its enclosing stage reached so far is kept in the enclosing record first.
+        """
+        record = {"case": self.case_name, "stage": name, "largest_array_mb": 0.0, "peak_rss_mb": 0.0}
+        parent, self.current = self.current, record
+        if not self.shared_process:
+            if parent is not None:
+                parent["peak_rss_mb"] = max(parent["peak_rss_mb"], peak_rss_mb())
+            reset_peak_rss()
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield record
+        finally:
+            record["wall_s"] = round(time.perf_counter() - wall_start, 4)
+            record["cpu_s"] = round(time.thread_time() - cpu_start, 4)
+            if self.shared_process:
+                record["peak_rss_mb"] = None
+            else:
+                record["peak_rss_mb"] = round(max(record["peak_rss_mb"], peak_rss_mb()), 1)
+            self.current = parent
+            if parent is not None:
+                parent["largest_array_mb"] = max(parent["largest_array_mb"], record["largest_array_mb"])
+                if record["peak_rss_mb"] is not None:
+                    parent["peak_rss_mb"] = max(parent["peak_rss_mb"], record["peak_rss_mb"])
+            self.records.append(record)
+
+    def note(self, *arrays) -> None:
+        """
+        Registers arrays allocated by the current stage.
+        """
+        if self.current is None:
+            return
+        for array in arrays:
+            self.current["largest_array_mb"] = max(self.current["largest_array_mb"], round(array_nbytes(array) / 1024**2, 1))
+
+    def start_deep(self) -> None:
+        """
+        Starts cProfile and tracemalloc for a single-case deep dive.
+        """
+        if not self.deep:
+            return
+        tracemalloc.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop_deep(self) -> None:
+        """
+        Stops the deep dive and writes the cProfile statistics and top allocations.
+        """
+        if not self.deep or self.profile is None:
+            return
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        output_folder = self.deep_output_folder or "."
+        os.makedirs(output_folder, exist_ok=True)
+        self.profile.dump_stats(os.path.join(output_folder, f"{self.case_name}.prof"))
+        summary = io.StringIO()
+        pstats.Stats(self.profile, stream=summary).sort_stats("cumulative").print_stats(40)
+        summary.write("\nTop allocations:\n")
+        for statistic in snapshot.statistics("lineno")[:40]:
+            summary.write(f"{statistic}\n")
+        with open(os.path.join(output_folder, f"{self.case_name}_profile.txt"), "w") as f:
+            f.write(summary.getvalue())
+        self.profile = None
+
+def write_profile_report(records: List[dict], report_path: str) -> None:
+    """
+    Appends stage records to a JSONL report, or to a CSV report if the path ends with .csv.
+    """
+    if not records:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+    if report_path.endswith(".csv"):
+        fieldnames = ["case", "stage", "wall_s", "cpu_s", "peak_rss_mb", "largest_array_mb"]
+        write_header = not os.path.exists(report_path)
+        with open(report_path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+            if write_header:
+                writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(report_path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
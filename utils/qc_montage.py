@@ -0,0 +1,212 @@
+import os
+import html
+import json
+import argparse
+import multiprocessing
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from utils.case_summary import load_case_summaries
+from utils.packed_store import INDEX_FILENAME, PackedVolumeStore
+from utils.common import verbose_print
+from typing import List, Optional, Tuple
+
+# Modified z-score (median and MAD based) above which a statistic marks a case as an outlier
+OUTLIER_THRESHOLD = 3.5
+SLICE_STATISTICS = ("mean", "std", "background_fraction")
+CROP_STATISTICS = ("crop_extent_x_mm", "crop_extent_y_mm", "crop_extent_z_mm")
+HU_STATISTICS = ("hu_mean", "hu_std", "hu_p01", "hu_p99")
+
+def list_outputs(source: str) -> List[str]:
+    """
+    Returns the names of the preprocessed outputs of a folder of NIfTI files (file names
+    without extension) or of a packed volume store (case names).
+    """
+    if os.path.exists(os.path.join(source, INDEX_FILENAME)):
+        with PackedVolumeStore(source) as store:
+            return list(store.index())
+    return sorted(
+        f.split(".nii")[0] for f in os.listdir(source)
+        if "_NORMAL" in f and (f.endswith(".nii.gz") or f.endswith(".nii"))
+    )
+
+def case_name_of(output_name: str) -> str:
+    return output_name.split("_NORMAL")[0]
+
+def mid_slices(volume) -> List[np.ndarray]:
+    """
+    Returns the sagittal, coronal and axial slices through the middle of a volume. The
+    volume can be a memory map or a nibabel array proxy, so only the slices are read.
+    """
+    mid_x, mid_y, mid_z = (size // 2 for size in volume.shape[:3])
+    return [
+        np.asarray(volume[mid_x, :, :], dtype=np.float32),
+        np.asarray(volume[:, mid_y, :], dtype=np.float32),
+        np.asarray(volume[:, :, mid_z], dtype=np.float32),
+    ]
+
+def read_output_slices(source: str, output_name: str) -> List[np.ndarray]:
+    """
+    Reads the three mid slices of an output. Packed stores and uncompressed .nii files
+    are memory-mapped; .nii.gz files are decompressed only as far as the slices need.
+    """
+    if os.path.exists(os.path.join(source, INDEX_FILENAME)):
+        with PackedVolumeStore(source) as store:
+            volume, _ = store.load(output_name)
+            return [store.dequantize(np.asarray(slice_data)) for slice_data in mid_slices(volume)]
+    filename = next(f for f in (f"{output_name}.nii", f"{output_name}.nii.gz") if os.path.exists(os.path.join(source, f)))
+    return mid_slices(nib.load(os.path.join(source, filename), mmap=True).dataobj)
+
+def inspect_output(source: str, output_name: str, slice_folder: str) -> dict:
+    """
+    Reads the mid slices of an output, keeps them for the montage and returns their
+    intensity statistics. The statistics come from the three slices only, since reading
+    the whole volume is what the QC pass avoids.
+    """
+    try:
+        slices = read_output_slices(source, output_name)
+    except Exception as e:
+        return {"name": output_name, "case": case_name_of(output_name), "error": str(e)}
+    np.savez(os.path.join(slice_folder, f"{output_name}.npz"), *slices)
+    values = np.concatenate([slice_data.ravel() for slice_data in slices])
+    return {
+        "name": output_name,
+        "case": case_name_of(output_name),
+        "mean": float(values.mean()),
+        "std": float(values.std()),
+        "background_fraction": float(np.mean(values <= values.min())),
+    }
+
+def flag_outliers(records: List[dict], fields: Tuple[str, ...], threshold: float = OUTLIER_THRESHOLD) -> None:
+    """
+    Adds the statistics of every record that deviate from the other records by more than
+    the threshold, as modified z-scores, to its "outliers" list.
+    """
+    for record in records:
+        record.setdefault("outliers", [])
+    for field in fields:
+        values = np.array([record[field] for record in records if record.get(field) is not None], dtype=np.float64)
+        if len(values) < 3:
+            continue
+        median = np.median(values)
+        mad = np.median(np.abs(values - median))
+        if mad == 0:
+            continue
+        for record in records:
+            if record.get(field) is None:
+                continue
+            score = 0.6745 * (record[field] - median) / mad
+            if abs(score) > threshold:
+                record["outliers"].append(f"{field} {record[field]:.3g} (z={score:+.1f})")
+
+def render_page(page_path: str, records: List[dict], slice_folder: str, columns: int = 4, vmin: float = 0.0, vmax: float = 1.0) -> str:
+    """
+    Renders the mid slices of a page of outputs off-screen into one PNG montage, framing
+    and titling the outliers in red.
+    """
+    rows = (len(records) + columns - 1) // columns
+    figure = Figure(figsize=(columns * 6, rows * 2.3), dpi=80)
+    FigureCanvasAgg(figure)
+    for position, record in enumerate(records):
+        row, column = divmod(position, columns)
+        color = "red" if record.get("outliers") or record.get("error") else "black"
+        slices = []
+        if not record.get("error"):
+            with np.load(os.path.join(slice_folder, f"{record['name']}.npz")) as stored:
+                slices = [stored[f"arr_{axis}"] for axis in range(3)]
+        for axis in range(3):
+            ax = figure.add_subplot(rows, columns * 3, row * columns * 3 + column * 3 + axis + 1)
+            ax.set_xticks([])
+            ax.set_yticks([])
+            for spine in ax.spines.values():
+                spine.set_color(color)
+                spine.set_linewidth(3 if color == "red" else 0.5)
+            if slices:
+                ax.imshow(np.rot90(slices[axis]), cmap="gray", vmin=vmin, vmax=vmax, interpolation="nearest")
+            if axis == 1:
+                ax.set_title(record["name"], fontsize=8, color=color)
+    figure.tight_layout()
+    figure.savefig(page_path)
+    return page_path
+
+def write_index(qc_folder: str, pages: List[Tuple[str, List[dict]]]) -> str:
+    """
+    Writes the HTML index of the montage pages, listing the flagged cases first.
+    """
+    lines = ["<!DOCTYPE html>", "<html><head><meta charset='utf-8'><title>CT preprocessing QC</title>",
+             "<style>body{font-family:sans-serif} .flagged{color:#b00} img{max-width:100%} td{padding:2px 8px}</style>",
+             "</head><body>", "<h1>CT preprocessing QC</h1>"]
+    flagged = [(page_path, record) for page_path, records in pages for record in records if record.get("outliers") or record.get("error")]
+    lines.append(f"<h2>Flagged outputs ({len(flagged)} of {sum(len(records) for _, records in pages)})</h2><table>")
+    for page_path, record in flagged:
+        reasons = record.get("error") or "; ".join(record["outliers"])
+        lines.append(f"<tr class='flagged'><td>{html.escape(record['name'])}</td><td>{html.escape(reasons)}</td>"
+                     f"<td><a href='#{html.escape(os.path.basename(page_path))}'>page</a></td></tr>")
+    lines.append("</table>")
+    for page_path, records in pages:
+        page_name = os.path.basename(page_path)
+        names = ", ".join(
+            f"<span class='flagged'>{html.escape(record['name'])}</span>" if record.get("outliers") or record.get("error") else html.escape(record["name"])
+            for record in records
+        )
+        lines.append(f"<h3 id='{html.escape(page_name)}'>{html.escape(page_name)}</h3><p>{names}</p><img src='{html.escape(page_name)}' loading='lazy'>")
+    lines.append("</body></html>")
+    index_path = os.path.join(qc_folder, "index.html")
+    with open(index_path, "w") as f:
+        f.write("\n".join(lines))
+    return index_path
+
+def generate_qc(source: str, qc_folder: str, summary_folder: Optional[str] = None, cases_per_page: int = 24, columns: int = 4, num_workers: int = 1, threshold: float = OUTLIER_THRESHOLD, verbose: bool = False) -> List[dict]:
+    """
+    Builds the QC report of the preprocessed outputs in source: the mid slices of every
+    output are read in a process pool and rendered into montage pages, and outputs whose
+    intensity statistics, crop box or HU statistics (from the case summaries, by default
+    in source/case_summaries) are outliers are flagged in the montages and in index.html.
+    The statistics of every output are written to qc_summary.json.
+    """
+    slice_folder = os.path.join(qc_folder, "slices")
+    os.makedirs(slice_folder, exist_ok=True)
+    output_names = list_outputs(source)
+    verbose_print(f"Inspecting {len(output_names)} outputs...", verbose)
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max(1, num_workers), mp_context=context) as executor:
+        records = list(executor.map(inspect_output, repeat(source), output_names, repeat(slice_folder), chunksize=16))
+
+        summaries = load_case_summaries(summary_folder or os.path.join(source, "case_summaries"))
+        for record in records:
+            summary = summaries.get(record["case"], {})
+            if summary.get("crop_extent_mm") is not None:
+                record.update(zip(CROP_STATISTICS, summary["crop_extent_mm"]))
+            if summary.get("hu_statistics") is not None:
+                hu_statistics = summary["hu_statistics"]
+                record.update(zip(HU_STATISTICS, (hu_statistics["mean"], hu_statistics["std"], hu_statistics["quantiles"]["0.01"], hu_statistics["quantiles"]["0.99"])))
+        flag_outliers([record for record in records if not record.get("error")], SLICE_STATISTICS + CROP_STATISTICS + HU_STATISTICS, threshold)
+
+        page_records = [records[start:start + cases_per_page] for start in range(0, len(records), cases_per_page)]
+        page_paths = [os.path.join(qc_folder, f"page_{number:04d}.png") for number in range(len(page_records))]
+        verbose_print(f"Rendering {len(page_paths)} montage pages...", verbose)
+        list(executor.map(render_page, page_paths, page_records, repeat(slice_folder), repeat(columns)))
+
+    with open(os.path.join(qc_folder, "qc_summary.json"), "w") as f:
+        json.dump(records, f, indent=4)
+    index_path = write_index(qc_folder, list(zip(page_paths, page_records)))
+    flagged = sum(1 for record in records if record.get("outliers") or record.get("error"))
+    verbose_print(f"QC report written to {index_path}, {flagged} outputs flagged.", verbose)
+    return records
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Renders QC montages of the preprocessed outputs and flags outliers.")
+    parser.add_argument("source", help="Folder of preprocessed NIfTI files or packed volume store")
+    parser.add_argument("--qc-folder", default="qc")
+    parser.add_argument("--summaries", default=None, help="Folder of the case summaries (default: source/case_summaries)")
+    parser.add_argument("--cases-per-page", type=int, default=24)
+    parser.add_argument("--columns", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threshold", type=float, default=OUTLIER_THRESHOLD)
+    args = parser.parse_args()
+
+    generate_qc(args.source, args.qc_folder, args.summaries, args.cases_per_page, args.columns, args.workers, args.threshold, verbose=True)
@@ -0,0 +1,145 @@
+import time
+import multiprocessing
+import multiprocessing.connection
+import nibabel as nib
+from utils.common import verbose_print
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Peak memory model of a case: the larger of the segmentation and the preprocessing
+# stage, which never run at the same time, on top of a fixed interpreter and model base
+DEFAULT_MEMORY_MODEL = {
+    "base_mb": 1500,
+    "segmentation_bytes_per_voxel": 24,
+    "ct_bytes_per_voxel": 8,
+}
+
+def nifti_voxels(path: str) -> Optional[int]:
+    """
+    Returns the number of voxels of a NIfTI file from its header, None if it cannot be read.
+    """
+    try:
+        shape = nib.load(path).shape
+    except (OSError, ValueError, nib.filebasedimages.ImageFileError):
+        return None
+    voxels = 1
+    for size in shape:
+        voxels *= int(size)
+    return voxels
+
+def estimate_case_memory(ct_scan_path: str, segmentation_ct_path: str, memory_model: Optional[dict] = None, default_bytes: int = 4 * 1024**3) -> int:
+    """
+    Estimates the peak memory of a case in bytes from the headers of its NIfTI files,
+    without loading any voxel data. Falls back to default_bytes when the files are missing.
+    """
+    model = dict(DEFAULT_MEMORY_MODEL, **(memory_model or {}))
+    ct_voxels = nifti_voxels(ct_scan_path)
+    segmentation_voxels = nifti_voxels(segmentation_ct_path)
+    if ct_voxels is None or segmentation_voxels is None:
+        return default_bytes
+    stage_bytes = max(segmentation_voxels * model["segmentation_bytes_per_voxel"], ct_voxels * model["ct_bytes_per_voxel"])
+    return int(model["base_mb"] * 1024**2 + stage_bytes)
+
+def run_job(connection: multiprocessing.connection.Connection, function: Callable, args: tuple) -> None:
+    """
+    Runs a job in a worker process and sends its outcome back to the scheduler.
+    """
+    try:
+        connection.send(("done", function(*args)))
+    except BaseException as e:
+        connection.send(("exception", f"{type(e).__name__}: {e}"))
+    finally:
+        connection.close()
+
+class AdmissionScheduler:
+    """
+    Runs jobs in their own worker processes, admitting them largest first as long as
+    the sum of their memory estimates stays within the budget. A job that is larger than
+    the budget runs on its own. Jobs that exceed the timeout are killed; jobs whose worker
+    died or raised are retried with a doubled estimate, since the usual cause is running
+    out of memory.
+    """
+    def __init__(
+        self,
+        function: Callable,
+        memory_budget: int,
+        max_workers: int = 1,
+        timeout: Optional[float] = None,
+        retries: int = 1,
+        retry_timeouts: bool = False,
+        poll_interval: float = 1.0,
+        verbose: bool = False,
+    ):
+        self.function = function
+        self.memory_budget = memory_budget
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_timeouts = retry_timeouts
+        self.poll_interval = poll_interval
+        self.verbose = verbose
+        self.context = multiprocessing.get_context("spawn")
+
+    def start(self, key: str, args: tuple) -> Tuple[multiprocessing.Process, multiprocessing.connection.Connection]:
+        receiver, sender = self.context.Pipe(duplex=False)
+        process = self.context.Process(target=run_job, args=(sender, self.function, args), daemon=True)
+        process.start()
+        sender.close()
+        return process, receiver
+
+    def run(self, jobs: List[Tuple[str, tuple, int]], on_outcome: Optional[Callable[[str, dict], None]] = None) -> Dict[str, dict]:
+        """
+        Runs (key, args, memory estimate) jobs and returns the outcome of every job by key:
+        {"status": "done", "result": ...} or {"status": "timeout" | "crashed" | "exception",
+        "error": ...}, with the number of attempts. on_outcome is called as soon as a job
+        has its final outcome.
+        """
+        pending = sorted(([key, args, estimate, 1] for key, args, estimate in jobs), key=lambda job: job[2], reverse=True)
+        running = {}
+        outcomes = {}
+        while pending or running:
+            # Admit the largest pending jobs that fit next to the running ones
+            in_flight = sum(job[2] for job, _, _, _ in running.values())
+            for job in list(pending):
+                if len(running) >= self.max_workers:
+                    break
+                if running and in_flight + job[2] > self.memory_budget:
+                    continue
+                pending.remove(job)
+                process, connection = self.start(job[0], job[1])
+                running[job[0]] = (job, process, connection, time.monotonic())
+                in_flight += job[2]
+                verbose_print(f"Admitted {job[0]} ({job[2] / 1024**3:.1f} GB estimated, {in_flight / 1024**3:.1f} GB in flight, attempt {job[3]})", self.verbose)
+
+            multiprocessing.connection.wait([connection for _, _, connection, _ in running.values()], timeout=self.poll_interval)
+            for key, (job, process, connection, started) in list(running.items()):
+                outcome = None
+                if connection.poll():
+                    try:
+                        status, value = connection.recv()
+                    except EOFError:
+                        status, value = "crashed", None
+                    outcome = {"status": "done", "result": value} if status == "done" else {"status": status, "error": value}
+                elif not process.is_alive():
+                    outcome = {"status": "crashed", "error": f"Worker exited with code {process.exitcode}"}
+                elif self.timeout is not None and time.monotonic() - started > self.timeout:
+                    process.kill()
+                    outcome = {"status": "timeout", "error": f"Exceeded the timeout of {self.timeout:.0f} seconds"}
+                if outcome is None:
+                    continue
+
+                process.join()
+                connection.close()
+                del running[key]
+                if outcome["status"] == "crashed" and outcome["error"] is None:
+                    outcome["error"] = f"Worker exited with code {process.exitcode}"
+                retryable = outcome["status"] in ("crashed", "exception") or (outcome["status"] == "timeout" and self.retry_timeouts)
+                if retryable and job[3] <= self.retries:
+                    verbose_print(f"Retrying {key} after {outcome['status']}: {outcome['error']}", self.verbose)
+                    pending.append([key, job[1], job[2] * 2, job[3] + 1])
+                    pending.sort(key=lambda job: job[2], reverse=True)
+                    continue
+                outcome["attempts"] = job[3]
+                outcomes[key] = outcome
+                if on_outcome is not None:
+                    on_outcome(key, outcome)
+        return outcomes
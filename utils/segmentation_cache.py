@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+from utils.common import verbose_print
+from typing import Dict, List, Optional
+
+PROVENANCE_FILENAME = ".segmentation_provenance.json"
+ENTRY_MANIFEST = "entry.json"
+
+def segmentation_cache_key(input_hash: str, task: str, options: dict) -> str:
+    """
+    Computes the cache key of a segmentation task from the hash of its input CT scan,
+    the task name and its options (fast/fastest flags and ROI subset).
+    """
+    description = json.dumps({"input": input_hash, "task": task, "options": options}, sort_keys=True)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+def read_provenance(segmentation_path: str) -> Dict[str, str]:
+    """
+    Reads the cache key each task's masks in the segmentation folder were produced with.
+    """
+    provenance_path = os.path.join(segmentation_path, PROVENANCE_FILENAME)
+    if not os.path.exists(provenance_path):
+        return {}
+    try:
+        with open(provenance_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def record_provenance(segmentation_path: str, task: str, key: str) -> None:
+    """
+    Records the cache key a task's masks in the segmentation folder were produced with.
+    """
+    provenance = read_provenance(segmentation_path)
+    provenance[task] = key
+    provenance_path = os.path.join(segmentation_path, PROVENANCE_FILENAME)
+    temp_path = f"{provenance_path}.tmp{os.getpid()}"
+    with open(temp_path, 'w') as f:
+        json.dump(provenance, f, indent=4)
+    os.replace(temp_path, provenance_path)
+
+def snapshot_folder(folder: str) -> Dict[str, int]:
+    """
+    Returns the modification time of every file in a folder.
+    """
+    if not os.path.isdir(folder):
+        return {}
+    return {entry.name: entry.stat().st_mtime_ns for entry in os.scandir(folder) if entry.is_file()}
+
+def link_or_copy(source: str, destination: str) -> None:
+    """
+    Hardlinks a file, falling back to a copy across filesystems.
+    """
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+def detach_links(folder: str) -> None:
+    """
+    Replaces the hardlinked files of a folder by private copies, so that rewriting them in
+    place (as nib.save does) cannot write through into a cache entry.
+    """
+    if not os.path.isdir(folder):
+        return
+    for entry in os.scandir(folder):
+        if entry.is_file() and entry.stat().st_nlink > 1:
+            temp_path = f"{entry.path}.tmp{os.getpid()}"
+            shutil.copy2(entry.path, temp_path)
+            os.replace(temp_path, entry.path)
+
+class SegmentationCache:
+    """
+    Content-addressed cache of segmentation masks shared between cases and runs,
+    limited in size with least-recently-used eviction.
+    """
+    def __init__(self, cache_folder: str, max_bytes: int, verbose: bool = False):
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self.verbose = verbose
+        os.makedirs(cache_folder, exist_ok=True)
+
+    def restore(self, key: str, segmentation_path: str) -> bool:
+        """
+        Hardlinks the cached masks of a key into the segmentation folder. Returns False on a miss.
+        """
+        entry_path = os.path.join(self.cache_folder, key)
+        manifest_path = os.path.join(entry_path, ENTRY_MANIFEST)
+        if not os.path.exists(manifest_path):
+            return False
+        try:
+            with open(manifest_path, 'r') as f:
+                files = json.load(f)["files"]
+            os.makedirs(segmentation_path, exist_ok=True)
+            for filename in files:
+                link_or_copy(os.path.join(entry_path, filename), os.path.join(segmentation_path, filename))
+        except (OSError, ValueError, KeyError) as e:
+            verbose_print(f"Segmentation cache entry {key} is unusable: {e}", self.verbose)
+            return False
+        # The entry's mtime is its last use for LRU eviction
+        os.utime(entry_path)
+        verbose_print(f"Segmentation restored from cache entry {key}.", self.verbose)
+        return True
+
+    def store(self, key: str, segmentation_path: str, filenames: List[str]) -> None:
+        """
+        Adds the given masks of the segmentation folder to the cache under a key.
+        """
+        entry_path = os.path.join(self.cache_folder, key)
+        if os.path.exists(entry_path) or not filenames:
+            return
+        temp_path = tempfile.mkdtemp(prefix=f".{key}_", dir=self.cache_folder)
+        try:
+            for filename in filenames:
+                link_or_copy(os.path.join(segmentation_path, filename), os.path.join(temp_path, filename))
+            with open(os.path.join(temp_path, ENTRY_MANIFEST), 'w') as f:
+                json.dump({"files": sorted(filenames), "created": time.time()}, f, indent=4)
+            os.rename(temp_path, entry_path)
+        except OSError:
+            # Another process stored the same key first
+            shutil.rmtree(temp_path, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries until the cache fits in its size limit.
+        """
+        entries = []
+        total_bytes = 0
+        for entry in os.scandir(self.cache_folder):
+            if not entry.is_dir() or entry.name.startswith("."):
+                continue
+            size = sum(item.stat().st_size for item in os.scandir(entry.path) if item.is_file())
+            entries.append((entry.stat().st_mtime, size, entry.path))
+            total_bytes += size
+
+        for _, size, entry_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_bytes -= size
+            verbose_print(f"Evicted segmentation cache entry {os.path.basename(entry_path)}.", self.verbose)
+
+def create_segmentation_cache(config: dict, verbose: bool = False) -> Optional[SegmentationCache]:
+    """
+    Creates the shared segmentation cache if a cache folder is configured.
+    """
+    if not config.get("segmentation_cache_folder"):
+        return None
+    return SegmentationCache(config["segmentation_cache_folder"], int(config.get("segmentation_cache_max_gb", 0) * 1024**3), verbose=verbose)
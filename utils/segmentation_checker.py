@@ -1,11 +1,12 @@
 import os
 from config import config
 
-def check_segmentation_files(segmentation_path: str) -> set:
+def check_segmentation_files(segmentation_path: str, roi_bounds: dict = None) -> set:
     """
     Checks if all required segmentation files are present in the given path.
     """
-    required_segmenations = [bound["label"] for bound in config["roi_bounds"].values()]
+    roi_bounds = roi_bounds if roi_bounds is not None else config["roi_bounds"]
+    required_segmenations = [bound["label"] for bound in roi_bounds.values()]
     
     missing_segmenations = set()
     for label in required_segmenations:
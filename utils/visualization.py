@@ -2,14 +2,18 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 def show_slices(ct_data, z_min, z_max, x_min, x_max):
-    mid_z = (z_max - z_min) // 2
+    """
+    Shows the axial and sagittal slices through the middle of the crop box of a scan.
+    For batches of outputs on a headless machine, use utils.qc_montage instead.
+    """
+    mid_z = z_min + (z_max - z_min) // 2
     plt.figure(figsize=(5, 5))
     plt.imshow(ct_data[:, :, mid_z], cmap="gray")
     plt.axis("off")
     plt.title("Cropped Head & Neck CT Scan")
     plt.show()
 
-    mid_x = (x_max - x_min) // 2
+    mid_x = x_min + (x_max - x_min) // 2
     plt.figure(figsize=(5, 5))
     plt.imshow(ct_data[mid_x, :, :], cmap="gray")
     plt.axis("off")
@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import socket
+import hashlib
+import threading
+from utils.common import verbose_print
+from typing import List, Tuple
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """
+    Parses a shard given as "i/N" into its index and the number of shards.
+    """
+    index, count = (int(part) for part in shard.split("/"))
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard {shard}, expected i/N with 0 <= i < N")
+    return index, count
+
+def in_shard(name: str, shard_index: int, shard_count: int) -> bool:
+    """
+    Assigns a case to a shard by the hash of its name, so the partition does not change
+    when other cases are added or removed.
+    """
+    return int(hashlib.sha256(name.encode()).hexdigest()[:8], 16) % shard_count == shard_index
+
+def default_node_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def node_order(names: List[str], node_id: str) -> List[str]:
+    """
+    Rotates the list of cases by an offset derived from the node id, so that nodes start
+    claiming at different cases instead of all contending for the first ones.
+    """
+    if not names:
+        return []
+    offset = int(hashlib.sha256(node_id.encode()).hexdigest()[:8], 16) % len(names)
+    return names[offset:] + names[:offset]
+
+def node_file(path: str, node_id: str) -> str:
+    """
+    Returns the per-node variant of a report path, e.g. error_log.node1.csv.
+    """
+    root, extension = os.path.splitext(path)
+    return f"{root}.{node_id}{extension}"
+
+def merge_node_file(path: str, node_id: str, lock_timeout: float = 60) -> None:
+    """
+    Appends the per-node variant of a CSV or JSONL report to the report itself and removes
+    it, so that every node merges only its own lines and reports of earlier runs are never
+    merged twice. A lock file serializes the nodes appending to the same report; the CSV
+    header is written only when the report is new.
+    """
+    source_path = node_file(path, node_id)
+    if not os.path.exists(source_path):
+        return
+    with open(source_path, "r") as f:
+        lines = f.read().splitlines()
+    header = None
+    if os.path.splitext(path)[1] == ".csv" and lines:
+        header, lines = lines[0], lines[1:]
+    lines = [line for line in lines if line]
+
+    lock_path = f"{path}.lock"
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            # A lock left behind by a node that died while merging is broken after the timeout
+            try:
+                if time.time() - os.stat(lock_path).st_mtime > lock_timeout:
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(0.1)
+    try:
+        write_header = header is not None and (not os.path.exists(path) or os.path.getsize(path) == 0)
+        with open(path, "a") as f:
+            f.write("".join(line + "\n" for line in ([header] if write_header else []) + lines))
+    finally:
+        os.remove(lock_path)
+    os.remove(source_path)
+
+class WorkClaims:
+    """
+    Claims cases on a shared filesystem so that several nodes never process the same case.
+    A claim is a file created atomically with O_EXCL and kept alive by a heartbeat thread
+    that touches it; a claim whose heartbeat stopped for lease_seconds belongs to a dead
+    node and is taken over. A node whose claim was taken over notices it in the heartbeat
+    or through holds, and never removes or renews a claim it does not own. Finished cases
+    get a .done marker holding a key, typically the config hash and input fingerprint of
+    the case, and are only skipped while their key is unchanged, so a config or input
+    change makes them claimable again.
+    """
+    def __init__(self, claims_folder: str, node_id: str, lease_seconds: float = 300, heartbeat_seconds: float = 30, verbose: bool = False):
+        os.makedirs(claims_folder, exist_ok=True)
+        self.claims_folder = claims_folder
+        self.node_id = node_id
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.verbose = verbose
+        self.held = set()
+        self.lost = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self.beat, daemon=True)
+
+    def __enter__(self) -> "WorkClaims":
+        self.heartbeat.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.stopped.set()
+        self.heartbeat.join()
+        for name in list(self.held):
+            self.release(name)
+
+    def claim_path(self, name: str) -> str:
+        return os.path.join(self.claims_folder, f"{name}.claim")
+
+    def done_path(self, name: str) -> str:
+        return os.path.join(self.claims_folder, f"{name}.done")
+
+    def is_done(self, name: str, key: str = "") -> bool:
+        try:
+            with open(self.done_path(name), "r") as f:
+                return json.load(f).get("key", "") == key
+        except (OSError, ValueError):
+            return False
+
+    def owns(self, name: str) -> bool:
+        """
+        Checks if the claim file of a case exists and names this node.
+        """
+        try:
+            with open(self.claim_path(name), "r") as f:
+                return json.load(f).get("node") == self.node_id
+        except (OSError, ValueError):
+            return False
+
+    def holds(self, name: str) -> bool:
+        """
+        Checks if this node still holds the claim of a case, i.e. it was not lost to a
+        node that took it over as stale.
+        """
+        with self.lock:
+            if name in self.lost or name not in self.held:
+                return False
+        if self.owns(name):
+            return True
+        self.mark_lost(name)
+        return False
+
+    def mark_lost(self, name: str) -> None:
+        with self.lock:
+            self.held.discard(name)
+            self.lost.add(name)
+        verbose_print(f"Claim of {name} was lost by {self.node_id}", self.verbose)
+
+    def beat(self) -> None:
+        """
+        Touches the held claims until the claims are closed. Claims now owned by another
+        node are marked lost instead of being renewed.
+        """
+        while not self.stopped.wait(self.heartbeat_seconds):
+            with self.lock:
+                held = list(self.held)
+            for name in held:
+                if not self.owns(name):
+                    self.mark_lost(name)
+                    continue
+                try:
+                    os.utime(self.claim_path(name))
+                except FileNotFoundError:
+                    self.mark_lost(name)
+
+    def take_over_stale(self, name: str) -> bool:
+        """
+        Removes the claim of a case if its lease expired. Returns False if it is still alive.
+        """
+        path = self.claim_path(name)
+        try:
+            if time.time() - os.stat(path).st_mtime < self.lease_seconds:
+                return False
+        except FileNotFoundError:
+            return True
+
+        # Renaming is atomic, so only one node moves the stale claim away
+        stale_path = f"{path}.stale.{self.node_id}"
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return True
+        # Another node may have renewed the claim between the check and the rename,
+        # in which case it is put back unless a new claim exists already
+        if time.time() - os.stat(stale_path).st_mtime < self.lease_seconds:
+            try:
+                os.link(stale_path, path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        verbose_print(f"Took over the stale claim of {name}", self.verbose)
+        return True
+
+    def claim(self, name: str, key: str = "") -> bool:
+        """
+        Claims a case for this node. Returns False if the case is done with the same key
+        or claimed elsewhere. The done marker is checked again once the claim is created,
+        since another node may have finished and released the case in between.
+        """
+        if self.is_done(name, key):
+            return False
+        for _ in range(2):
+            try:
+                fd = os.open(self.claim_path(name), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self.take_over_stale(name):
+                    return False
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump({"node": self.node_id, "claimed": time.time()}, f)
+            if self.is_done(name, key):
+                os.remove(self.claim_path(name))
+                return False
+            with self.lock:
+                self.held.add(name)
+                self.lost.discard(name)
+            return True
+        return False
+
+    def release(self, name: str, done: bool = False, key: str = "") -> None:
+        """
+        Releases the claim of a case, marking it done with its key if it finished. A claim
+        that was taken over by another node is left to that node.
+        """
+        owned = self.owns(name)
+        if done and owned:
+            with open(self.done_path(name), "w") as f:
+                json.dump({"node": self.node_id, "finished": time.time(), "key": key}, f)
+        with self.lock:
+            self.held.discard(name)
+            self.lost.discard(name)
+        if owned:
+            try:
+                os.remove(self.claim_path(name))
+            except FileNotFoundError:
+                pass